@@ -4,6 +4,8 @@ from flask_bootstrap import Bootstrap
 from flask_sqlalchemy import SQLAlchemy
 from flask_moment import Moment
 from config import config
+from .jobs import JobRunner
+from .render import RenderService
 
 logging.basicConfig(level=logging.DEBUG,
                     format='%(asctime)s %(filename)s[line:%(lineno)d] %(levelname)s %(message)s',
@@ -11,6 +13,8 @@ logging.basicConfig(level=logging.DEBUG,
 bootstrap = Bootstrap()
 moment = Moment()
 db = SQLAlchemy()
+job_runner = JobRunner()
+render_service = RenderService()
 
 
 def create_app(config_name):
@@ -21,12 +25,11 @@ def create_app(config_name):
     bootstrap.init_app(app)
     moment.init_app(app)
     db.init_app(app)
-    # can not run db.create_all() directly
-    # see https://stackoverflow.com/questions/19437883/when-scattering-flask-models-runtimeerror-application-not-registered-on-db-w/19438054#19438054
-    with app.app_context():
-        # Extensions like Flask-SQLAlchemy now know what the "current" app
-        # is while within this block. Therefore, you can now run........
-        db.create_all()
+    job_runner.init_app(app)
+    from .main.algorithm.Metrics import metrics
+    metrics.Enabled = app.config.get('METRICS_ENABLED', False)
+    render_service.init_app(app)
+    # the schema is created by "manage.py init_db" once, not on every start
 
     from .main import main as main_blueprint
     app.register_blueprint(main_blueprint)
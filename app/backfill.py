@@ -0,0 +1,168 @@
+import logging
+import time
+from flask import current_app
+from sqlalchemy import select, bindparam, or_
+
+from . import db
+from .models import ImageDatabase, AlgorithmVersion
+from .main.algorithm.ImageHandler import ImageHandler
+from .main.algorithm.IngestPipeline import IngestPipeline, score_stored, score_stored_rows
+from .main.algorithm.Metrics import metrics
+from .main.algorithm.PixelStore import PixelStore
+
+# the columns a worker needs to score a row again, see IngestPipeline.stored_dicom()
+Task_Columns = ('Uid', 'Pixel_hash', 'Rows', 'Cols', 'Pixel_spacing', 'Rescale_slope', 'Rescale_intercept',
+                'Window_center', 'Window_width')
+
+
+class Backfill:
+    """
+    Score again the rows made by another algorithm version or other parameters, from the pixel data in the
+    PixelStore, the DICOM files are not read. The outdated rows are read by keyset over Uid a chunk at a time
+    and scored by a process pool, each batch of results is written in one transaction by an update which only
+    matches a row still outdated, so a row is written once, and an interrupted backfill resumes where it
+    stopped by running it again. The drift scores of the updated rows are cleared, rebuild the baselines after.
+    The rows without pixel data can not be scored again, they are counted as missing.
+    """
+    def __init__(self, median_window=6, median_factor=3, workers=None, chunk_size=None, batch_size=None):
+        """
+        :param median_window: width of the median window, see ImageHandler.median_filter()
+        :param median_factor: edge correction factor
+        :param workers: number of worker processes, default is INGEST_WORKERS
+        :param chunk_size: number of rows sent to a worker at a time, default is INGEST_CHUNK_SIZE
+        :param batch_size: number of rows read and written in one transaction, default is INGEST_BATCH_SIZE
+        """
+        config = current_app.config
+        self.Parameters = ImageHandler.default_parameters(median_window, median_factor)
+        self.Parameter_Hash = AlgorithmVersion.parameter_hash(self.Parameters)
+        self.Workers = workers or config['INGEST_WORKERS']
+        self.Chunk_Size = max(1, chunk_size or config['INGEST_CHUNK_SIZE'])
+        self.Batch_Size = max(1, batch_size or config['INGEST_BATCH_SIZE'])
+        self.Pixel_Store = config['PIXEL_STORE_DIR']
+        self.Total = 0
+        self.Missing = 0
+        self.Processed = 0
+        self.Updated = 0
+        self.Failed = 0
+        self.Elapsed = 0.0
+
+    def outdated(self):
+        """
+        :return: the condition of the rows which are not made by the parameters of this backfill
+        """
+        table = ImageDatabase.__table__
+        return or_(table.c.Parameter_hash.is_(None), table.c.Parameter_hash != self.Parameter_Hash)
+
+    def count(self):
+        """
+        Count the outdated rows, with and without pixel data.
+        """
+        table = ImageDatabase.__table__
+        rows, with_pixels = db.session.execute(
+            select([db.func.count(), db.func.count(table.c.Pixel_hash)]).where(self.outdated())).fetchone()
+        self.Total = with_pixels
+        self.Missing = rows - with_pixels
+
+    def tasks(self, stop=None):
+        """
+        :param stop: a callable, no more rows are read once it returns True
+        :return: a generator of dicts of Task_Columns of the outdated rows with pixel data, by Uid
+        """
+        table = ImageDatabase.__table__
+        query = select([table.c[name] for name in Task_Columns]).where(self.outdated()).where(
+            table.c.Pixel_hash.isnot(None))
+        last_uid = None
+        while stop is None or not stop():
+            chunk = query if last_uid is None else query.where(table.c.Uid > last_uid)
+            rows = [dict(row) for row in
+                    db.session.execute(chunk.order_by(table.c.Uid).limit(self.Batch_Size)).fetchall()]
+            if not rows:
+                return
+            last_uid = rows[-1]['Uid']
+            yield from rows
+
+    def results(self, stop=None):
+        """
+        :return: a generator of the IngestResult of the outdated rows, in Uid order
+        """
+        tasks = self.tasks(stop)
+        if self.Workers <= 1:
+            store = PixelStore(self.Pixel_Store)
+            for task in tasks:
+                yield score_stored(task, store, self.Parameters)
+            return
+        pipeline = IngestPipeline(workers=self.Workers, chunk_size=self.Chunk_Size)
+        yield from pipeline.map_chunks(score_stored_rows, pipeline.chunks(tasks), self.Pixel_Store, self.Parameters,
+                                       metrics.Enabled)
+
+    @metrics.timed('backfill_write')
+    def write(self, values):
+        """
+        Write a batch of results in one transaction, a row which is not outdated any more is not written.
+        :param values: list of dicts of the update parameters
+        """
+        table = ImageDatabase.__table__
+        update = table.update().where(table.c.Uid == bindparam('uid')).where(self.outdated()).values(
+            Integration_result=bindparam('profile'), Integration_raw=bindparam('raw_profile'),
+            Algorithm_version=bindparam('version'), Parameter_hash=bindparam('params'), Drift_score=None)
+        try:
+            result = db.session.execute(update, values)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        self.Updated += result.rowcount if result.rowcount >= 0 else len(values)
+
+    def state(self):
+        """
+        :return: a JSON serializable dict of the progress
+        """
+        return dict(total=self.Total, missing=self.Missing, processed=self.Processed, updated=self.Updated,
+                    failed=self.Failed, elapsed=self.Elapsed,
+                    rows_per_second=self.Processed / self.Elapsed if self.Elapsed > 0 else 0.0,
+                    version=self.Parameters['version'], params=self.Parameter_Hash)
+
+    def run(self, stop=None, report=None):
+        """
+        :param stop: a callable, the backfill stops when it returns True, the written batches are kept
+        :param report: optional callable(state()), called after each written batch
+        :return: state()
+        """
+        started = time.perf_counter()
+        self.count()
+        AlgorithmVersion.register([self.Parameters])
+        db.session.commit()
+        logging.info(r"Backfill of %d rows to the parameters %s" % (self.Total, self.Parameter_Hash))
+        values = []
+
+        def flush():
+            if values:
+                self.write(values)
+                del values[:]
+            self.Elapsed = time.perf_counter() - started
+            if report is not None:
+                report(self.state())
+
+        try:
+            for result in self.results(stop):
+                self.Processed += 1
+                if not result.isComplete:
+                    self.Failed += 1
+                    logging.warning(result.FileName + r": the stored pixel data can not be scored")
+                    continue
+                values.append(dict(uid=result.Uid, profile=ImageDatabase.pack_profile(result.Profile),
+                                   raw_profile=ImageDatabase.pack_profile(result.Raw_Profile),
+                                   version=result.Algorithm['version'],
+                                   params=AlgorithmVersion.parameter_hash(result.Algorithm)))
+                if len(values) >= self.Batch_Size:
+                    flush()
+        finally:
+            flush()
+        return self.state()
+
+
+def backfill(median_window=6, median_factor=3, workers=None, stop=None, report=None):
+    """
+    :return: the state() of the finished Backfill
+    """
+    return Backfill(median_window, median_factor, workers=workers).run(stop, report)
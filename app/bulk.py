@@ -0,0 +1,144 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+from datetime import datetime
+
+from flask import current_app
+
+from .main.ingest import DicomIngest
+
+
+class IngestCheckpoint:
+    """
+    The state of a bulk ingest of one directory, saved to a JSON file after every written batch.
+    Which files are done is kept by the FileManifest rows, written in the same transaction as the
+    images, so a run that is interrupted at any point skips the done files on the next run without
+    opening them. The checkpoint file adds what the manifest does not know: the totals and the
+    failed files of all runs until the directory is finished.
+    """
+    Counters = ('processed', 'inserted', 'duplicated', 'unchanged', 'failed')
+
+    def __init__(self, path, directory):
+        """
+        :param path: the JSON file
+        :param directory: the absolute directory to ingest
+        """
+        self.Path = path
+        self.Directory = directory
+        self.State = self.new_state()
+        # the counters of the previous runs, the current run is added by update()
+        self.Base = dict.fromkeys(self.Counters, 0)
+        self.Elapsed_Base = 0.0
+
+    def new_state(self):
+        state = dict(directory=self.Directory, started=datetime.now().isoformat(timespec='seconds'),
+                     updated=None, finished=False, runs=0, elapsed=0.0, skipped=0, failures=[])
+        state.update(dict.fromkeys(self.Counters, 0))
+        return state
+
+    @classmethod
+    def default_path(cls, directory):
+        """
+        :return: INGEST_CHECKPOINT_DIR/<hash of the directory>.json
+        """
+        name = hashlib.sha1(directory.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(current_app.config['INGEST_CHECKPOINT_DIR'], name + '.json')
+
+    def load(self):
+        """
+        Continue the unfinished run saved in the file, if any.
+        :return: True if a run is resumed
+        """
+        try:
+            with open(self.Path) as fp:
+                state = json.load(fp)
+        except (OSError, ValueError):
+            return False
+        if state.get('directory') != self.Directory or state.get('finished'):
+            return False
+        self.State.update(state)
+        self.Base = {name: state[name] for name in self.Counters}
+        return True
+
+    def begin(self):
+        self.Elapsed_Base = self.State['elapsed']
+        self.State['runs'] += 1
+
+    def update(self, ingest, elapsed, failures=(), finished=False):
+        """
+        :param ingest: the DicomIngest of the current run
+        :param elapsed: seconds of the current run
+        :param failures: the files failed since the last update
+        :param finished: the whole directory is done
+        """
+        counts = dict(processed=ingest.Processed, inserted=ingest.Inserted, duplicated=ingest.Duplicated,
+                      unchanged=ingest.Unchanged, failed=ingest.Failed)
+        for name in self.Counters:
+            self.State[name] = self.Base[name] + counts[name]
+        self.State['skipped'] = ingest.Manifest.Skipped
+        self.State['failures'].extend(failures)
+        self.State['elapsed'] = self.Elapsed_Base + elapsed
+        self.State['finished'] = finished
+        self.State['updated'] = datetime.now().isoformat(timespec='seconds')
+
+    def save(self):
+        """
+        Write the file atomically, a crash never leaves half a checkpoint.
+        """
+        directory = os.path.dirname(os.path.abspath(self.Path))
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as fp:
+                json.dump(self.State, fp, indent=2)
+            os.replace(temp_path, self.Path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+
+def bulk_ingest(directory, workers=None, batch_size=None, checkpoint_path=None, restart=False, stop=None,
+                report=None, report_interval=10.0):
+    """
+    Ingest a directory tree unattended with the same pipeline as the web ingest.
+    :param directory: the directory to ingest
+    :param workers: number of worker processes, default is INGEST_WORKERS
+    :param batch_size: number of rows written in one transaction, default is INGEST_BATCH_SIZE
+    :param checkpoint_path: the checkpoint JSON file, default is IngestCheckpoint.default_path()
+    :param restart: do not continue the totals of an unfinished run
+    :param stop: a callable, the ingest stops when it returns True, the checkpoint is kept to resume
+    :param report: optional callable(checkpoint state), called every report_interval seconds
+    :param report_interval: seconds between 2 reports
+    :return: the IngestCheckpoint, State has the totals of all runs
+    """
+    directory = os.path.abspath(directory)
+    checkpoint = IngestCheckpoint(checkpoint_path or IngestCheckpoint.default_path(directory), directory)
+    if not restart:
+        checkpoint.load()
+    checkpoint.begin()
+    ingest = DicomIngest(directory, workers=workers, batch_size=batch_size, keep_log=False)
+    started = time.perf_counter()
+    last_report = started
+    flush_count = 0
+    failures = []
+    for result in ingest.run(stop=stop):
+        if not result.isComplete and not result.isUnchanged:
+            failures.append(result.FileName)
+        now = time.perf_counter()
+        if ingest.Writer.Flush_Count != flush_count:
+            # the failures are written to the manifest with the batch, save them together
+            flush_count = ingest.Writer.Flush_Count
+            checkpoint.update(ingest, now - started, failures)
+            failures = []
+            checkpoint.save()
+        if report is not None and now - last_report >= report_interval:
+            last_report = now
+            checkpoint.update(ingest, now - started)
+            report(checkpoint.State)
+    stopped = stop is not None and stop()
+    checkpoint.update(ingest, time.perf_counter() - started, failures,
+                      finished=not stopped and ingest.Directory_Handler.Input_Directory is not None)
+    checkpoint.save()
+    return checkpoint
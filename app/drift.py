@@ -0,0 +1,198 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+from flask import current_app
+from sqlalchemy import select
+
+from . import db
+from .models import ImageDatabase, Baseline
+from .query import filter_images
+from .main.algorithm.DriftDetector import DriftDetector
+
+# the columns of a profile matrix, enough for Baseline.scan_mode()
+Matrix_Columns = ('Uid', 'Serial_number', 'Tube_voltage', 'Tube_current', 'Kernel', 'Total_collimation',
+                  'Slice_Thickness', 'Instance', 'Date_Time', 'Integration_result')
+
+
+class ProfileMatrix:
+    """
+    The stored profiles as float32 matrices, one per profile length, with the baseline key of every row.
+    """
+    def __init__(self, uids, keys, date_times, profiles):
+        """
+        :param uids: list of Uid
+        :param keys: list of (serial number, scan mode), one per row
+        :param date_times: list of Date_Time
+        :param profiles: list of Integration_result bytes
+        """
+        self.Uids = np.array(uids, dtype=object)
+        self.Date_Times = np.array(date_times, dtype=object)
+        # index of the key of every row in Keys
+        self.Keys, self.Key_Index = self.index_keys(keys)
+        lengths = np.array([len(profile) // 4 for profile in profiles], dtype=np.int64)
+        # {length: (row indexes, (rows, length) float32 matrix)}
+        self.Matrices = OrderedDict()
+        for length in np.unique(lengths):
+            rows = np.flatnonzero(lengths == length)
+            data = b''.join(profiles[i] for i in rows)
+            self.Matrices[int(length)] = (rows, np.frombuffer(data, dtype=np.float32).reshape(len(rows), length))
+
+    @staticmethod
+    def index_keys(keys):
+        index = {}
+        key_index = np.fromiter((index.setdefault(key, len(index)) for key in keys), dtype=np.int64,
+                                count=len(keys))
+        return list(index), key_index
+
+    def __len__(self):
+        return len(self.Uids)
+
+    @classmethod
+    def load(cls, chunk_size=5000, **filters):
+        """
+        :param chunk_size: number of rows fetched at a time
+        :param filters: see query.filter_images()
+        :return: a ProfileMatrix of the matching images
+        """
+        columns = [getattr(ImageDatabase, name) for name in Matrix_Columns]
+        query = filter_images(db.session.query(*columns), **filters)
+        uids, keys, date_times, profiles = [], [], [], []
+        for row in query.yield_per(chunk_size):
+            row = dict(zip(Matrix_Columns, row))
+            uids.append(row['Uid'])
+            keys.append((Baseline.serial_number(row['Serial_number']), Baseline.scan_mode(row)))
+            date_times.append(row['Date_Time'])
+            profiles.append(row['Integration_result'])
+        return cls(uids, keys, date_times, profiles)
+
+
+class BaselineCache:
+    """
+    All baselines as arrays, loaded once and again only when a baseline is written, see Baseline.Written.
+    The table is small (one row per scanner and scan mode), the check is one aggregate query.
+    """
+    def __init__(self):
+        self.Lock = threading.Lock()
+        self.Stamp = None
+        # {(serial number, scan mode): (count, float32 mean, float32 std)}
+        self.Baselines = {}
+
+    def stamp(self):
+        table = Baseline.__table__
+        return tuple(db.session.execute(select([db.func.count(), db.func.sum(table.c.Count),
+                                                db.func.max(table.c.Written)])).fetchone())
+
+    def get(self):
+        """
+        :return: dict of {(serial number, scan mode): (count, mean, std)}
+        """
+        stamp = self.stamp()
+        with self.Lock:
+            if stamp != self.Stamp:
+                baselines = {}
+                for baseline in Baseline.query:
+                    running = baseline.running_profile()
+                    baselines[(Baseline.serial_number(baseline.Serial_number), baseline.Scan_mode)] = (
+                        running.Count, running.Mean.astype(np.float32), running.std.astype(np.float32))
+                self.Baselines = baselines
+                self.Stamp = stamp
+            return self.Baselines
+
+
+baseline_cache = BaselineCache()
+
+
+def score_matrix(matrix, baselines, detector):
+    """
+    :param matrix: a ProfileMatrix
+    :param baselines: dict of BaselineCache.get()
+    :param detector: the DriftDetector
+    :return: (n,) scores of all rows of the matrix, NaN if unscored
+    """
+    scores = np.full(len(matrix), np.nan)
+    for length, (rows, profiles) in matrix.Matrices.items():
+        # the baselines of this length, in the order of matrix.Keys
+        index = np.full(len(matrix.Keys), -1, dtype=np.int64)
+        means, stds, counts = [], [], []
+        for i, key in enumerate(matrix.Keys):
+            baseline = baselines.get(key)
+            if baseline is not None and len(baseline[1]) == length:
+                index[i] = len(counts)
+                counts.append(baseline[0])
+                means.append(baseline[1])
+                stds.append(baseline[2])
+        if not counts:
+            continue
+        scores[rows] = detector.score_matrix(profiles, index[matrix.Key_Index[rows]], np.stack(means),
+                                             np.stack(stds), np.array(counts))
+    return scores
+
+
+def drift_report(matrix, baselines, detector):
+    """
+    The fleet-wide drift of a ProfileMatrix against the baselines, computed on the whole matrix at once.
+    :param matrix: a ProfileMatrix
+    :param baselines: dict of BaselineCache.get()
+    :param detector: the DriftDetector, its Threshold flags a profile
+    :return: a JSON serializable dict, the scanners and the scan modes sorted by max score, highest first
+    """
+    scores = score_matrix(matrix, baselines, detector)
+    keys = matrix.Keys
+    summary = detector.summarize(scores, matrix.Key_Index, len(keys))
+
+    # the newest profile of every key: the last of the rows sorted by key then Date_Time
+    order = np.lexsort((matrix.Date_Times.astype(str), matrix.Key_Index)) if len(matrix) else np.array([], int)
+    last = np.full(len(keys), -1, dtype=np.int64)
+    last[matrix.Key_Index[order]] = order
+
+    def number(value):
+        return None if np.isnan(value) else round(float(value), 3)
+
+    modes = []
+    for i, (serial, scan_mode) in enumerate(keys):
+        baseline = baselines.get((serial, scan_mode))
+        modes.append(OrderedDict(serial=serial, scan_mode=scan_mode, baseline_count=baseline[0] if baseline else 0,
+                                 images=int(summary['images'][i]), scored=int(summary['scored'][i]),
+                                 flagged=int(summary['flagged'][i]), mean_score=number(summary['mean_score'][i]),
+                                 max_score=number(summary['max_score'][i]), last_uid=matrix.Uids[last[i]],
+                                 last_date_time=matrix.Date_Times[last[i]], last_score=number(scores[last[i]])))
+
+    # the same summary by scanner
+    serials, serial_index = ProfileMatrix.index_keys([serial for serial, _ in keys])
+    serial_summary = detector.summarize(scores, serial_index[matrix.Key_Index], len(serials))
+    scanners = [OrderedDict(serial=serial, scan_modes=int(np.count_nonzero(serial_index == i)),
+                            images=int(serial_summary['images'][i]), scored=int(serial_summary['scored'][i]),
+                            flagged=int(serial_summary['flagged'][i]),
+                            mean_score=number(serial_summary['mean_score'][i]),
+                            max_score=number(serial_summary['max_score'][i]))
+                for i, serial in enumerate(serials)]
+
+    def by_score(item):
+        return -1 if item['max_score'] is None else item['max_score']
+
+    scored = ~np.isnan(scores)
+    return OrderedDict(threshold=detector.Threshold, images=len(matrix), scored=int(scored.sum()),
+                       flagged=int((scores[scored] > detector.Threshold).sum()),
+                       scanners=sorted(scanners, key=by_score, reverse=True),
+                       scan_modes=sorted(modes, key=by_score, reverse=True))
+
+
+def fleet_drift_report(threshold=None, **filters):
+    """
+    Load the profiles matching the filters and report their drift against the cached baselines.
+    :param threshold: the score which flags a profile, default is DRIFT_THRESHOLD
+    :param filters: see query.filter_images()
+    :return: see drift_report()
+    """
+    detector = make_detector(threshold)
+    return drift_report(ProfileMatrix.load(**filters), baseline_cache.get(), detector)
+
+
+def make_detector(threshold=None):
+    """
+    :param threshold: the score which flags a profile, default is DRIFT_THRESHOLD
+    :return: a DriftDetector of the DRIFT_* settings
+    """
+    config = current_app.config
+    return DriftDetector(min_count=config['DRIFT_MIN_COUNT'], std_floor=config['DRIFT_STD_FLOOR'],
+                         threshold=config['DRIFT_THRESHOLD'] if threshold is None else threshold)
@@ -0,0 +1,210 @@
+import csv
+import io
+from sqlalchemy import and_, or_
+
+from . import db
+from .models import ImageDatabase
+from .query import filter_images
+
+# every column but the profiles and the legacy Dicom_Save, the profile is added as a fixed length array,
+# Algorithm_version and Parameter_hash tell which algorithm made it
+Export_Columns = ('Uid', 'Serial_number', 'Modality', 'Tube_voltage', 'Tube_current', 'Kernel', 'Total_collimation',
+                  'Slice_Thickness', 'Series', 'Instance', 'Date_Time', 'Comment', 'Rows', 'Cols', 'Pixel_spacing',
+                  'Rescale_slope', 'Rescale_intercept', 'Window_center', 'Window_width', 'Pixel_hash', 'Drift_score',
+                  'Algorithm_version', 'Parameter_hash')
+# SQLite keeps a serial number with letters as text in the integer column, they are exported as text
+Text_Columns = ('Serial_number',)
+
+Formats = {'csv': 'text/csv', 'arrow': 'application/vnd.apache.arrow.stream',
+           'parquet': 'application/vnd.apache.parquet'}
+
+
+def profile_length(**filters):
+    """
+    :param filters: see query.filter_images()
+    :return: the longest profile of the matching images, the length of the profile column
+    """
+    query = filter_images(db.session.query(db.func.max(db.func.length(ImageDatabase.Integration_result))),
+                          **filters)
+    return (query.scalar() or 0) // 4
+
+
+def iter_chunks(chunk_size=2000, **filters):
+    """
+    The matching images by Date_Time then Uid, a chunk at a time, each chunk is a new query which starts after
+    the last row of the previous one, so no cursor stays open and a chunk costs the same at any depth.
+    :param chunk_size: number of rows of a chunk
+    :param filters: see query.filter_images()
+    :return: a generator of lists of tuples of Export_Columns + (Integration_result,)
+    """
+    columns = [getattr(ImageDatabase, name) for name in Export_Columns] + [ImageDatabase.Integration_result]
+    uid, date_time = Export_Columns.index('Uid'), Export_Columns.index('Date_Time')
+    last = None
+    while True:
+        query = filter_images(db.session.query(*columns), **filters)
+        if last is not None:
+            query = query.filter(or_(ImageDatabase.Date_Time > last[date_time],
+                                     and_(ImageDatabase.Date_Time == last[date_time], ImageDatabase.Uid > last[uid])))
+        rows = query.order_by(ImageDatabase.Date_Time, ImageDatabase.Uid).limit(chunk_size).all()
+        # the rows are fetched, the transaction is not kept open between 2 chunks
+        db.session.commit()
+        if not rows:
+            return
+        yield rows
+        last = rows[-1]
+        if len(rows) < chunk_size:
+            return
+
+
+def profile_matrix(rows, length):
+    """
+    :param rows: tuples ending with Integration_result
+    :param length: the length of the profile column
+    :return: (rows, length) float32 np array, a shorter profile is padded by NaN
+    """
+    import numpy as np
+    matrix = np.full((len(rows), length), np.nan, dtype=np.float32)
+    for i, row in enumerate(rows):
+        profile = ImageDatabase.unpack_profile(row[-1])[:length]
+        matrix[i, :len(profile)] = profile
+    return matrix
+
+
+def export_csv(chunk_size=2000, **filters):
+    """
+    :param filters: see query.filter_images()
+    :return: a generator of encoded CSV text, a header line then one chunk of rows at a time,
+    the profile is one column per radius, empty after the end of a shorter profile
+    """
+    length = profile_length(**filters)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(Export_Columns + tuple('Profile_%d' % i for i in range(length)))
+    for rows in iter_chunks(chunk_size, **filters):
+        profiles = profile_matrix(rows, length)
+        for row, profile in zip(rows, profiles.tolist()):
+            writer.writerow(row[:-1] + tuple('' if value != value else '%.7g' % value for value in profile))
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+class ChunkSink:
+    """
+    A write-only file object for the pyarrow writers, what is written is taken out by pop() and sent,
+    so the file is streamed without being kept.
+    """
+    def __init__(self):
+        self.Chunks = []
+        self.Position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self.Chunks.append(data)
+        self.Position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.Position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def writable(self):
+        return True
+
+    def pop(self):
+        data = b''.join(self.Chunks)
+        self.Chunks = []
+        return data
+
+
+def import_pyarrow():
+    """
+    :raise ImportError: pyarrow is not installed, it is only needed by the Arrow and Parquet exports
+    """
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError(r"The Arrow and Parquet exports need pyarrow: pip install pyarrow")
+    return pyarrow
+
+
+def arrow_schema(pa, length):
+    types = {int: pa.int64(), float: pa.float64(), str: pa.string()}
+    fields = [pa.field(name, pa.string() if name in Text_Columns else
+                       types[ImageDatabase.__table__.c[name].type.python_type]) for name in Export_Columns]
+    fields.append(pa.field('Profile', pa.list_(pa.float32(), length)))
+    return pa.schema(fields)
+
+
+def record_batch(pa, schema, rows, length):
+    """
+    :return: a pyarrow RecordBatch of the rows, the profile is a fixed size list of float32
+    """
+    arrays = []
+    for i, name in enumerate(Export_Columns):
+        values = [row[i] for row in rows]
+        if name in Text_Columns:
+            values = [None if value is None else str(value) for value in values]
+        arrays.append(pa.array(values, type=schema.field(name).type))
+    flat = pa.array(profile_matrix(rows, length).ravel(), type=pa.float32())
+    arrays.append(pa.FixedSizeListArray.from_arrays(flat, length))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def export_arrow(chunk_size=2000, **filters):
+    """
+    :param filters: see query.filter_images()
+    :return: a generator of the bytes of an Arrow IPC stream, one record batch per chunk of rows
+    """
+    pa = import_pyarrow()
+    length = profile_length(**filters)
+    schema = arrow_schema(pa, length)
+    sink = ChunkSink()
+    writer = pa.ipc.new_stream(sink, schema)
+    for rows in iter_chunks(chunk_size, **filters):
+        writer.write_batch(record_batch(pa, schema, rows, length))
+        yield sink.pop()
+    writer.close()
+    yield sink.pop()
+
+
+def export_parquet(chunk_size=2000, **filters):
+    """
+    :param filters: see query.filter_images()
+    :return: a generator of the bytes of a Parquet file, one row group per chunk of rows
+    """
+    pa = import_pyarrow()
+    import pyarrow.parquet as pq
+    length = profile_length(**filters)
+    schema = arrow_schema(pa, length)
+    sink = ChunkSink()
+    writer = pq.ParquetWriter(sink, schema)
+    for rows in iter_chunks(chunk_size, **filters):
+        writer.write_table(pa.Table.from_batches([record_batch(pa, schema, rows, length)]))
+        yield sink.pop()
+    writer.close()
+    yield sink.pop()
+
+
+Exporters = {'csv': export_csv, 'arrow': export_arrow, 'parquet': export_parquet}
+
+
+def export(format_, chunk_size=2000, **filters):
+    """
+    :param format_: csv, arrow or parquet
+    :param chunk_size: number of rows read and converted at a time, the memory does not depend on the total
+    :param filters: see query.filter_images()
+    :return: a generator of bytes
+    :raise ImportError: the format needs pyarrow, which is not installed
+    """
+    if format_ != 'csv':
+        import_pyarrow()
+    return Exporters[format_](chunk_size, **filters)
@@ -0,0 +1,160 @@
+import cProfile
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class IngestJob:
+    """
+    One background ingest of a directory, its status is read by the status endpoint
+    while the job runner thread updates it.
+    """
+    Status_Type = {'queued', 'running', 'done', 'failed', 'cancelled'}
+
+    def __init__(self, directory):
+        self.Id = uuid.uuid4().hex
+        self.Directory = directory
+        self.Status = 'queued'
+        self.Error = None
+        self.Created = time.time()
+        self.Started = None
+        self.Finished = None
+        self.Cancel_Event = threading.Event()
+        self.Future = None
+        self.Ingest = None
+        # path of the cProfile stats of the job, if INGEST_PROFILE is set
+        self.Profile = None
+
+    def is_finished(self):
+        return self.Status in ('done', 'failed', 'cancelled')
+
+    def to_dict(self, since=0):
+        """
+        :param since: number of log lines the client already has
+        :return: a JSON serializable dict of the status, with the log lines after since
+        """
+        ingest = self.Ingest
+        result = dict(id=self.Id, directory=self.Directory, status=self.Status, error=self.Error,
+                      created=self.Created, started=self.Started, finished=self.Finished,
+                      progress=0, found=0, processed=0, inserted=0, duplicated=0, unchanged=0, failed=0, drifted=0,
+                      log=[], log_offset=since, timing=None, profile=self.Profile is not None)
+        if ingest is not None:
+            # lines of rows still waiting for their batch may change, they are sent later
+            settled = ingest.settled_log_count()
+            result.update(progress=100 if self.Status == 'done' else ingest.progress(),
+                          found=ingest.Directory_Handler.Total_Dicom_Quantity,
+                          processed=ingest.Processed, inserted=ingest.Inserted, duplicated=ingest.Duplicated,
+                          unchanged=ingest.Unchanged, failed=ingest.Failed, drifted=ingest.Drifted,
+                          log=ingest.Log_Record[since:settled], log_offset=max(since, settled),
+                          timing=ingest.Timing)
+        return result
+
+
+class JobRunner:
+    """
+    In-process runner of ingest jobs, so a multi-minute import never blocks a web worker.
+    Jobs run in INGEST_JOB_THREADS background threads, each one in its own app context;
+    the last INGEST_JOB_HISTORY finished jobs are kept for the status endpoint.
+    """
+    def __init__(self, app=None):
+        self.app = None
+        self.Executor = None
+        self.Jobs = OrderedDict()
+        self.Lock = threading.Lock()
+        self.History = 100
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.History = app.config.get('INGEST_JOB_HISTORY', 100)
+        self.Executor = ThreadPoolExecutor(max_workers=app.config.get('INGEST_JOB_THREADS', 1))
+
+    def submit(self, directory):
+        """
+        :param directory: the directory to ingest
+        :return: the queued IngestJob
+        """
+        job = IngestJob(directory)
+        with self.Lock:
+            self.Jobs[job.Id] = job
+            self.forget_old_jobs()
+        job.Future = self.Executor.submit(self.run, job)
+        return job
+
+    def forget_old_jobs(self):
+        finished = [job_id for job_id, job in self.Jobs.items() if job.is_finished()]
+        for job_id in finished[:max(0, len(finished) - self.History)]:
+            del self.Jobs[job_id]
+
+    def status_counts(self):
+        """
+        :return: dict of {status: number of jobs}
+        """
+        with self.Lock:
+            jobs = list(self.Jobs.values())
+        counts = dict.fromkeys(IngestJob.Status_Type, 0)
+        for job in jobs:
+            counts[job.Status] += 1
+        return counts
+
+    def get(self, job_id):
+        with self.Lock:
+            return self.Jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """
+        :return: the job, or None if there is no such job
+        """
+        job = self.get(job_id)
+        if job is not None:
+            job.Cancel_Event.set()
+        return job
+
+    def run(self, job):
+        from . import db
+        from .main.ingest import DicomIngest
+        from .main.algorithm.Metrics import metrics
+        with self.app.app_context():
+            if job.Cancel_Event.is_set():
+                job.Status = 'cancelled'
+                job.Finished = time.time()
+                return
+            job.Status = 'running'
+            job.Started = time.time()
+            profile = cProfile.Profile() if self.app.config.get('INGEST_PROFILE') else None
+            try:
+                job.Ingest = DicomIngest(job.Directory)
+                if profile is not None:
+                    profile.enable()
+                with metrics.timer('dicom_input'):
+                    for _ in job.Ingest.run(stop=job.Cancel_Event.is_set):
+                        pass
+                job.Status = 'cancelled' if job.Cancel_Event.is_set() else 'done'
+            except Exception as e:
+                logging.exception(e)
+                job.Error = str(e)
+                job.Status = 'failed'
+            finally:
+                if profile is not None:
+                    profile.disable()
+                    self.save_profile(job, profile)
+                job.Finished = time.time()
+                db.session.remove()
+
+    def save_profile(self, job, profile):
+        """
+        Save the stats of the main thread of the job, the worker processes are not profiled.
+        """
+        directory = self.app.config['PROFILE_DIR']
+        try:
+            os.makedirs(directory, exist_ok=True)
+            job.Profile = os.path.join(directory, job.Id + '.prof')
+            profile.dump_stats(job.Profile)
+        except OSError as e:
+            logging.error(str(e))
+            job.Profile = None
@@ -2,14 +2,29 @@ import dicom
 import numpy as np
 import logging
 
+from .Metrics import metrics
+
 
 class DicomHandler:
-    def __init__(self, filename):
+    # header attributes which are plain values, used by header()
+    Header_Fields = ('SerialNumber', 'Modality', 'Slop', 'Intercept', 'Rows', 'Cols', 'PixSpace', 'Instance',
+                     'StudyDescription', 'WindowCenter', 'WindowWidth', 'FOV', 'KVP', 'Current', 'Kernel',
+                     'Series', 'TotalCollimation', 'SliceThickness', 'DateTime', 'ScanMode', 'Uid')
+
+    def __init__(self, filename, fp=None, lean=False):
+        """
+        :param filename: full path of the DICOM file
+        :param fp: optional file object of the content (e.g. io.BytesIO), read instead of filename
+        :param lean: drop the pydicom Dataset once the header is read, Data is None then,
+        and RawData is a read only view of the pixel data bytes instead of a copy
+        """
         self.isComplete = False
         self.FileName = filename
+        self.Lean = lean
 
         try:
-            self.Data = dicom.read_file(self.FileName)
+            with metrics.timer('dicom_read'):
+                self.Data = dicom.read_file(fp if fp is not None else self.FileName)
 
             # system related
             self.SerialNumber = self.Data[0x0018, 0x1000].value
@@ -32,7 +47,8 @@ class DicomHandler:
             self.WindowCenter = self.Data[0x0028, 0x1050].value
             self.WindowWidth = self.Data[0x0028, 0x1051].value
             self.FOV = self.Data[0x0018, 0x1100].value
-            self.RawData = np.array(self.Data.pixel_array)
+            with metrics.timer('dicom_pixel_data'):
+                self.RawData = self.pixel_view() if self.Lean else np.array(self.Data.pixel_array)
 
             # Scan related
             self.KVP = self.Data[0x0018, 0x0060].value
@@ -55,12 +71,55 @@ class DicomHandler:
         except Exception as e:
             logging.error("Dicom data parse error:" + str(e))
             return
+        finally:
+            if self.Lean:
+                self.Data = None
 
         self.isComplete = True
 
+    def pixel_view(self):
+        """
+        The pixel data without a copy, only the bytes of PixelData are kept alive by the view.
+        Falls back to a copy of pixel_array for multi frame or multi sample data.
+        :return: a read only np array in shape (Rows, Cols)
+        """
+        data = self.Data
+        if data.get('NumberOfFrames', 1) > 1 or data.get('SamplesPerPixel', 1) > 1:
+            return np.array(data.pixel_array)
+        dtype = np.dtype('%sint%d' % (('u', '')[data.PixelRepresentation], data.BitsAllocated))
+        stored = dtype.newbyteorder('<' if data.is_little_endian else '>')
+        pixels = np.frombuffer(data.PixelData, stored, count=self.Rows * self.Cols).reshape(self.Rows, self.Cols)
+        # big endian data is swapped to a native copy, as pixel_array does
+        return pixels if stored.isnative else pixels.astype(dtype)
+
+    def header(self):
+        """
+        Get the header fields without the pydicom Dataset and pixel data,
+        small enough to be sent between processes.
+        :return: a dict of {field name: plain python value}
+        """
+        return {field: self.plain_value(getattr(self, field)) for field in self.Header_Fields}
+
+    @staticmethod
+    def plain_value(value):
+        """
+        Convert pydicom value types (DSfloat, IS, MultiValue...) to plain python types
+        """
+        if isinstance(value, (list, tuple)):
+            return [DicomHandler.plain_value(v) for v in value]
+        if isinstance(value, float):
+            return float(value)
+        if isinstance(value, int):
+            return int(value)
+        return str(value)
+
 
 if __name__ == '__main__':
     print("please do not use it individually unless of debugging.")
 
-    a = DicomHandler(r"../../../tests/a.dcm")
-    print(a.isComplete)
+    # python -m app.main.algorithm.DicomHanlder
+    import tempfile
+    from .PhantomGenerator import PhantomGenerator
+    with tempfile.TemporaryDirectory() as directory:
+        a = DicomHandler(PhantomGenerator().write(directory + '/phantom.dcm'))
+        print(a.isComplete, a.header())
@@ -3,48 +3,154 @@ import os
 import dicom
 import logging
 
+from .Metrics import metrics
+
 
 class DirectoryHandler:
     """
     The class will iterate the input directory to find target database file.
     And store each found file full path in a list of string "Database_File_Path"
+    The files are checked by the 128 bytes preamble and "DICM" magic first,
+    then only the header (everything before pixel data) is read to check the study description.
     """
-    Dicom_File_Path = []
-    Total_Dicom_Quantity = 0
-    Log_Record = []
+    Study_Description = r"Band Assessment"
 
-    def __init__(self, input_directory):
+    def __init__(self, input_directory, lazy=False):
         """
         :param input_directory:
+        :param lazy: if True, do not walk the directory now, use iter_files() to stream the found files
         """
-        if input_directory is not None:
-            if os.path.isdir(input_directory):
-                self.Log_Record.append(r"输入参数为文件夹（正确）")
-            else:
-                self.Log_Record.append(r"输入参数不是文件夹，请再次检查！")
-                return
-        absolute_path = os.path.abspath(input_directory)
-        self.list_files(absolute_path)
+        # instance level, so nothing leaks between requests
+        self.Dicom_File_Path = []
+        self.Total_Dicom_Quantity = 0
+        # True once iter_files() or iter_paths() is exhausted, Total_Dicom_Quantity is final then
+        self.Discovery_Finished = False
+        self.Log_Record = []
+        self.Input_Directory = None
+        if input_directory is not None and os.path.isdir(input_directory):
+            self.Log_Record.append(r"输入参数为文件夹（正确）")
+        else:
+            self.Log_Record.append(r"输入参数不是文件夹，请再次检查！")
+            return
+        self.Input_Directory = os.path.abspath(input_directory)
+        if not lazy:
+            self.list_files(self.Input_Directory)
 
     def list_files(self, input_directory):
         """
         :param input_directory:
         :return: no return. Directly write all target files found in Database_File_Path
         """
-        dir_list = os.listdir(input_directory)
-        for dl in dir_list:
-            full_dl = os.path.join(input_directory, dl)
-            if os.path.isfile(full_dl):
+        for full_dl in self.iter_files(input_directory):
+            self.Dicom_File_Path.append(full_dl)
+            self.Log_Record.append(str(full_dl))
+
+    def iter_files(self, input_directory=None, skip=None, reject=None):
+        """
+        Walk the directory without recursion and yield the target files as soon as they are found.
+        Total_Dicom_Quantity is updated while walking, Discovery_Finished is set at the end.
+        :param input_directory: default is the directory passed to the constructor
+        :param skip: optional callable(path, stat), return True to skip the file before it is opened
+        :param reject: optional callable(path, stat), called for each file which is not a target file
+        :return: a generator of full path, sorted by name in each directory
+        """
+        if input_directory is None:
+            input_directory = self.Input_Directory
+        if input_directory is None:
+            self.Discovery_Finished = True
+            return
+        pending_directory = [input_directory]
+        while pending_directory:
+            current_directory = pending_directory.pop()
+            try:
+                with os.scandir(current_directory) as it:
+                    entries = sorted(it, key=lambda e: e.name)
+            except OSError as e:
+                logging.error(str(e))
+                continue
+            sub_directory = []
+            for entry in entries:
                 try:
-                    # try to open the dicom file.
-                    _ = dicom.read_file(full_dl)[0x0018, 0x1000].value
-                    self.Dicom_File_Path.append(full_dl)
-                    self.Total_Dicom_Quantity += 1
-                    self.Log_Record.append(str(full_dl))
-                except Exception as e:
+                    if entry.is_dir(follow_symlinks=False):
+                        sub_directory.append(entry.path)
+                    elif entry.is_file() and self.check_file(entry.path, entry.stat(), skip, reject):
+                        yield entry.path
+                except OSError as e:
                     logging.error(str(e))
-            else:
-                self.list_files(full_dl)
+            # pop() takes the last one, keep the sub directories in name order
+            pending_directory.extend(reversed(sub_directory))
+        self.Discovery_Finished = True
+
+    def iter_paths(self, paths, skip=None, reject=None):
+        """
+        The same as iter_files() for a list of files instead of a walk, e.g. the new files of a watched directory.
+        :param paths: full paths of files, a missing one is ignored
+        :param skip: see iter_files()
+        :param reject: see iter_files()
+        :return: a generator of the target files in the order of paths
+        """
+        for path in paths:
+            try:
+                if self.check_file(path, os.stat(path), skip, reject):
+                    yield path
+            except OSError as e:
+                logging.error(str(e))
+        self.Discovery_Finished = True
+
+    def check_file(self, path, stat, skip, reject):
+        """
+        :return: True if the file is a target file, Total_Dicom_Quantity is updated
+        """
+        if skip is not None and skip(path, stat):
+            return False
+        metrics.count('files_discovered')
+        if self.is_target(path):
+            self.Total_Dicom_Quantity += 1
+            return True
+        if reject is not None:
+            reject(path, stat)
+        return False
+
+    @staticmethod
+    def has_dicom_magic(fp):
+        """
+        :param fp: a binary file object at position 0
+        :return: True if there is a 128 bytes preamble followed by "DICM"
+        """
+        return fp.read(132)[128:] == b"DICM"
+
+    @metrics.timed('is_target')
+    def is_target(self, filename):
+        """
+        Check the file is a DICOM file of Band Assessment, without reading the pixel data.
+        :param filename: full path
+        :return: True if it is a target file
+        """
+        with open(filename, 'rb') as fp:
+            return self.is_target_file(filename, fp)
+
+    @classmethod
+    def is_target_file(cls, filename, fp):
+        """
+        :param filename: the name in the logs
+        :param fp: a binary file object at position 0, e.g. a BytesIO of an uploaded file
+        :return: True if it is a DICOM file of Band Assessment
+        """
+        if not cls.has_dicom_magic(fp):
+            logging.debug(filename + " is not a DICOM file.")
+            return False
+        fp.seek(0)
+        try:
+            data = dicom.read_file(fp, stop_before_pixels=True)
+            _ = data[0x0018, 0x1000].value
+            study_description = data[0x0008, 0x1030].value
+        except Exception as e:
+            logging.error(filename + ": " + str(e))
+            return False
+        if study_description != cls.Study_Description:
+            logging.info(filename + " is not Band Assessment. It is: " + str(study_description))
+            return False
+        return True
 
 
 if __name__ == '__main__':
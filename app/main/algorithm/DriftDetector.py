@@ -0,0 +1,150 @@
+import numpy as np
+
+
+class RunningProfile:
+    """
+    Mean and variance per radius of the profiles of one scanner and scan mode, updated
+    incrementally by Welford's algorithm, a batch at a time (the parallel form of Chan et al.),
+    so a baseline never needs its history again.
+    """
+    def __init__(self, count=0, mean=None, m2=None):
+        """
+        :param count: number of profiles so far
+        :param mean: float64 np array of the mean per radius
+        :param m2: float64 np array of the sum of the squared differences from the mean per radius
+        """
+        self.Count = count
+        self.Mean = mean
+        self.M2 = m2
+
+    @property
+    def length(self):
+        return None if self.Mean is None else len(self.Mean)
+
+    def add(self, profiles):
+        """
+        :param profiles: 2D array, one profile per row, of the same length as the baseline
+        """
+        profiles = np.asarray(profiles, dtype=np.float64)
+        count = profiles.shape[0]
+        if count == 0:
+            return
+        mean = profiles.mean(axis=0)
+        m2 = ((profiles - mean) ** 2).sum(axis=0)
+        if self.Count == 0:
+            self.Count, self.Mean, self.M2 = count, mean, m2
+            return
+        total = self.Count + count
+        delta = mean - self.Mean
+        self.Mean = self.Mean + delta * (count / total)
+        self.M2 = self.M2 + m2 + delta ** 2 * (self.Count * count / total)
+        self.Count = total
+
+    @property
+    def std(self):
+        """
+        :return: the sample standard deviation per radius, 0 with less than 2 profiles
+        """
+        if self.Count < 2:
+            return np.zeros_like(self.Mean)
+        return np.sqrt(self.M2 / (self.Count - 1))
+
+    def to_bytes(self):
+        return self.Mean.astype(np.float64).tobytes(), self.M2.astype(np.float64).tobytes()
+
+    @classmethod
+    def from_bytes(cls, count, mean, m2):
+        return cls(count, np.frombuffer(mean, dtype=np.float64).copy(), np.frombuffer(m2, dtype=np.float64).copy())
+
+
+class DriftDetector:
+    """
+    Score profiles against their baselines as batched NumPy operations.
+    The score of a profile is the max over radius of |profile - baseline mean| / baseline std,
+    the std is floored so a very stable baseline does not turn noise into drift.
+    The center (radius 0) and the rim, where the median filter extrapolates, are left out.
+    """
+    def __init__(self, min_count=10, std_floor=0.5, threshold=5.0, margin=2):
+        """
+        :param min_count: a baseline of fewer profiles does not score
+        :param std_floor: the min std in HU
+        :param threshold: a profile with a higher score is flagged
+        :param margin: number of radius left out at each end
+        """
+        self.Min_Count = min_count
+        self.Std_Floor = std_floor
+        self.Threshold = threshold
+        self.Margin = margin
+
+    def scores(self, profiles, means, stds):
+        """
+        :param profiles: (n, length) profiles
+        :param means: (n, length) the baseline mean of each profile, or (length,) for all of them
+        :param stds: same shape as means
+        :return: (n,) float64 scores
+        """
+        profiles = np.atleast_2d(profiles)
+        inner = slice(self.Margin, profiles.shape[1] - self.Margin)
+        if profiles.shape[1] <= 2 * self.Margin:
+            inner = slice(None)
+        means = np.asarray(means)[..., inner]
+        stds = np.maximum(np.asarray(stds)[..., inner], self.Std_Floor)
+        deviation = np.abs(profiles[:, inner] - means)
+        deviation /= stds
+        return deviation.max(axis=1)
+
+    def score(self, baseline, profiles):
+        """
+        :param baseline: a RunningProfile
+        :param profiles: (n, length) profiles of the same length
+        :return: (n,) scores, NaN if the baseline has fewer than Min_Count profiles
+        """
+        profiles = np.atleast_2d(np.asarray(profiles, dtype=np.float64))
+        if baseline.Count < self.Min_Count or baseline.length != profiles.shape[1]:
+            return np.full(profiles.shape[0], np.nan)
+        return self.scores(profiles, baseline.Mean, baseline.std)
+
+    def score_matrix(self, profiles, group, means, stds, counts, chunk_size=16384):
+        """
+        Score a whole matrix of profiles, chunk_size rows at a time so the gathered baselines of a
+        chunk stay small.
+        :param profiles: (n, length) profiles
+        :param group: (n,) index of the baseline of each profile, -1 for none
+        :param means: (groups, length) baseline means
+        :param stds: (groups, length) baseline stds
+        :param counts: (groups,) number of profiles of each baseline
+        :param chunk_size: number of rows scored at a time
+        :return: (n,) scores, NaN where there is no baseline of Min_Count profiles
+        """
+        result = np.full(len(group), np.nan)
+        if len(means) == 0:
+            return result
+        valid = group >= 0
+        valid[valid] = counts[group[valid]] >= self.Min_Count
+        rows = np.flatnonzero(valid)
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            index = group[chunk]
+            result[chunk] = self.scores(profiles[chunk], means[index], stds[index])
+        return result
+
+    def summarize(self, scores, group, groups):
+        """
+        :param scores: (n,) scores, NaN for unscored
+        :param group: (n,) index of the report group of each score
+        :param groups: number of report groups
+        :return: dict of (groups,) arrays: images, scored, flagged, mean_score and max_score (NaN if none scored)
+        """
+        scored = ~np.isnan(scores)
+        values = np.where(scored, scores, 0.0)
+        images = np.bincount(group, minlength=groups)
+        scored_count = np.bincount(group, weights=scored, minlength=groups)
+        flagged = np.bincount(group, weights=scored & (values > self.Threshold), minlength=groups)
+        total = np.bincount(group, weights=values, minlength=groups)
+        max_score = np.full(groups, -np.inf)
+        np.maximum.at(max_score, group[scored], values[scored])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean_score = total / scored_count
+        max_score[np.isinf(max_score)] = np.nan
+        return dict(images=images, scored=scored_count.astype(np.int64), flagged=flagged.astype(np.int64),
+                    mean_score=mean_score, max_score=max_score)
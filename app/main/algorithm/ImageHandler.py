@@ -1,27 +1,80 @@
+import os
 import dicom
 import numpy as np
 from PIL import Image
 from PIL import ImageDraw
 from PIL import ImageFilter
-import matplotlib.pyplot as plt
 import logging
 
 from .DicomHanlder import DicomHandler
+from .RingIntegrator import RingIntegrator
+from .PolarTransform import PolarTransform
+from .Renderer import Renderer
+from .Metrics import metrics
 # from DicomHanlder import DicomHandler
 
 
 class ImageHandler:
-    def __init__(self, dcm: DicomHandler):
+    # ring pixels integrated at a time in lean mode
+    Lean_Chunk_Size = 16384
+    # bump it when the same pixels give other profiles with the same parameters, e.g. a change of the
+    # radius rules of calc_circle() or of median_filter(), the stored rows of older versions are backfilled
+    Algorithm_Version = 1
+
+    def __init__(self, dcm: DicomHandler, integration='ring', circle='numpy', subpixel=False,
+                 median_window=6, median_factor=3, lean=False):
+        """
+        :param dcm: a complete DicomHandler
+        :param integration: 'ring' to use the vectorized RingIntegrator,
+        'bresenham' to keep the legacy per pixel loop for validation
+        :param circle: 'numpy' to use the vectorized edge detector,
+        'pil' to keep the legacy PIL FIND_EDGES detector for validation
+        :param subpixel: also estimate a sub-pixel center by a least-squares circle fit,
+        stored in Center_Subpixel and Radius_Subpixel
+        :param median_window: width of the median window, see median_filter()
+        :param median_factor: edge correction factor, see median_filter()
+        :param lean: low memory mode, Image_HU is float32 and clipped to the window in place,
+        the display image Image is None and only made by show_image()
+        """
         self.isImageComplete = False
         self.RescaleType = {'linear', 'logarithm'}
+        self.IntegrationType = {'ring', 'bresenham'}
+        self.CircleType = {'numpy', 'pil'}
+        if integration not in self.IntegrationType:
+            raise ValueError(r"Unknown integration type: " + str(integration))
+        if circle not in self.CircleType:
+            raise ValueError(r"Unknown circle type: " + str(circle))
+        self.Integration = integration
+        self.Circle = circle
+        self.Median_Window = median_window
+        self.Median_Factor = median_factor
+        self.Lean = lean
+        self.Image = None
+        self.Center_Subpixel = None
+        self.Radius_Subpixel = None
         self.Dicom = dcm
 
         try:
             # Convert to HU unit
-            self.Image_HU = self.Dicom.RawData * self.Dicom.Slop + self.Dicom.Intercept
+            if self.Lean:
+                self.Image_HU = self.hu_image(self.Dicom.RawData, self.Dicom.Slop, self.Dicom.Intercept)
+            else:
+                self.Image_HU = self.Dicom.RawData * self.Dicom.Slop + self.Dicom.Intercept
             # center is always in format (row, col)
-            self.Center, self.Radius = self.calc_circle(self.Image_HU.copy())
-            self.Image = self.rescale_image(self.Image_HU, (self.Dicom.WindowWidth, self.Dicom.WindowCenter))
+            if self.Circle == 'pil':
+                self.Center, self.Radius = self.calc_circle_pil(self.Image_HU.copy())
+            else:
+                # the numpy detector never writes to the image, no copy needed
+                self.Center, self.Radius = self.calc_circle(self.Image_HU)
+            if subpixel:
+                self.Center_Subpixel, self.Radius_Subpixel = self.fit_circle(self.Image_HU, self.Center,
+                                                                             self.Radius[0])
+            with metrics.timer('rescale_image'):
+                if self.Lean:
+                    # the integration only needs the clipped HU, as rescale_image() leaves it
+                    self.clip_hu(self.Image_HU, self.window())
+                else:
+                    self.Image = self.rescale_image(self.Image_HU, self.window())
             # Initial Image data
             # Do the initial calculation
             # define circular integration result
@@ -34,6 +87,53 @@ class ImageHandler:
             return
         self.isImageComplete = True
 
+    @classmethod
+    def default_parameters(cls, median_window=6, median_factor=3, circle='numpy', integration='ring',
+                           center='slice'):
+        """
+        :param center: 'slice' if the center is detected on each slice, 'series' if on the middle slice of a series
+        :return: the dict of the algorithm version and the parameters which change the profiles,
+        its hash is stored with every row, see AlgorithmVersion
+        :raise ValueError: the median window is shorter than 1, see median_filter()
+        """
+        if median_window < 1:
+            raise ValueError(r"Median window must be at least 1: " + str(median_window))
+        return dict(version=cls.Algorithm_Version, circle=circle, integration=integration, center=center,
+                    median_window=median_window, median_factor=median_factor)
+
+    def algorithm_parameters(self):
+        """
+        :return: default_parameters() of this handler
+        """
+        return self.default_parameters(self.Median_Window, self.Median_Factor, self.Circle, self.Integration)
+
+    def window(self):
+        """
+        :return: (window width, window center) of the DICOM
+        """
+        return self.Dicom.WindowWidth, self.Dicom.WindowCenter
+
+    @staticmethod
+    def hu_image(raw_data, slope, intercept):
+        """
+        :param raw_data: the raw pixel data, it will not be modified
+        :return: the HU image as float32 np array, with no float64 temporary
+        """
+        image_hu = np.empty(raw_data.shape, dtype=np.float32)
+        np.multiply(raw_data, slope, out=image_hu, casting='unsafe')
+        image_hu += intercept
+        return image_hu
+
+    @staticmethod
+    def clip_hu(image_hu, window):
+        """
+        :param image_hu: HU values, clipped in place
+        :param window: a tuple pass in as (window width, window center)
+        """
+        np.minimum(image_hu, window[1] + window[0] / 2, out=image_hu)
+        np.maximum(image_hu, window[1] - window[0] / 2, out=image_hu)
+        return image_hu
+
     @staticmethod
     def rescale_image(raw_data, window):
         """
@@ -60,6 +160,62 @@ class ImageHandler:
         image_rescale = image_rescale * 255 / max_hu_image  # rescale the image to fit 0~255
         return image_rescale
 
+    @staticmethod
+    def edge_scale(raw_data, window):
+        """
+        Get the parameters rescale_image() would use, without touching the image.
+        :param raw_data: a np array as raw image data, it will not be modified
+        :param window: a tuple pass in as (window width, window center)
+        :return: a tuple as (window lower, window upper, shift, peak),
+        the rescaled data is (clip(data, lower, upper) + shift) * 255 / peak
+        """
+        window_upper = window[1] + window[0] / 2
+        window_lower = window[1] - window[0] / 2
+        # min/max of the clipped image equal the clipped min/max of the image
+        min_hu_image = min(max(raw_data.min(), window_lower), window_upper)
+        max_hu_image = min(max(raw_data.max(), window_lower), window_upper)
+        if min_hu_image < 0:
+            return window_lower, window_upper, 0 - min_hu_image, max_hu_image + abs(min_hu_image)
+        return window_lower, window_upper, 0, max_hu_image
+
+    @staticmethod
+    def edge_line(raw_data, index, axis, scale):
+        """
+        Apply the PIL "L" conversion and FIND_EDGES filter to a single line of the image.
+        Only the line and its 2 neighbours are rescaled, so no full frame buffer is allocated.
+        :param raw_data: a np array as raw image data, it will not be modified
+        :param index: the index of the line
+        :param axis: 0 to take the row raw_data[index, :], 1 to take the col raw_data[:, index]
+        :param scale: the rescale parameters returned by edge_scale()
+        :return: a np array as the filtered line, same as np.array(filtered_image)[index, :]
+        """
+        lines = raw_data if axis == 0 else raw_data.T
+        window_lower, window_upper, shift, peak = scale
+        strip = lines[max(index - 1, 0):index + 2]
+        # rescale_image() followed by PIL float to "L" conversion (float32, truncated)
+        strip = (np.clip(strip, window_lower, window_upper) + shift) * 255 / peak
+        strip = np.clip(strip.astype(np.float32), 0, 255).astype(np.int32)
+        center = strip[min(index, 1)]
+        # PIL copies the border pixels, the kernel is 8 * center - 8 neighbours
+        if index == 0 or index == lines.shape[0] - 1:
+            return center
+        box = strip.sum(axis=0)
+        edge = center.copy()
+        edge[1:-1] = np.clip(9 * center[1:-1] - box[:-2] - box[1:-1] - box[2:], 0, 255)
+        return edge
+
+    @staticmethod
+    def first_edge(line):
+        """
+        :param line: a np array as filtered line, starting from distance 1
+        :return: the distance of the 1st edge, or len(line) if there is no edge as the legacy loop does
+        """
+        found = line != 0
+        if found.any():
+            return int(found.argmax()) + 1
+        return len(line)
+
+    @metrics.timed('calc_circle')
     def calc_circle(self, raw_data):
         """
         Calculate the image center and radius
@@ -67,6 +223,110 @@ class ImageHandler:
         from up/down/left/right side to go into center
         the 1st number is > mean value, it's the edge
         calculate the distance from th edge to center
+        Same result as calc_circle_pil(), but the edges are found by array reductions
+        over the center row and center col only.
+        :param raw_data: the image data will be calculated, it will not be modified
+        :return: return 2 tuples which are image center and radius
+        (center row, center col),(radius in pixel, radius in cm)
+        """
+        # set up some local variables
+        is_abnormal = False
+        img_size = (self.Dicom.Rows, self.Dicom.Cols)
+        center_col = img_size[0] // 2
+        center_row = img_size[1] // 2
+        max_allowed_deviation = 20
+        scale = self.edge_scale(raw_data, (100, 0))
+
+        # start to calculate center col
+        filtered_line = self.edge_line(raw_data, center_row, 0, scale)
+        left_distance = self.first_edge(filtered_line[1:])
+        right_distance = self.first_edge(filtered_line[:0:-1])
+        center_col += (left_distance - right_distance) // 2
+        logging.debug(r"Center Col calculated as: " + str(center_col))
+        # if the calculated center col deviated too much
+        if (img_size[0] // 2 + max_allowed_deviation) < center_col < (img_size[0] // 2 - max_allowed_deviation):
+            logging.warning(r"It seems abnormal when calculate Center Col, use image center now!")
+            center_col = img_size[0] // 2
+            is_abnormal = True
+
+        # start to calculate center row
+        filtered_line = self.edge_line(raw_data, center_col, 1, scale)
+        up_distance = self.first_edge(filtered_line[1:])
+        low_distance = self.first_edge(filtered_line[:0:-1])
+        center_row += (up_distance - low_distance) // 2
+        logging.debug(r"Center Row calculated as: " + str(center_row))
+        # if the calculated center row deviated too much
+        if (img_size[1] // 2 + max_allowed_deviation) < center_row < (img_size[1] // 2 - max_allowed_deviation):
+            logging.warning(r"It seems abnormal when calculate Center row, use image center now!")
+            center_row = img_size[1] // 2
+            is_abnormal = True
+
+        radius, diameter_in_cm = self.standardize_radius(img_size, left_distance, right_distance, is_abnormal)
+        return (center_row, center_col), (radius, diameter_in_cm)
+
+    @staticmethod
+    def fit_circle(raw_data, center, radius, threshold=-500, chords=7):
+        """
+        Sub-pixel center estimate by a least-squares (Kasa) circle fit.
+        The boundary points are the threshold crossings, linear interpolated between 2 pixels,
+        on several rows and cols around the center.
+        :param raw_data: the HU image, it will not be modified
+        :param center: the integer center in format (row, col)
+        :param radius: the radius in pixel, used to place the chords inside the phantom
+        :param threshold: HU value of the phantom boundary, half way between air and water by default
+        :param chords: the number of rows and the number of cols to search for boundary
+        :return: 2 values as (center row, center col) in float and radius in pixel,
+        or (None, None) if there are not enough boundary points
+        """
+        offsets = np.round(np.linspace(-radius / 2, radius / 2, chords)).astype(int)
+        point_row = []
+        point_col = []
+        for axis in (0, 1):
+            lines = raw_data if axis == 0 else raw_data.T
+            size = lines.shape[1]
+            index = np.clip(center[axis] + offsets, 0, lines.shape[0] - 1)
+            strip = lines[index]
+            inside = strip > threshold
+            chord = np.arange(len(index))
+            for edge, step in ((inside.argmax(axis=1), -1),
+                               (size - 1 - inside[:, ::-1].argmax(axis=1), 1)):
+                outer = edge + step
+                valid = inside.any(axis=1) & (outer >= 0) & (outer < size)
+                if not valid.any():
+                    continue
+                value_in = strip[chord[valid], edge[valid]]
+                value_out = strip[chord[valid], outer[valid]]
+                position = edge[valid] + step * (value_in - threshold) / (value_in - value_out)
+                if axis == 0:
+                    point_row.append(index[valid])
+                    point_col.append(position)
+                else:
+                    point_row.append(position)
+                    point_col.append(index[valid])
+        if not point_row:
+            return None, None
+        point_row = np.concatenate(point_row).astype(np.float64)
+        point_col = np.concatenate(point_col).astype(np.float64)
+        if len(point_row) < 3:
+            return None, None
+        # x^2 + y^2 = a * x + b * y + c
+        matrix = np.stack((point_row, point_col, np.ones_like(point_row)), axis=1)
+        a, b, c = np.linalg.lstsq(matrix, point_row ** 2 + point_col ** 2, rcond=-1)[0]
+        fit_row = a / 2
+        fit_col = b / 2
+        logging.debug(r"Sub-pixel center calculated as: " + str((fit_row, fit_col)))
+        return (fit_row, fit_col), float(np.sqrt(c + fit_row ** 2 + fit_col ** 2))
+
+    @metrics.timed('calc_circle')
+    def calc_circle_pil(self, raw_data):
+        """
+        Legacy version of calc_circle, which finds the edge by PIL FIND_EDGES filter.
+        Kept for validation of the numpy detector.
+        Calculate the image center and radius
+        the method is simple
+        from up/down/left/right side to go into center
+        the 1st number is > mean value, it's the edge
+        calculate the distance from th edge to center
         :param raw_data: the image data will be calculated besure to pass a copy!
         :return: return 2 tuples which are image center and radius 
         (center row, center col),(radius in pixel, radius in cm)
@@ -116,7 +376,18 @@ class ImageHandler:
             center_row = img_size[1] // 2
             is_abnormal = True
 
-        # set different radius according to normal/abnormal situation
+        radius, diameter_in_cm = self.standardize_radius(img_size, left_distance, right_distance, is_abnormal)
+        return (center_row, center_col), (radius, diameter_in_cm)
+
+    def standardize_radius(self, img_size, left_distance, right_distance, is_abnormal):
+        """
+        Set different radius according to normal/abnormal situation
+        :param img_size: (rows, cols)
+        :param left_distance: distance from left side to the edge
+        :param right_distance: distance from right side to the edge
+        :param is_abnormal: whether the calculated center is abnormal
+        :return: (radius in pixel, radius in cm)
+        """
         if is_abnormal is False:
             radius = (img_size[0] - left_distance - right_distance) // 2
             diameter_in_cm = radius * self.Dicom.PixSpace[0] * 2
@@ -136,7 +407,7 @@ class ImageHandler:
             radius = 50
             diameter_in_cm = radius * self.Dicom.PixSpace[0]
 
-        return (center_row, center_col), (radius, diameter_in_cm)
+        return radius, diameter_in_cm
 
     def bresenham(self, radius):
         x = 0
@@ -167,52 +438,102 @@ class ImageHandler:
             x += 1
 
     def integration(self):
-        for index in range(1, len(self.Image_Integration_Result)):
-            self.bresenham(index)
-            self.Image_Integration_Result[index] /= (index * 2 * 3.14)
+        with metrics.timer('ring_integration'):
+            if self.Integration == 'bresenham':
+                for index in range(1, len(self.Image_Integration_Result)):
+                    self.bresenham(index)
+                    self.Image_Integration_Result[index] /= (index * 2 * 3.14)
+            else:
+                ring = RingIntegrator.get(self.Dicom.Rows, self.Dicom.Cols, tuple(self.Center), self.Radius[0])
+                self.Image_Integration_Result = ring.integrate(
+                    self.Image_HU, chunk_size=self.Lean_Chunk_Size if self.Lean else None)
         # calculate data by using Median
-        factor = 3
-        # the 1st and 2nd data = factor * md3() - md5()
-        self.Image_Median_Filter_Result[0] = np.median(self.Image_Integration_Result[:3]) * factor - np.median(
-            self.Image_Integration_Result[:5])
-        self.Image_Median_Filter_Result[1] = np.median(self.Image_Integration_Result[:3]) * factor - np.median(
-            self.Image_Integration_Result[:5])
-
-        # the last and 2nd last data = factor * md3() - md5()
-        self.Image_Median_Filter_Result[-1] = np.median(self.Image_Integration_Result[-3:]) * factor - np.median(
-            self.Image_Integration_Result[-5:])
-        self.Image_Median_Filter_Result[-2] = np.median(self.Image_Integration_Result[-3:]) * factor - np.median(
-            self.Image_Integration_Result[-5:])
-        for index in range(3, len(self.Image_Integration_Result) - 2):
-            self.Image_Median_Filter_Result[index] = np.median(self.Image_Integration_Result[index - 3:index + 3])
-
-    def save_image(self):
+        with metrics.timer('median_filter'):
+            self.Image_Median_Filter_Result = self.median_filter(self.Image_Integration_Result,
+                                                                 self.Median_Window, self.Median_Factor)
+
+    def polar_profiles(self, angles=360, sectors=12):
+        """
+        Resample the clipped HU image around the center into (radius, angle) once,
+        see PolarTransform, the lookup table is cached per geometry.
+        :param angles: number of angles of the polar grid
+        :param sectors: number of angular sectors, the angles must split evenly into them
+        :return: (full ring profile in length of radius, sector profiles in shape (sectors, radius)),
+        (None, None) if the image is not complete
+        """
+        if not self.isImageComplete:
+            return None, None
+        with metrics.timer('polar_transform'):
+            polar = PolarTransform.get(self.Dicom.Rows, self.Dicom.Cols, tuple(self.Center), self.Radius[0], angles)
+            return polar.profiles(self.Image_HU, sectors)
+
+    @staticmethod
+    def median_filter(profiles, window=6, factor=3):
+        """
+        Sliding median of integration results, all windows of all profiles in one np.median call.
+        The 1st two and last two data = factor * md3() - md5() of the 3 and 5 data at that end,
+        then out[i] = median(x[i - window // 2:i - window // 2 + window]) for max(window // 2, 2) <= i < len - 2
+        where the window fits. Data not covered by either stay 0, with the default window it is out[2].
+        :param profiles: 1D integration result, or 2D array of integration results of the same length
+        :param window: width of the median window
+        :param factor: edge correction factor
+        :return: np array of the same shape
+        :raise ValueError: the window is shorter than 1
+        """
+        if window < 1:
+            raise ValueError(r"Median window must be at least 1: " + str(window))
+        profiles = np.asarray(profiles, dtype=np.float64)
+        data = np.atleast_2d(profiles)
+        result = np.zeros_like(data)
+        length = data.shape[1]
+        if length == 0:
+            return result.reshape(profiles.shape)
+
+        head = np.median(data[:, :3], axis=1) * factor - np.median(data[:, :5], axis=1)
+        tail = np.median(data[:, -3:], axis=1) * factor - np.median(data[:, -5:], axis=1)
+        result[:, :2] = head[:, np.newaxis]
+        result[:, -2:] = tail[:, np.newaxis]
+
+        half = window // 2
+        count = min(length - window + 1, length - 2 - half)
+        # a window shorter than 4 would start before the 2 edge corrected data, they are kept
+        skip = max(2 - half, 0)
+        if count > skip:
+            # read only view of all windows, shape (profiles, count, window)
+            windows = np.lib.stride_tricks.as_strided(
+                data, shape=(data.shape[0], count, window),
+                strides=(data.strides[0], data.strides[1], data.strides[1]), writeable=False)
+            result[:, half + skip:half + count] = np.median(windows[:, skip:], axis=2)
+        return result.reshape(profiles.shape)
+
+    def save_image(self, directory='.'):
+        """
+        Save the image as <ScanMode>.png and the profile plot as <ScanMode>_fig.png
+        :param directory: the output directory
+        """
         if self.isImageComplete:
             # set up the output file name
-            image__filename = self.Dicom.ScanMode + ".jpeg"
-            image__filename__fig = self.Dicom.ScanMode + "_fig.jpeg"
-            im = Image.fromarray(self.Image).convert("L")
-            # save image
+            image__filename = os.path.join(directory, self.Dicom.ScanMode + ".png")
+            image__filename__fig = os.path.join(directory, self.Dicom.ScanMode + "_fig.png")
             try:
                 # save image
-                im.save(self.Dicom.ScanMode + image__filename, "png")
-                # draw fig
-                plt.plot(self.Image_Median_Filter_Result)
-                plt.ylim((-5, 20))
-                plt.xlim((0, 250))
+                self.show_image().save(image__filename, "png")
                 # draw fig image
-                plt.savefig(self.Dicom.ScanMode + image__filename__fig)
+                with open(image__filename__fig, 'wb') as fp:
+                    fp.write(Renderer.render_plot(self.Image_Median_Filter_Result))
             except Exception as e:
                 logging.error(str(e))
                 return
-            finally:
-                plt.close()
         else:  # if self.isShowImgReady == False
             logging.warning(r"File is not complete initialized, skip show image.")
             return
 
     def show_image(self):
-        im = Image.fromarray(self.Image).convert("L")
+        image = self.Image
+        if image is None:
+            # lean mode, Image_HU is already clipped, rescale a copy of it
+            image = self.rescale_image(self.Image_HU.copy(), self.window())
+        im = Image.fromarray(image).convert("L")
         return im
 
     def show_integration_result(self):
@@ -226,6 +547,11 @@ if __name__ == '__main__':
                         format='%(asctime)s %(filename)s[line:%(lineno)d] %(levelname)s %(message)s',
                         datefmt='%a, %d %b %Y %H:%M:%S')
 
-    a = DicomHandler('/Users/qianxin/Downloads/add.dcm')
-    img = ImageHandler(a)
-    print(img.show_image())
+    # python -m app.main.algorithm.ImageHandler
+    import tempfile
+    from .PhantomGenerator import PhantomGenerator
+    with tempfile.TemporaryDirectory() as directory:
+        a = DicomHandler(PhantomGenerator(offset=(3, -5), rings=[(100, 8, 1.5)]).write(directory + '/phantom.dcm'))
+        img = ImageHandler(a)
+        print(img.Center, img.Radius)
+        print(img.show_integration_result())
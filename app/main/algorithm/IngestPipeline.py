@@ -0,0 +1,411 @@
+import hashlib
+import io
+import logging
+import os
+import signal
+from collections import deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from types import SimpleNamespace
+
+from .DicomHanlder import DicomHandler
+from .ImageHandler import ImageHandler
+from .PixelStore import PixelStore
+from .SeriesHandler import SeriesHandler
+from .Metrics import metrics
+
+
+class IngestResult:
+    """
+    The compact result of one DICOM file, which is sent back from the worker process.
+    It holds the header fields, the profiles and the Uid instead of the whole
+    DicomHandler/ImageHandler, so neither the pydicom Dataset nor the pixel data cross the
+    process boundary: the pixel data is written to the PixelStore by the worker.
+    """
+    def __init__(self, filename):
+        self.FileName = filename
+        self.isComplete = False
+        self.Uid = None
+        self.Header = None
+        # Image_Median_Filter_Result and Image_Integration_Result
+        self.Profile = None
+        self.Raw_Profile = None
+        # the PixelStore key of the raw pixel data
+        self.Pixel_Hash = None
+        # the ImageHandler.algorithm_parameters() which made the profiles
+        self.Algorithm = None
+        # sha1 of the file content, and whether it equals the hash the caller already knows
+        self.Content_Hash = None
+        self.isUnchanged = False
+        # log records emitted while processing, replayed by the main process in order
+        self.Log = []
+        # the Metrics recorded by the worker process, merged by the main process
+        self.Metrics = None
+
+
+class _RecordCollector(logging.Handler):
+    """
+    Collect the log records of a worker process instead of writing them,
+    so the main process can replay them in file order.
+    """
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        # make the record picklable
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        record.exc_text = None
+        self.records.append(record)
+
+    def pop(self):
+        records = self.records
+        self.records = []
+        return records
+
+
+_collector = None
+
+
+def _init_worker():
+    """
+    Route the logging of a worker process to the collector, called once per process
+    (ProcessPoolExecutor(initializer=) is not available before python 3.7)
+    """
+    global _collector
+    if _collector is None:
+        _collector = _RecordCollector()
+        logging.getLogger().handlers = [_collector]
+        # Ctrl+C reaches the whole process group, the main process decides how to stop
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def read_content(result, known_hash=None):
+    """
+    Read and hash one file.
+    :param result: the IngestResult to fill with the content hash
+    :param known_hash: the content hash recorded last time
+    :return: the bytes of the file, or None if it can not be read or is unchanged
+    """
+    try:
+        with metrics.timer('file_read'), open(result.FileName, 'rb') as fp:
+            content = fp.read()
+    except OSError as e:
+        logging.error(str(e))
+        return None
+    metrics.count('bytes_read', len(content))
+    result.Content_Hash = hashlib.sha1(content).hexdigest()
+    result.isUnchanged = result.Content_Hash == known_hash
+    return None if result.isUnchanged else content
+
+
+def score_file(filename, known_hash=None, pixel_store=None, lean=False):
+    """
+    Parse and score one DICOM file.
+    The file is read once, hashed, and parsed from memory.
+    :param filename: full path of the DICOM file
+    :param known_hash: the content hash recorded last time, if it is unchanged the file is not parsed
+    :param pixel_store: root directory of the PixelStore to save the raw pixel data, None to not save it
+    :param lean: low memory mode of DicomHandler and ImageHandler
+    :return: an IngestResult
+    """
+    result = IngestResult(filename)
+    content = read_content(result, known_hash)
+    if content is not None:
+        dicom = DicomHandler(filename, io.BytesIO(content), lean=lean)
+        # the parsed pixel data is a copy, the file content is not needed any more
+        del content
+        score_dicom(result, dicom, pixel_store, lean)
+    if _collector is not None:
+        result.Log = _collector.pop()
+    return result
+
+
+def score_content(filename, content, pixel_store=None, lean=False):
+    """
+    Parse and score one DICOM file which is already in memory, e.g. an uploaded one.
+    :param filename: the name of the file in the logs and the result
+    :param content: the bytes of the file
+    :param pixel_store: root directory of the PixelStore, None to not save the pixel data
+    :param lean: low memory mode of DicomHandler and ImageHandler
+    :return: an IngestResult
+    """
+    result = IngestResult(filename)
+    metrics.count('bytes_read', len(content))
+    result.Content_Hash = hashlib.sha1(content).hexdigest()
+    score_dicom(result, DicomHandler(filename, io.BytesIO(content), lean=lean), pixel_store, lean)
+    return result
+
+
+def score_dicom(result, dicom, pixel_store=None, lean=False):
+    """
+    :param result: the IngestResult to fill
+    :param dicom: the DicomHandler of the file
+    :param pixel_store: root directory of the PixelStore, None to not save the pixel data
+    :param lean: low memory mode of ImageHandler
+    """
+    if dicom.isComplete:
+        image = ImageHandler(dicom, lean=lean)
+        if image.isImageComplete:
+            complete_result(result, dicom, image.Image_Median_Filter_Result, image.Image_Integration_Result,
+                            image.algorithm_parameters(), pixel_store)
+
+
+def complete_result(result, dicom, profile, raw_profile, algorithm, pixel_store=None):
+    result.isComplete = True
+    result.Uid = dicom.Uid
+    result.Header = dicom.header()
+    result.Profile = profile
+    result.Raw_Profile = raw_profile
+    result.Algorithm = algorithm
+    if pixel_store is not None:
+        with metrics.timer('pixel_store'):
+            result.Pixel_Hash = PixelStore(pixel_store).put(dicom.RawData)
+
+
+def score_series(tasks, pixel_store=None, refine=False, lean=False):
+    """
+    Parse a chunk of files and score the slices of each series together by SeriesHandler.
+    A series which can not be scored together is scored slice by slice.
+    :param tasks: list of (full path, known hash)
+    :param pixel_store: root directory of the PixelStore
+    :param refine: detect the center of every slice, see SeriesHandler
+    :param lean: low memory mode of DicomHandler and ImageHandler
+    :return: list of IngestResult in the same order
+    """
+    results = []
+    series = OrderedDict()
+    for filename, known_hash in tasks:
+        result = IngestResult(filename)
+        results.append(result)
+        content = read_content(result, known_hash)
+        if content is None:
+            continue
+        dicom = DicomHandler(filename, io.BytesIO(content), lean=lean)
+        del content
+        if dicom.isComplete:
+            key = (str(dicom.SerialNumber), dicom.Series, dicom.Rows, dicom.Cols, tuple(dicom.PixSpace))
+            series.setdefault(key, []).append((result, dicom))
+
+    for members in series.values():
+        handler = SeriesHandler([dicom for _, dicom in members], refine=refine)
+        if handler.isImageComplete:
+            for (result, dicom), profile, raw_profile in zip(members, handler.Image_Median_Filter_Results,
+                                                             handler.Image_Integration_Results):
+                complete_result(result, dicom, profile, raw_profile, handler.algorithm_parameters(), pixel_store)
+        else:
+            for result, dicom in members:
+                score_dicom(result, dicom, pixel_store, lean)
+    # the records can not be told apart by file any more, they are replayed before the chunk
+    if _collector is not None and results:
+        results[0].Log = _collector.pop()
+    return results
+
+
+def score_files(tasks, pixel_store=None, instrument=False, lean=False):
+    """
+    Worker entry: score a chunk of files.
+    :param tasks: list of (full path, known hash)
+    :param pixel_store: root directory of the PixelStore
+    :param instrument: record the Metrics and send them back with the 1st result
+    :param lean: low memory mode, see score_file()
+    :return: list of IngestResult in the same order
+    """
+    _init_worker()
+    metrics.Enabled = instrument
+    return _send_metrics([score_file(f, h, pixel_store, lean) for f, h in tasks])
+
+
+def score_series_files(tasks, pixel_store=None, refine=False, instrument=False, lean=False):
+    """
+    Worker entry of the series mode, see score_series()
+    """
+    _init_worker()
+    metrics.Enabled = instrument
+    return _send_metrics(score_series(tasks, pixel_store, refine, lean))
+
+
+def stored_dicom(task, store):
+    """
+    :param task: dict of the ImageDatabase columns of a row whose pixel data is in the PixelStore
+    :param store: the PixelStore
+    :return: the DicomHandler fields ImageHandler reads, the pixel data is memory-mapped from the store
+    :raise OSError: the pixel data is not in the store
+    """
+    return SimpleNamespace(FileName=task['Uid'], ScanMode=task['Uid'], RawData=store.get(task['Pixel_hash']),
+                           Slop=task['Rescale_slope'], Intercept=task['Rescale_intercept'],
+                           Rows=task['Rows'], Cols=task['Cols'], PixSpace=[task['Pixel_spacing']] * 2,
+                           WindowWidth=task['Window_width'], WindowCenter=task['Window_center'])
+
+
+def score_stored(task, store, parameters):
+    """
+    Score the stored pixel data of one row again, the DICOM file is not read.
+    :param task: see stored_dicom()
+    :param store: the PixelStore
+    :param parameters: the ImageHandler.default_parameters() to score with
+    :return: an IngestResult, its FileName is the Uid
+    """
+    result = IngestResult(task['Uid'])
+    try:
+        with metrics.timer('pixel_store'):
+            dicom = stored_dicom(task, store)
+    except (OSError, ValueError) as e:
+        logging.error(str(e))
+        return result
+    image = ImageHandler(dicom, integration=parameters['integration'], circle=parameters['circle'],
+                         median_window=parameters['median_window'], median_factor=parameters['median_factor'])
+    if image.isImageComplete:
+        result.isComplete = True
+        result.Uid = task['Uid']
+        result.Profile = image.Image_Median_Filter_Result
+        result.Raw_Profile = image.Image_Integration_Result
+        result.Algorithm = image.algorithm_parameters()
+    return result
+
+
+def score_stored_rows(tasks, pixel_store, parameters, instrument=False):
+    """
+    Worker entry of the backfill, see score_stored()
+    :param tasks: list of dicts of ImageDatabase columns
+    :param pixel_store: root directory of the PixelStore
+    :return: list of IngestResult in the same order, the log records are sent with the 1st one
+    """
+    _init_worker()
+    metrics.Enabled = instrument
+    store = PixelStore(pixel_store)
+    results = [score_stored(task, store, parameters) for task in tasks]
+    if results:
+        results[0].Log = _collector.pop()
+    return _send_metrics(results)
+
+
+def _send_metrics(results):
+    if metrics.Enabled and results:
+        results[0].Metrics = metrics.pop()
+    return results
+
+
+class IngestPipeline:
+    """
+    Run the parse-and-score stage of the ingest in a process pool.
+    Results are yielded in the same order as the input files, so the caller can keep
+    all database writes, logs and progress in the main process and deterministic.
+    """
+    def __init__(self, workers=1, chunk_size=8, pixel_store=None, series=False, series_size=32,
+                 refine=False, instrument=False, lean=False):
+        """
+        :param workers: number of worker processes, 1 or less runs in the current process
+        :param chunk_size: number of files sent to a worker at a time
+        :param pixel_store: root directory of the PixelStore the workers save the raw pixel data to
+        :param series: score the slices of a series together by SeriesHandler
+        :param series_size: in series mode, the max number of files of one directory sent to a worker
+        at a time, the slices of a series in the same chunk are scored together
+        :param refine: in series mode, detect the center of every slice
+        :param instrument: the worker processes record Metrics, set it to metrics.Enabled
+        :param lean: low memory mode of DicomHandler and ImageHandler, the profiles only differ
+        by the float32 rounding of the HU values
+        """
+        self.Workers = workers
+        self.Chunk_Size = max(1, chunk_size)
+        self.Pixel_Store = pixel_store
+        self.Series = series
+        self.Series_Size = max(1, series_size)
+        self.Refine = refine
+        self.Instrument = instrument
+        self.Lean = lean
+
+    def chunks(self, tasks):
+        chunk = []
+        for t in tasks:
+            chunk.append(t)
+            if len(chunk) >= self.Chunk_Size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def series_chunks(self, tasks):
+        """
+        Chunks of consecutive files in the same directory, a series is usually one directory.
+        """
+        chunk = []
+        for t in tasks:
+            if chunk and (len(chunk) >= self.Series_Size or
+                          os.path.dirname(t[0]) != os.path.dirname(chunk[0][0])):
+                yield chunk
+                chunk = []
+            chunk.append(t)
+        if chunk:
+            yield chunk
+
+    def run(self, filenames, known_hashes=None):
+        """
+        :param filenames: an iterable of full path, it is consumed lazily
+        :param known_hashes: optional dict of {full path: content hash} recorded by a previous ingest
+        :return: a generator of IngestResult in input order
+        """
+        if known_hashes is None:
+            known_hashes = {}
+        tasks = ((f, known_hashes.get(f)) for f in filenames)
+        if self.Workers <= 1 and self.Series:
+            for chunk in self.series_chunks(tasks):
+                yield from self.replay(score_series(chunk, self.Pixel_Store, self.Refine, self.Lean))
+            return
+        if self.Workers <= 1:
+            for f, h in tasks:
+                yield score_file(f, h, self.Pixel_Store, self.Lean)
+            return
+
+        if self.Series:
+            yield from self.map_chunks(score_series_files, self.series_chunks(tasks), self.Pixel_Store, self.Refine,
+                                       self.Instrument, self.Lean)
+        else:
+            yield from self.map_chunks(score_files, self.chunks(tasks), self.Pixel_Store, self.Instrument, self.Lean)
+
+    def map_chunks(self, function, chunks, *args):
+        """
+        Run function(chunk, *args) on the chunks in a process pool of Workers processes.
+        :param function: a module level function returning a list of IngestResult
+        :param chunks: an iterable of chunks, it is consumed lazily
+        :return: a generator of the replayed IngestResult in input order
+        """
+        # keep a bounded number of chunks in flight, so the input is streamed
+        # and the memory of finished but not yet consumed results is bounded
+        max_pending = self.Workers * 2
+        pending = deque()
+        with ProcessPoolExecutor(max_workers=self.Workers) as executor:
+            try:
+                for chunk in chunks:
+                    pending.append(executor.submit(function, chunk, *args))
+                    if len(pending) >= max_pending:
+                        yield from self.replay(pending.popleft().result())
+                while pending:
+                    yield from self.replay(pending.popleft().result())
+            finally:
+                # the consumer stopped early, do not wait for chunks nobody will read
+                for future in pending:
+                    future.cancel()
+
+    def run_contents(self, contents):
+        """
+        Score files which are already in memory, one at a time in the current process:
+        sending them to the workers would keep several of them in memory at once.
+        The series mode does not apply, every file is scored on its own.
+        :param contents: an iterable of (name, bytes), it is consumed lazily
+        :return: a generator of IngestResult in input order
+        """
+        for filename, content in contents:
+            result = score_content(filename, content, self.Pixel_Store, self.Lean)
+            # do not hold this file while the next one is read
+            del content
+            yield result
+
+    @staticmethod
+    def replay(results):
+        for result in results:
+            for record in result.Log:
+                logging.getLogger(record.name).handle(record)
+            metrics.merge(result.Metrics)
+            yield result
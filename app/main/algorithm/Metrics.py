@@ -0,0 +1,143 @@
+import functools
+import threading
+import time
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+class _Timer:
+    def __init__(self, metrics, stage):
+        self.Metrics = metrics
+        self.Stage = stage
+
+    def __enter__(self):
+        self.Start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.Metrics.add_time(self.Stage, time.perf_counter() - self.Start)
+        return False
+
+
+_null_timer = _NullTimer()
+
+
+class Metrics:
+    """
+    Process wide stage timers and counters of the ingest.
+    Disabled by default, then timer() returns a shared no-op context and count() returns at once,
+    so the instrumented hot paths cost a method call per stage.
+    Worker processes record into their own instance and send pop() back with their results,
+    the main process merge()s it, so /metrics and the ingest summary include the worker stages.
+    """
+    def __init__(self, enabled=False):
+        self.Enabled = enabled
+        self.Lock = threading.Lock()
+        # stage: [calls, seconds]
+        self.Timers = {}
+        self.Counters = {}
+
+    def timer(self, stage):
+        """
+        :param stage: the stage name
+        :return: a context manager timing the block
+        """
+        if not self.Enabled:
+            return _null_timer
+        return _Timer(self, stage)
+
+    def timed(self, stage):
+        """
+        Decorator version of timer()
+        """
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.Enabled:
+                    return function(*args, **kwargs)
+                with _Timer(self, stage):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def add_time(self, stage, seconds, calls=1):
+        with self.Lock:
+            timer = self.Timers.setdefault(stage, [0, 0.0])
+            timer[0] += calls
+            timer[1] += seconds
+
+    def count(self, name, value=1):
+        if not self.Enabled:
+            return
+        with self.Lock:
+            self.Counters[name] = self.Counters.get(name, 0) + value
+
+    def snapshot(self):
+        """
+        :return: a copy as {'timers': {stage: [calls, seconds]}, 'counters': {name: value}}
+        """
+        with self.Lock:
+            return {'timers': {stage: list(timer) for stage, timer in self.Timers.items()},
+                    'counters': dict(self.Counters)}
+
+    def pop(self):
+        """
+        :return: the snapshot, and reset
+        """
+        with self.Lock:
+            snapshot = {'timers': self.Timers, 'counters': self.Counters}
+            self.Timers = {}
+            self.Counters = {}
+        return snapshot
+
+    def merge(self, snapshot):
+        if not snapshot:
+            return
+        with self.Lock:
+            for stage, (calls, seconds) in snapshot['timers'].items():
+                timer = self.Timers.setdefault(stage, [0, 0.0])
+                timer[0] += calls
+                timer[1] += seconds
+            for name, value in snapshot['counters'].items():
+                self.Counters[name] = self.Counters.get(name, 0) + value
+
+    @staticmethod
+    def difference(after, before):
+        """
+        :return: the snapshot of what was recorded between 2 snapshots
+        """
+        timers = {}
+        for stage, (calls, seconds) in after['timers'].items():
+            old = before['timers'].get(stage, [0, 0.0])
+            if calls != old[0]:
+                timers[stage] = [calls - old[0], seconds - old[1]]
+        counters = {name: value - before['counters'].get(name, 0) for name, value in after['counters'].items()
+                    if value != before['counters'].get(name, 0)}
+        return {'timers': timers, 'counters': counters}
+
+    def prometheus(self, prefix='webbat'):
+        """
+        :return: the timers and counters in Prometheus text exposition format
+        """
+        snapshot = self.snapshot()
+        lines = ['# HELP %s_stage_seconds_total Time spent in each ingest stage.' % prefix,
+                 '# TYPE %s_stage_seconds_total counter' % prefix]
+        for stage, (calls, seconds) in sorted(snapshot['timers'].items()):
+            lines.append('%s_stage_seconds_total{stage="%s"} %r' % (prefix, stage, seconds))
+        lines += ['# HELP %s_stage_calls_total Number of times each ingest stage ran.' % prefix,
+                  '# TYPE %s_stage_calls_total counter' % prefix]
+        for stage, (calls, seconds) in sorted(snapshot['timers'].items()):
+            lines.append('%s_stage_calls_total{stage="%s"} %d' % (prefix, stage, calls))
+        for name, value in sorted(snapshot['counters'].items()):
+            lines += ['# TYPE %s_%s_total counter' % (prefix, name),
+                      '%s_%s_total %r' % (prefix, name, value)]
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
@@ -0,0 +1,150 @@
+import os
+import numpy as np
+from dicom.dataset import Dataset, FileDataset
+
+
+class PhantomGenerator:
+    """
+    Write synthetic Band Assessment DICOM files: a water cylinder in air, with optional ring
+    artifacts, gaussian noise and an offset of the phantom from the image center.
+    Every tag DicomHandler reads is written, so the files go through the whole ingest.
+    """
+    CT_Image_Storage = '1.2.840.10008.5.1.4.1.1.2'
+    Uid_Root = '1.2.826.0.1.3680043.9.7537.'
+
+    def __init__(self, size=512, fov=250.0, phantom_diameter=200.0, offset=(0, 0), noise=5.0, rings=(),
+                 serial_number='12345', kvp=120, current=200, kernel='B30f', collimation=19.2,
+                 slice_thickness=1.2, date_time='20170601120000.000000', seed=0):
+        """
+        :param size: rows and cols of the image
+        :param fov: reconstruction diameter in mm, the pixel spacing is fov / size
+        :param phantom_diameter: diameter of the water cylinder in mm
+        :param offset: offset of the phantom center from the image center in pixel as (row, col)
+        :param noise: standard deviation of the gaussian noise in HU
+        :param rings: ring artifacts as a list of (radius in pixel, amplitude in HU, width in pixel)
+        :param serial_number: the device serial number
+        :param kvp: tube voltage
+        :param current: tube current
+        :param kernel: convolution kernel
+        :param collimation: total collimation width in mm
+        :param slice_thickness: slice thickness in mm
+        :param date_time: acquisition date time, series n is n minutes later
+        :param seed: seed of the noise, instance n uses seed + n
+        """
+        self.Size = size
+        self.FOV = fov
+        self.Phantom_Diameter = phantom_diameter
+        self.Offset = offset
+        self.Noise = noise
+        self.Rings = list(rings)
+        self.Serial_Number = serial_number
+        self.KVP = kvp
+        self.Current = current
+        self.Kernel = kernel
+        self.Collimation = collimation
+        self.Slice_Thickness = slice_thickness
+        self.Date_Time = date_time
+        self.Seed = seed
+
+    @property
+    def pixel_spacing(self):
+        return self.FOV / self.Size
+
+    def image_hu(self, instance=1):
+        """
+        :param instance: the instance number, it selects the noise
+        :return: the HU image as float64 np array
+        """
+        rows, cols = np.ogrid[:self.Size, :self.Size]
+        distance = np.hypot(rows - self.Size // 2 - self.Offset[0], cols - self.Size // 2 - self.Offset[1])
+        radius = self.Phantom_Diameter / 2 / self.pixel_spacing
+        image = np.where(distance < radius, 0.0, -1000.0)
+        for ring_radius, amplitude, width in self.Rings:
+            image += amplitude * np.exp(-0.5 * ((distance - ring_radius) / width) ** 2) * (distance < radius)
+        if self.Noise:
+            image += np.random.RandomState(self.Seed + instance).normal(0, self.Noise, image.shape)
+        return image
+
+    def pixel_data(self, instance=1):
+        """
+        :return: the stored values as int16 np array, HU = value - 1024
+        """
+        return np.round(self.image_hu(instance) + 1024).astype(np.int16)
+
+    def date_time(self, series):
+        # series n is acquired n minutes after the 1st one
+        minute = int(self.Date_Time[10:12]) + series - 1
+        hour = int(self.Date_Time[8:10]) + minute // 60
+        return '%s%02d%02d%s' % (self.Date_Time[:8], hour % 24, minute % 60, self.Date_Time[12:])
+
+    def dataset(self, filename, instance=1, series=1):
+        """
+        :param filename: the file name stored in the dataset
+        :param instance: the instance number
+        :param series: the series number
+        :return: a pydicom FileDataset
+        """
+        date_time = self.date_time(series)
+        sop_instance_uid = self.Uid_Root + '%s.%s.%d.%d' % (self.Serial_Number, date_time[:14], series, instance)
+        meta = Dataset()
+        meta.MediaStorageSOPClassUID = self.CT_Image_Storage
+        meta.MediaStorageSOPInstanceUID = sop_instance_uid
+        meta.TransferSyntaxUID = '1.2.840.10008.1.2.1'
+        meta.ImplementationClassUID = self.Uid_Root + '1'
+        ds = FileDataset(filename, {}, file_meta=meta, preamble=b"\0" * 128)
+        ds.is_little_endian = True
+        ds.is_implicit_VR = False
+
+        ds.SOPClassUID = self.CT_Image_Storage
+        ds.SOPInstanceUID = sop_instance_uid
+        ds.StudyInstanceUID = self.Uid_Root + '%s.%s' % (self.Serial_Number, self.Date_Time[:14])
+        ds.SeriesInstanceUID = ds.StudyInstanceUID + '.%d' % series
+        ds.Modality = 'CT'
+        ds.PatientName = 'Phantom'
+        ds.PatientID = 'PHANTOM'
+        # the tags DicomHandler reads
+        ds.DeviceSerialNumber = self.Serial_Number
+        ds.ManufacturerModelName = 'Synthetic'
+        ds.StudyDescription = 'Band Assessment'
+        ds.RescaleSlope = '1'
+        ds.RescaleIntercept = '-1024'
+        ds.Rows = self.Size
+        ds.Columns = self.Size
+        ds.PixelSpacing = ['%.6f' % self.pixel_spacing] * 2
+        ds.InstanceNumber = str(instance)
+        ds.SeriesNumber = str(series)
+        ds.WindowCenter = '0'
+        ds.WindowWidth = '100'
+        ds.ReconstructionDiameter = str(self.FOV)
+        ds.KVP = str(self.KVP)
+        ds.XRayTubeCurrent = str(self.Current)
+        ds.ConvolutionKernel = self.Kernel
+        ds.TotalCollimationWidth = float(self.Collimation)
+        ds.SliceThickness = str(self.Slice_Thickness)
+        ds.AcquisitionDateTime = date_time
+
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.BitsAllocated = 16
+        ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 1
+        ds.PixelData = self.pixel_data(instance).tobytes()
+        ds[0x7fe0, 0x0010].VR = 'OW'
+        return ds
+
+    def write(self, filename, instance=1, series=1):
+        """
+        :return: the file name
+        """
+        self.dataset(filename, instance, series).save_as(filename)
+        return filename
+
+    def write_series(self, directory, count, series=1):
+        """
+        Write the instances 1 ~ count of a series into directory.
+        :return: list of the file names
+        """
+        os.makedirs(directory, exist_ok=True)
+        return [self.write(os.path.join(directory, 'IM%05d.dcm' % instance), instance, series)
+                for instance in range(1, count + 1)]
@@ -0,0 +1,62 @@
+import hashlib
+import os
+import tempfile
+import numpy as np
+
+
+class PixelStore:
+    """
+    Content-addressed store of pixel arrays as .npy files.
+    The key is the sha1 of dtype, shape and data, the file is <root>/<key[:2]>/<key[2:]>.npy,
+    so the same pixel data is stored once and a file never changes after it is written.
+    Files are written atomically, different processes can put into the same store.
+    """
+    def __init__(self, root):
+        """
+        :param root: the root directory of the store, created when the 1st array is put
+        """
+        self.Root = root
+
+    @staticmethod
+    def key(array):
+        array = np.ascontiguousarray(array)
+        digest = hashlib.sha1()
+        digest.update((array.dtype.str + str(array.shape)).encode())
+        digest.update(array.data)
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.Root, key[:2], key[2:] + '.npy')
+
+    def exists(self, key):
+        return os.path.isfile(self.path(key))
+
+    def put(self, array):
+        """
+        :param array: np array
+        :return: the key of the array
+        """
+        key = self.key(array)
+        path = self.path(key)
+        if os.path.isfile(path):
+            return key
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                np.save(fp, np.ascontiguousarray(array), allow_pickle=False)
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        return key
+
+    def get(self, key, mmap=True):
+        """
+        :param key: the key returned by put()
+        :param mmap: True to memory-map the file read only instead of reading it
+        :return: np array
+        """
+        return np.load(self.path(key), mmap_mode='r' if mmap else None, allow_pickle=False)
@@ -0,0 +1,137 @@
+import functools
+import numpy as np
+
+
+class PolarTransform:
+    """
+    Resample the HU image around the phantom center into a (radius, angle) grid by bilinear interpolation.
+    The 4 neighbour pixels and weights of every grid point are precomputed once per geometry as a flat index
+    lookup table, so a remap is a single gather and a weighted sum, for one slice or a batch of slices.
+    A full ring profile is the mean over all angles, a sector profile the mean over the angles of one sector,
+    both come from the same remap: a band artifact of a few detector channels shows up in its sector
+    instead of being averaged over the full circle.
+    Angle 0 points to +col, the angle grows counterclockwise as the image is displayed.
+    """
+    def __init__(self, rows, cols, center, radius, angles=360):
+        """
+        :param rows: image rows
+        :param cols: image cols
+        :param center: image center in format (row, col), sub-pixel values work too
+        :param radius: radius in pixel, the grid has radius 0 ~ radius-1
+        :param angles: number of angles of the grid
+        :raise IndexError: the grid exceeds the image border
+        """
+        self.Rows = rows
+        self.Cols = cols
+        self.Center = center
+        self.Radius = radius
+        self.Angles = angles
+
+        offset_row, offset_col = self.polar_offsets(radius, angles)
+        row_index, row_weight = self.neighbours(offset_row + center[0], rows)
+        col_index, col_weight = self.neighbours(offset_col + center[1], cols)
+        # shape (4, radius * angles): the top left, top right, bottom left and bottom right neighbours
+        self.Flat_Index = np.stack([(row_index + dr) * cols + col_index + dc for dr in (0, 1) for dc in (0, 1)])
+        self.Weight = np.stack([(1 - row_weight if dr == 0 else row_weight) *
+                                (1 - col_weight if dc == 0 else col_weight) for dr in (0, 1) for dc in (0, 1)])
+
+    @staticmethod
+    @functools.lru_cache(maxsize=8)
+    def polar_offsets(radius, angles):
+        """
+        The offsets do not depend on the center, they are cached per radius and angles.
+        :return: 2 read only np arrays of (radius * angles) as (row offset, col offset), radius major
+        """
+        radii = np.arange(radius, dtype=np.float64)[:, np.newaxis]
+        theta = np.arange(angles) * (2 * np.pi / angles)
+        offsets = ((-radii * np.sin(theta)).ravel(), (radii * np.cos(theta)).ravel())
+        for array in offsets:
+            array.setflags(write=False)
+        return offsets
+
+    @staticmethod
+    def neighbours(position, size):
+        """
+        :param position: np array of sub-pixel positions along an axis
+        :param size: the size of the axis
+        :return: (index of the lower neighbour, weight of the upper one), the upper neighbour is index + 1
+        :raise IndexError: a position is out of the axis
+        """
+        # the rounding of sin and cos may put a point on the border a hair outside
+        position = np.round(position, 9)
+        if position.size and (position.min() < 0 or position.max() > size - 1):
+            raise IndexError(r"Polar grid exceeds image border, image size: " + str(size))
+        index = np.minimum(np.floor(position).astype(np.intp), max(size - 2, 0))
+        return index, position - index
+
+    @classmethod
+    @functools.lru_cache(maxsize=32)
+    def get(cls, rows, cols, center, radius, angles=360):
+        """
+        Get the cached lookup table, slices sharing a geometry reuse it.
+        :param center: image center in format (row, col), must be a tuple
+        :return: a PolarTransform instance
+        """
+        return cls(rows, cols, center, radius, angles)
+
+    def gather(self, volume):
+        """
+        :param volume: 3D np array in shape (slices, Rows, Cols), of any dtype
+        :return: np array in shape (slices, 4, radius * angles), the neighbour pixels of the grid points
+        """
+        flat = volume.reshape(volume.shape[0], -1)
+        return flat.take(self.Flat_Index.ravel(), axis=1).reshape((volume.shape[0],) + self.Flat_Index.shape)
+
+    def interpolate(self, values):
+        """
+        :param values: the gathered HU values in shape (slices, 4, radius * angles)
+        :return: np array in shape (slices, radius, angles), the polar images
+        """
+        result = np.einsum('ijk,jk->ik', values, self.Weight)
+        return result.reshape(values.shape[0], self.Radius, self.Angles)
+
+    def remap(self, image_hu):
+        """
+        :param image_hu: the HU image as 2D np array in shape (Rows, Cols)
+        :return: np array in shape (radius, angles)
+        """
+        return self.remap_batch(image_hu[np.newaxis])[0]
+
+    def remap_batch(self, volume_hu):
+        """
+        :param volume_hu: the HU volume as 3D np array in shape (slices, Rows, Cols)
+        :return: np array in shape (slices, radius, angles), row k is remap(volume_hu[k])
+        """
+        return self.interpolate(self.gather(volume_hu))
+
+    @staticmethod
+    def ring_profiles(polar):
+        """
+        :param polar: polar images in shape (..., radius, angles)
+        :return: np array in shape (..., radius), the mean of every full ring
+        """
+        return polar.mean(axis=-1)
+
+    @staticmethod
+    def sector_profiles(polar, sectors):
+        """
+        :param polar: polar images in shape (..., radius, angles)
+        :param sectors: number of sectors, the angles must split evenly into them
+        :return: np array in shape (..., sectors, radius), sector k covers the angles of
+        [k * 360 / sectors, (k + 1) * 360 / sectors) degrees
+        """
+        angles = polar.shape[-1]
+        if sectors < 1 or angles % sectors:
+            raise ValueError(r"Angles can not be split into sectors: " + str((angles, sectors)))
+        result = polar.reshape(polar.shape[:-1] + (sectors, angles // sectors)).mean(axis=-1)
+        return np.swapaxes(result, -1, -2)
+
+    def profiles(self, volume_hu, sectors=12):
+        """
+        Full ring and sector profiles of one remap.
+        :param volume_hu: the HU image in shape (Rows, Cols) or volume in shape (slices, Rows, Cols)
+        :param sectors: number of sectors
+        :return: (ring profiles in shape (..., radius), sector profiles in shape (..., sectors, radius))
+        """
+        polar = self.remap(volume_hu) if volume_hu.ndim == 2 else self.remap_batch(volume_hu)
+        return self.ring_profiles(polar), self.sector_profiles(polar, sectors)
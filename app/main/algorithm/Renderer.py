@@ -0,0 +1,150 @@
+import hashlib
+import io
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+from PIL import Image
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+
+class Renderer:
+    """
+    Render slice previews and profile plots to PNG bytes, with an LRU cache in memory and on disk.
+    Only the object oriented matplotlib API with its own Agg canvas is used, there is no global
+    pyplot state, so different threads can render at the same time.
+    A cached PNG is found by a key made of everything the rendering depends on, so it never has to be
+    invalidated: a new window, size or profile is a new key.
+    """
+    # part of every key, increase it when the rendering changes
+    Version = 1
+
+    def __init__(self, cache_dir=None, memory_items=256):
+        """
+        :param cache_dir: directory of the disk cache, None to cache in memory only
+        :param memory_items: number of PNGs kept in memory
+        """
+        self.Cache_Dir = cache_dir
+        self.Memory_Items = memory_items
+        self.Memory = OrderedDict()
+        self.Lock = threading.Lock()
+        self.Hits = 0
+        self.Misses = 0
+
+    @classmethod
+    def key(cls, *parts):
+        """
+        :param parts: the values the rendering depends on
+        :return: the cache key, also good as an ETag
+        """
+        return hashlib.sha1(repr((cls.Version,) + parts).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.Cache_Dir, key[:2], key[2:] + '.png')
+
+    def get(self, key, render):
+        """
+        :param key: the cache key
+        :param render: a callable returning the PNG bytes, called on a cache miss
+        :return: (PNG bytes, time the PNG was rendered as a timestamp)
+        """
+        with self.Lock:
+            if key in self.Memory:
+                self.Memory.move_to_end(key)
+                self.Hits += 1
+                return self.Memory[key]
+        entry = self.load(key)
+        if entry is None:
+            self.Misses += 1
+            data = render()
+            entry = data, self.save(key, data)
+        else:
+            self.Hits += 1
+        with self.Lock:
+            self.Memory[key] = entry
+            self.Memory.move_to_end(key)
+            while len(self.Memory) > self.Memory_Items:
+                self.Memory.popitem(last=False)
+        return entry
+
+    def load(self, key):
+        if self.Cache_Dir is None:
+            return None
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as fp:
+                return fp.read(), os.path.getmtime(path)
+        except OSError:
+            return None
+
+    def save(self, key, data):
+        """
+        Write the PNG to the disk cache atomically.
+        :return: the modification time of the cached file
+        """
+        if self.Cache_Dir is None:
+            return time.time()
+        path = self.path(key)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(data)
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        return os.path.getmtime(path)
+
+    @staticmethod
+    def window_image(image_hu, window):
+        """
+        :param image_hu: the HU image, it will not be modified
+        :param window: a tuple pass in as (window width, window center)
+        :return: uint8 np array, the window mapped to 0~255
+        """
+        width = max(float(window[0]), 1)
+        window_lower = window[1] - width / 2
+        image = (np.clip(image_hu, window_lower, window_lower + width) - window_lower) * 255 / width
+        return image.astype(np.uint8)
+
+    @classmethod
+    def render_preview(cls, image_hu, window, size=None):
+        """
+        :param image_hu: the HU image
+        :param window: a tuple pass in as (window width, window center)
+        :param size: the max width and height in pixel, None to keep the image size
+        :return: PNG bytes
+        """
+        image = Image.fromarray(cls.window_image(image_hu, window), 'L')
+        if size is not None:
+            image.thumbnail((size, size), Image.BILINEAR)
+        output = io.BytesIO()
+        image.save(output, 'png')
+        return output.getvalue()
+
+    @staticmethod
+    def render_plot(profile, size=None, ylim=(-5, 20), xlim=(0, 250)):
+        """
+        :param profile: the Image_Median_Filter_Result
+        :param size: the width in pixel, None for 640
+        :param ylim: the y range, same as the legacy plot
+        :param xlim: the x range, same as the legacy plot
+        :return: PNG bytes
+        """
+        dpi = 80
+        width = (size or 640) / dpi
+        figure = Figure(figsize=(width, width * 0.75), dpi=dpi)
+        FigureCanvasAgg(figure)
+        axes = figure.add_subplot(111)
+        axes.plot(profile)
+        axes.set_ylim(ylim)
+        axes.set_xlim(xlim)
+        output = io.BytesIO()
+        figure.savefig(output, format='png')
+        return output.getvalue()
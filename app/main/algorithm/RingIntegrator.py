@@ -0,0 +1,137 @@
+import functools
+import numpy as np
+
+
+class RingIntegrator:
+    """
+    Vectorized replacement of ImageHandler.bresenham().
+    The pixels visited by the bresenham circle of every radius are precomputed once
+    as a flat index map plus a ring label per index, so the integration of all radius
+    is a single gather and a single np.bincount.
+    The pixels are visited in exactly the same order as the bresenham loop does and
+    np.bincount sums sequentially, so the result matches the legacy integration
+    within 1e-9 HU (in practice it is bit identical).
+    """
+    def __init__(self, rows, cols, center, radius):
+        """
+        :param rows: image rows
+        :param cols: image cols
+        :param center: image center in format (row, col)
+        :param radius: radius in pixel, rings 1 ~ radius-1 will be integrated
+        """
+        self.Rows = rows
+        self.Cols = cols
+        self.Center = center
+        self.Radius = radius
+
+        offset_row, offset_col, ring_label = self.bresenham_offsets(radius)
+        pix_row = self.wrap_index(offset_row + center[0], rows)
+        pix_col = self.wrap_index(offset_col + center[1], cols)
+        self.Flat_Index = pix_row * cols + pix_col
+        self.Ring_Label = ring_label
+        # the circumference used by the legacy code to normalize each ring
+        self.Circumference = np.arange(radius) * 2 * 3.14
+        self.Circumference[0] = 1
+
+    @staticmethod
+    @functools.lru_cache(maxsize=8)
+    def bresenham_offsets(radius):
+        """
+        Walk the bresenham circle of every radius in range(1, radius) once.
+        The offsets do not depend on the center, they are cached per radius,
+        so a new center only costs a shift of the offsets.
+        :param radius: radius in pixel
+        :return: 3 read only np arrays as (row offset, col offset, ring label), in visiting order
+        """
+        offset_row = []
+        offset_col = []
+        ring_label = []
+        for r in range(1, radius):
+            x = 0
+            y = r
+            d = 3 - 2 * r
+            while x < y:
+                # keep the same order as ImageHandler.bresenham()
+                offset_row.extend((-y, y, -y, y, -x, -x, x, x))
+                offset_col.extend((x, x, -x, -x, y, -y, y, -y))
+                ring_label.extend((r,) * 8)
+                if d < 0:
+                    d = d + 4 * x + 6
+                else:
+                    d = d + 4 * (x - y) + 10
+                    y -= 1
+                x += 1
+        offsets = (np.array(offset_row, dtype=np.intp),
+                   np.array(offset_col, dtype=np.intp),
+                   np.array(ring_label, dtype=np.intp))
+        for array in offsets:
+            array.setflags(write=False)
+        return offsets
+
+    @staticmethod
+    def wrap_index(index, size):
+        """
+        Mimic numpy indexing: negative index wraps around, out of range index raises IndexError
+        :param index: np array of index
+        :param size: the size of the indexed axis
+        :return: np array of non-negative index
+        """
+        if index.size and (index.max() >= size or index.min() < -size):
+            raise IndexError(r"Ring exceeds image border, image size: " + str(size))
+        return np.where(index < 0, index + size, index)
+
+    @classmethod
+    @functools.lru_cache(maxsize=32)
+    def get(cls, rows, cols, center, radius):
+        """
+        Get the cached ring geometry, slices sharing a geometry reuse it.
+        :param rows: image rows
+        :param cols: image cols
+        :param center: image center in format (row, col), must be a tuple
+        :param radius: radius in pixel
+        :return: a RingIntegrator instance
+        """
+        return cls(rows, cols, center, radius)
+
+    def integrate(self, image_hu, chunk_size=None):
+        """
+        Integrate all rings in one pass.
+        :param image_hu: the HU image as 2D np array in shape (Rows, Cols)
+        :param chunk_size: gather and sum this many ring pixels at a time, so the temporary buffers
+        stay small, None to do all at once. The sums may differ in the last bits by the summation order.
+        :return: np array in length of radius, same as ImageHandler.Image_Integration_Result
+        """
+        flat = image_hu.reshape(-1)
+        if chunk_size is None or chunk_size >= len(self.Flat_Index):
+            result = np.bincount(self.Ring_Label, weights=flat[self.Flat_Index], minlength=self.Radius)
+            return result / self.Circumference
+        result = np.zeros(self.Radius)
+        for start in range(0, len(self.Flat_Index), chunk_size):
+            stop = start + chunk_size
+            result += np.bincount(self.Ring_Label[start:stop], weights=flat[self.Flat_Index[start:stop]],
+                                  minlength=self.Radius)
+        return result / self.Circumference
+
+    def gather(self, volume):
+        """
+        :param volume: 3D np array in shape (slices, Rows, Cols), of any dtype
+        :return: np array in shape (slices, number of ring pixels), the pixels in visiting order
+        """
+        return volume.reshape(volume.shape[0], -1).take(self.Flat_Index, axis=1)
+
+    def sum_rings(self, values):
+        """
+        :param values: the gathered HU values in shape (slices, number of ring pixels)
+        :return: np array in shape (slices, radius), row k is the integration of slice k
+        """
+        # one np.bincount per slice is faster than one over shifted labels, and sums in the same order
+        result = np.stack([np.bincount(self.Ring_Label, weights=v, minlength=self.Radius) for v in values])
+        return result / self.Circumference
+
+    def integrate_batch(self, volume_hu):
+        """
+        Integrate all rings of many slices sharing this geometry.
+        :param volume_hu: the HU volume as 3D np array in shape (slices, Rows, Cols)
+        :return: np array in shape (slices, radius), row k is integrate(volume_hu[k])
+        """
+        return self.sum_rings(self.gather(volume_hu))
@@ -0,0 +1,143 @@
+import logging
+from collections import OrderedDict
+import numpy as np
+
+from .ImageHandler import ImageHandler
+from .RingIntegrator import RingIntegrator
+from .PolarTransform import PolarTransform
+from .Metrics import metrics
+
+
+class SeriesHandler(ImageHandler):
+    """
+    Score all slices of one series together.
+    The raw slices are stacked into one volume, the center is detected once on the middle slice
+    (or on every slice with refine), and for all slices sharing a center the ring pixels are
+    gathered at once, converted to HU and clipped to the window as ImageHandler does, integrated
+    and median filtered in one median_filter() call. Only the ring pixels are converted, no
+    full HU volume or display image is made, use ImageHandler to show a single slice.
+    With refine every slice gets the same profiles ImageHandler would give it.
+    """
+    def __init__(self, dicoms, refine=False, median_window=6, median_factor=3):
+        """
+        :param dicoms: list of complete DicomHandler of one series, sharing Rows, Cols and PixSpace
+        :param refine: detect the center of every slice instead of the middle slice only
+        :param median_window: width of the median window, see median_filter()
+        :param median_factor: edge correction factor, see median_filter()
+        """
+        self.isImageComplete = False
+        self.Dicoms = list(dicoms)
+        # the reference slice, its geometry is used by calc_circle()
+        self.Dicom = self.Dicoms[len(self.Dicoms) // 2]
+        self.Refine = refine
+        self.Median_Window = median_window
+        self.Median_Factor = median_factor
+        self.Centers = []
+        self.Radius = []
+        self.Image_Integration_Results = []
+        self.Image_Median_Filter_Results = []
+
+        try:
+            for dcm in self.Dicoms:
+                if (dcm.Rows, dcm.Cols, list(dcm.PixSpace)) != \
+                        (self.Dicom.Rows, self.Dicom.Cols, list(self.Dicom.PixSpace)):
+                    raise ValueError(r"Slices of a series have different geometry: " + dcm.FileName)
+            self.Volume = np.stack([dcm.RawData for dcm in self.Dicoms])
+            # center is always in format (row, col)
+            if self.Refine:
+                circles = [self.calc_circle(self.image_hu(index)) for index in range(len(self.Dicoms))]
+            else:
+                circles = [self.calc_circle(self.image_hu(len(self.Dicoms) // 2))] * len(self.Dicoms)
+            self.Centers = [center for center, _ in circles]
+            self.Radius = [radius for _, radius in circles]
+            self.integration()
+        except Exception as e:
+            logging.error(str(e))
+            return
+        self.isImageComplete = True
+
+    def algorithm_parameters(self):
+        return self.default_parameters(self.Median_Window, self.Median_Factor,
+                                       center='slice' if self.Refine else 'series')
+
+    def image_hu(self, index):
+        """
+        :param index: index of the slice
+        :return: the HU image of the slice, same as ImageHandler.Image_HU
+        """
+        dcm = self.Dicoms[index]
+        return self.Volume[index] * dcm.Slop + dcm.Intercept
+
+    def rescale_values(self, values, indexes):
+        """
+        Convert the gathered raw values to HU and clip them to the window,
+        ImageHandler integrates the HU image after rescale_image() has clipped it.
+        Each row is converted in place by the same float operations ImageHandler uses.
+        :param values: the raw values in shape (slices, number of pixels)
+        :param indexes: index of the slices of the rows of values
+        :return: the HU values as float64 np array
+        """
+        result = np.empty(values.shape)
+        for row, index in enumerate(indexes):
+            dcm = self.Dicoms[index]
+            np.multiply(values[row], dcm.Slop, out=result[row])
+            result[row] += dcm.Intercept
+            self.clip_hu(result[row], (dcm.WindowWidth, dcm.WindowCenter))
+        return result
+
+    def integration(self):
+        # slices sharing center and radius share one ring geometry
+        groups = OrderedDict()
+        for index, (center, radius) in enumerate(zip(self.Centers, self.Radius)):
+            groups.setdefault((tuple(center), radius[0]), []).append(index)
+        self.Image_Integration_Results = [None] * len(self.Dicoms)
+        self.Image_Median_Filter_Results = [None] * len(self.Dicoms)
+        for (center, radius), indexes in groups.items():
+            ring = RingIntegrator.get(self.Dicom.Rows, self.Dicom.Cols, center, radius)
+            with metrics.timer('ring_integration'):
+                values = self.rescale_values(ring.gather(self.Volume[indexes]), indexes)
+                integration_results = ring.sum_rings(values)
+            with metrics.timer('median_filter'):
+                median_filter_results = self.median_filter(integration_results, self.Median_Window,
+                                                           self.Median_Factor)
+            for index, integration_result, median_filter_result in zip(indexes, integration_results,
+                                                                        median_filter_results):
+                self.Image_Integration_Results[index] = integration_result
+                self.Image_Median_Filter_Results[index] = median_filter_result
+        logging.debug(r"Series scored in rings groups: " + str(len(groups)))
+
+    def polar_profiles(self, angles=360, sectors=12):
+        """
+        ImageHandler.polar_profiles() of every slice, the slices sharing a center are remapped in one batch,
+        the neighbour pixels are converted to HU and clipped as rescale_values() does before interpolation.
+        :return: (list of full ring profiles, list of sector profiles in shape (sectors, radius)),
+        one per slice, (None, None) if the series is not complete
+        """
+        if not self.isImageComplete:
+            return None, None
+        groups = OrderedDict()
+        for index, (center, radius) in enumerate(zip(self.Centers, self.Radius)):
+            groups.setdefault((tuple(center), radius[0]), []).append(index)
+        ring_profiles = [None] * len(self.Dicoms)
+        sector_profiles = [None] * len(self.Dicoms)
+        for (center, radius), indexes in groups.items():
+            transform = PolarTransform.get(self.Dicom.Rows, self.Dicom.Cols, center, radius, angles)
+            with metrics.timer('polar_transform'):
+                values = transform.gather(self.Volume[indexes])
+                values = self.rescale_values(values.reshape(len(indexes), -1), indexes).reshape(values.shape)
+                polar = transform.interpolate(values)
+                ring_results = transform.ring_profiles(polar)
+                sector_results = transform.sector_profiles(polar, sectors)
+            for index, ring, sector in zip(indexes, ring_results, sector_results):
+                ring_profiles[index] = ring
+                sector_profiles[index] = sector
+        return ring_profiles, sector_profiles
+
+    def save_image(self):
+        logging.warning(r"A series has no display image, use ImageHandler to save a slice.")
+
+    def show_image(self):
+        logging.warning(r"A series has no display image, use ImageHandler to show a slice.")
+
+    def show_integration_result(self):
+        return self.Image_Median_Filter_Results
@@ -0,0 +1,483 @@
+import io
+import logging
+import os
+import time
+from collections import OrderedDict
+from flask import current_app
+from sqlalchemy import event
+
+from .. import db
+from ..drift import make_detector
+from ..models import ImageDatabase, FileManifest, FilterChoice, Baseline, AlgorithmVersion
+from .algorithm.DirectoryHandler import DirectoryHandler
+from .algorithm.IngestPipeline import IngestPipeline
+from .algorithm.Metrics import metrics
+
+
+class ManifestIndex:
+    """
+    The FileManifest rows under one directory, loaded once per ingest.
+    A file whose size and mtime are unchanged is skipped before it is opened,
+    a file with the same size but a new mtime is hashed and skipped if the content is unchanged.
+    """
+    def __init__(self, directory, writer, paths=None, chunk_size=500):
+        """
+        :param directory: the absolute directory to ingest, None for nothing
+        :param writer: the BatchWriter the manifest rows are written with
+        :param paths: only load the rows of these files of the directory, None for the whole directory
+        :param chunk_size: number of paths looked up in one query
+        """
+        self.Writer = writer
+        self.Entries = {}
+        self.Known_Hash = {}
+        self.Stat = {}
+        self.Skipped = 0
+        if directory is None:
+            return
+        columns = (FileManifest.Path, FileManifest.Size, FileManifest.Mtime_ns, FileManifest.Content_hash,
+                   FileManifest.Uid)
+        if paths is None:
+            queries = [db.session.query(*columns).filter(FileManifest.Path.startswith(os.path.join(directory, '')))]
+        else:
+            paths = list(paths)
+            queries = [db.session.query(*columns).filter(FileManifest.Path.in_(paths[i:i + chunk_size]))
+                       for i in range(0, len(paths), chunk_size)]
+        for query in queries:
+            for path, size, mtime_ns, content_hash, uid in query:
+                self.Entries[path] = (size, mtime_ns, content_hash, uid)
+
+    def is_unchanged(self, path, stat):
+        """
+        DirectoryHandler.iter_files() skip callback
+        """
+        entry = self.Entries.get(path)
+        if entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            self.Skipped += 1
+            return True
+        self.Stat[path] = stat
+        if entry is not None and entry[0] == stat.st_size and entry[2] is not None:
+            self.Known_Hash[path] = entry[2]
+        return False
+
+    def reject(self, path, stat):
+        """
+        DirectoryHandler.iter_files() reject callback, remember the file is not a target file
+        """
+        self.Stat[path] = stat
+        self.record(path, None, None)
+
+    def uid(self, path):
+        entry = self.Entries.get(path)
+        return entry[3] if entry is not None else None
+
+    def record(self, path, content_hash, uid):
+        """
+        Add or update the manifest row of the file with the next batch.
+        """
+        stat = self.Stat.pop(path, None)
+        if stat is None:
+            # not a file of the directory, e.g. an uploaded one
+            return
+        self.Writer.add_manifest(dict(Path=path, Size=stat.st_size, Mtime_ns=stat.st_mtime_ns,
+                                      Content_hash=content_hash, Uid=uid))
+        self.Entries[path] = (stat.st_size, stat.st_mtime_ns, content_hash, uid)
+        self.Known_Hash.pop(path, None)
+
+
+class BatchWriter:
+    """
+    Accumulate ImageDatabase and FileManifest rows and write them in chunks by bulk inserts.
+    A Uid which is already in the table is ignored by the insert itself (INSERT OR IGNORE on SQLite,
+    ON CONFLICT DO NOTHING on PostgreSQL), the manifest rows are upserted.
+    The FilterChoice counts of the new images are added in the same transaction, and so are the new images
+    to their Baseline, after they are scored against it, and their new parameter sets to AlgorithmVersion.
+    """
+    def __init__(self, batch_size=500, sqlite_pragmas=(), drift_detector=None):
+        """
+        :param batch_size: number of rows written in one transaction
+        :param sqlite_pragmas: PRAGMA statements for bulk loading, applied to every SQLite connection
+        :param drift_detector: the DriftDetector to score the new images, None to not update the baselines
+        """
+        self.Batch_Size = max(1, batch_size)
+        self.Images = []
+        self.Manifest = []
+        # {Parameter_hash: parameters} of the pending images, and the hashes known to be in AlgorithmVersion
+        self.Algorithms = {}
+        self.Known_Algorithms = set()
+        self.Drift_Detector = drift_detector
+        # called with (uid, is_duplicated) for each image row once its batch is written
+        self.on_written = None
+        # called with (uid, score) for each new image scored over the drift threshold, once its batch is written
+        self.on_drifted = None
+        self.Flush_Count = 0
+        self.configure_sqlite(db.engine, sqlite_pragmas)
+
+    @staticmethod
+    def configure_sqlite(engine, pragmas):
+        if engine.dialect.name != 'sqlite' or not pragmas:
+            return
+
+        def set_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for pragma in pragmas:
+                cursor.execute('PRAGMA ' + pragma)
+            cursor.close()
+
+        # the sqlite engine uses NullPool, so the pragmas must be set on every new connection
+        if getattr(engine, '_webbat_pragmas', None) != tuple(pragmas):
+            event.listen(engine, 'connect', set_pragmas)
+            engine._webbat_pragmas = tuple(pragmas)
+
+    def add_image(self, row, algorithm=None):
+        """
+        :param row: a dict of ImageDatabase.make_row()
+        :param algorithm: the parameters of its Parameter_hash, to register them with the batch
+        """
+        if algorithm is not None and row['Parameter_hash'] not in self.Known_Algorithms:
+            self.Algorithms[row['Parameter_hash']] = algorithm
+        self.Images.append(row)
+        if len(self.Images) >= self.Batch_Size:
+            self.flush()
+
+    def add_manifest(self, row):
+        self.Manifest.append(row)
+        if len(self.Manifest) >= self.Batch_Size:
+            self.flush()
+
+    @staticmethod
+    def insert(table, replace=False):
+        """
+        :param table: the sqlalchemy Table
+        :param replace: True to replace the existing row, False to keep it
+        :return: an insert statement which does not fail on a duplicated primary key, a plain insert on the
+        dialects without one, see has_upsert()
+        """
+        dialect = db.engine.dialect.name
+        if dialect == 'sqlite':
+            return table.insert().prefix_with('OR REPLACE' if replace else 'OR IGNORE')
+        if dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+            statement = insert(table)
+            if replace:
+                primary_key = [c.name for c in table.primary_key]
+                return statement.on_conflict_do_update(
+                    index_elements=primary_key,
+                    set_={c.name: statement.excluded[c.name] for c in table.columns if c.name not in primary_key})
+            return statement.on_conflict_do_nothing()
+        return table.insert()
+
+    @staticmethod
+    def has_upsert():
+        """
+        :return: True if insert() skips or replaces the existing rows, otherwise flush() leaves out
+        the existing images and deletes the replaced manifest rows before the insert
+        """
+        return db.engine.dialect.name in ('sqlite', 'postgresql')
+
+    @staticmethod
+    def delete_existing(table, rows):
+        """
+        Delete the rows of the same primary key, in the current transaction, before a plain insert of rows.
+        :param table: the sqlalchemy Table, with a one column primary key
+        :param rows: dicts of column values, the last one of a primary key is kept
+        :return: the rows without the duplicated primary keys
+        """
+        column, = table.primary_key.columns
+        rows = list(OrderedDict((row[column.name], row) for row in rows).values())
+        db.session.execute(table.delete().where(column.in_([row[column.name] for row in rows])))
+        return rows
+
+    @metrics.timed('db_flush')
+    def flush(self):
+        """
+        Write all pending rows in one transaction.
+        """
+        if not self.Images and not self.Manifest:
+            return
+        images = self.Images
+        manifest = self.Manifest
+        algorithms = self.Algorithms
+        self.Images = []
+        self.Manifest = []
+        self.Algorithms = {}
+        # tell the duplicates in advance for the log, and for the dialects whose insert does not ignore them
+        uids = [row['Uid'] for row in images]
+        existed = set()
+        if uids:
+            existed = {uid for uid, in db.session.query(ImageDatabase.Uid).filter(ImageDatabase.Uid.in_(uids))}
+        new_images = []
+        written = []
+        for row in images:
+            is_duplicated = row['Uid'] in existed
+            if not is_duplicated:
+                existed.add(row['Uid'])
+                new_images.append(row)
+            written.append((row['Uid'], is_duplicated))
+        drifted = []
+        try:
+            if new_images:
+                if self.Drift_Detector is not None:
+                    with metrics.timer('drift'):
+                        drifted = Baseline.update(new_images, self.Drift_Detector)
+                db.session.execute(self.insert(ImageDatabase.__table__), new_images)
+                FilterChoice.increment(FilterChoice.count_rows(new_images))
+            if algorithms:
+                known = set(self.Known_Algorithms)
+                AlgorithmVersion.register(algorithms.values(), known)
+            if manifest:
+                if not self.has_upsert():
+                    manifest = self.delete_existing(FileManifest.__table__, manifest)
+                db.session.execute(self.insert(FileManifest.__table__, replace=True), manifest)
+            with metrics.timer('db_commit'):
+                db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        if algorithms:
+            self.Known_Algorithms = known
+        self.Flush_Count += 1
+        # the rows are reported once they are committed
+        if self.on_written is not None:
+            for uid, is_duplicated in written:
+                self.on_written(uid, is_duplicated)
+        if self.on_drifted is not None:
+            for uid, score in drifted:
+                self.on_drifted(uid, score)
+
+
+class DicomIngest:
+    """
+    Ingest all Band Assessment DICOM files of a directory into ImageDatabase.
+    Files are discovered, parsed and scored by the IngestPipeline workers,
+    all database writes happen here in the calling thread.
+    """
+    def __init__(self, input_directory, workers=None, chunk_size=None, batch_size=None, keep_log=True, paths=None):
+        """
+        :param input_directory: the directory to ingest
+        :param workers: number of worker processes, default is INGEST_WORKERS
+        :param chunk_size: number of files sent to a worker at a time, default is INGEST_CHUNK_SIZE
+        :param batch_size: number of rows written in one transaction, default is INGEST_BATCH_SIZE
+        :param keep_log: add a line per file to Log_Record, False for bulk ingests so the memory does not grow
+        :param paths: only ingest these files of the directory instead of walking it, e.g. the new files
+        of a watched directory
+        """
+        self.Directory_Handler = DirectoryHandler(input_directory, lazy=True)
+        self.Log_Record = self.Directory_Handler.Log_Record
+        self.Paths = paths
+        self.setup(self.Directory_Handler.Input_Directory, workers, chunk_size, batch_size, keep_log, paths)
+
+    def setup(self, directory, workers, chunk_size, batch_size, keep_log, paths=None):
+        """
+        :param directory: the absolute directory of the manifest rows, None for none
+        :param paths: only load the manifest rows of these files
+        """
+        config = current_app.config
+        self.Writer = BatchWriter(batch_size=batch_size or config['INGEST_BATCH_SIZE'],
+                                  sqlite_pragmas=config['INGEST_SQLITE_PRAGMAS'],
+                                  drift_detector=make_detector() if config['DRIFT_DETECTION'] else None)
+        self.Writer.on_written = self.on_written
+        self.Writer.on_drifted = self.on_drifted
+        self.Keep_Log = keep_log
+        # index in Log_Record of the images waiting for their batch, by Uid
+        self.Pending_Log = {}
+        self.Manifest = ManifestIndex(directory, self.Writer, paths)
+        self.Pipeline = IngestPipeline(workers=workers or config['INGEST_WORKERS'],
+                                       chunk_size=chunk_size or config['INGEST_CHUNK_SIZE'],
+                                       pixel_store=config['PIXEL_STORE_DIR'],
+                                       series=config['INGEST_SERIES_MODE'],
+                                       series_size=config['INGEST_SERIES_SIZE'],
+                                       refine=config['INGEST_SERIES_REFINE'],
+                                       lean=config['INGEST_LEAN_MODE'],
+                                       instrument=metrics.Enabled)
+        # the timing summary of the finished run(), see summary()
+        self.Timing = None
+        self.Processed = 0
+        self.Inserted = 0
+        self.Duplicated = 0
+        self.Unchanged = 0
+        self.Failed = 0
+        self.Drifted = 0
+
+    def progress(self):
+        """
+        :return: progress in percent, None while the files are still being found, the total is not known then
+        """
+        if not self.Directory_Handler.Discovery_Finished:
+            return None
+        if self.Directory_Handler.Total_Dicom_Quantity == 0:
+            return 100
+        return self.Processed / self.Directory_Handler.Total_Dicom_Quantity * 100
+
+    def settled_log_count(self):
+        """
+        :return: number of lines at the start of Log_Record which will not change any more
+        """
+        pending = [index for indexes in list(self.Pending_Log.values()) for index in indexes]
+        return min(pending) if pending else len(self.Log_Record)
+
+    def run(self, stop=None):
+        """
+        :param stop: a callable, the ingest stops when it returns True, what is done so far is kept
+        :return: a generator of IngestResult, each one is saved before it is yielded
+        """
+        started = time.perf_counter()
+        before = metrics.snapshot()
+        try:
+            for result in self.results(stop):
+                if stop is not None and stop():
+                    break
+                self.Processed += 1
+                self.save(result)
+                yield result
+        finally:
+            # also keep what is done if the ingest is stopped
+            self.Writer.flush()
+            self.count_metrics(time.perf_counter() - started)
+            self.Timing = self.summary(time.perf_counter() - started, metrics.difference(metrics.snapshot(), before))
+        if self.Manifest.Skipped:
+            self.Log_Record.append(r"未改变的文件已跳过：" + str(self.Manifest.Skipped))
+        self.Log_Record.append(r"耗时：%.1f秒，每秒%.1f个文件" % (self.Timing['elapsed'],
+                                                            self.Timing['files_per_second']))
+        if stop is not None and stop():
+            self.Log_Record.append(r"导入已取消")
+
+    def results(self, stop=None):
+        """
+        :param stop: see run()
+        :return: a generator of the IngestResult of the files to ingest
+        """
+        if self.Paths is not None:
+            files = self.Directory_Handler.iter_paths(self.Paths, skip=self.Manifest.is_unchanged,
+                                                      reject=self.Manifest.reject)
+        else:
+            files = self.Directory_Handler.iter_files(skip=self.Manifest.is_unchanged, reject=self.Manifest.reject)
+        if stop is not None:
+            files = self.until(files, stop)
+        return self.Pipeline.run(files, self.Manifest.Known_Hash)
+
+    def count_metrics(self, elapsed):
+        if not metrics.Enabled:
+            return
+        metrics.add_time('ingest', elapsed)
+        metrics.count('ingests')
+        metrics.count('files_processed', self.Processed)
+        metrics.count('files_inserted', self.Inserted)
+        metrics.count('files_duplicated', self.Duplicated)
+        metrics.count('files_unchanged', self.Unchanged)
+        metrics.count('files_failed', self.Failed)
+
+    def summary(self, elapsed, recorded):
+        """
+        :param elapsed: seconds of the whole run
+        :param recorded: the Metrics recorded during the run, the stages are empty if metrics is disabled
+        :return: a JSON serializable dict of the timing of this ingest
+        """
+        return dict(elapsed=elapsed, files=self.Processed,
+                    files_per_second=self.Processed / elapsed if elapsed > 0 else 0.0,
+                    bytes_read=recorded['counters'].get('bytes_read', 0),
+                    stages={stage: dict(calls=calls, seconds=seconds)
+                            for stage, (calls, seconds) in recorded['timers'].items()})
+
+    @staticmethod
+    def until(files, stop):
+        for filename in files:
+            if stop():
+                return
+            yield filename
+
+    def save(self, result):
+        """
+        Queue one result and its manifest row to the writer.
+        :param result: an IngestResult
+        """
+        log = result.FileName
+        if result.isUnchanged:
+            self.Unchanged += 1
+            if self.Keep_Log:
+                self.Log_Record.append(log + '-->' + r"文件未改变，跳过")
+            self.Manifest.record(result.FileName, result.Content_Hash, self.Manifest.uid(result.FileName))
+        elif result.isComplete:
+            header = result.Header
+            if self.Keep_Log:
+                # the line is completed by on_written() once the batch is written
+                self.Pending_Log.setdefault(result.Uid, []).append(len(self.Log_Record))
+                self.Log_Record.append(log + '-->' + header['SerialNumber'] + ':' + header['ScanMode'])
+            # image before manifest, a file is never marked as done before its image is written
+            self.Writer.add_image(self.make_row(result), result.Algorithm)
+            self.Manifest.record(result.FileName, result.Content_Hash, result.Uid)
+        else:
+            self.Failed += 1
+            if self.Keep_Log:
+                self.Log_Record.append(log)
+            if result.Content_Hash is not None:
+                self.Manifest.record(result.FileName, result.Content_Hash, None)
+            else:
+                # could not read the file, try again next time
+                self.Manifest.Stat.pop(result.FileName, None)
+
+    def on_written(self, uid, is_duplicated):
+        index = None
+        if uid in self.Pending_Log:
+            index = self.Pending_Log[uid].pop(0)
+            if not self.Pending_Log[uid]:
+                del self.Pending_Log[uid]
+        if is_duplicated:
+            self.Duplicated += 1
+            if index is not None:
+                self.Log_Record[index] += r"已经存在于数据库！"
+        else:
+            self.Inserted += 1
+
+    def on_drifted(self, uid, score):
+        self.Drifted += 1
+        logging.warning(uid + r": the profile drifts from the baseline, score %.1f" % score)
+        if self.Keep_Log:
+            self.Log_Record.append(uid + '-->' + r"偏离基线：%.1f" % score)
+
+    @staticmethod
+    def make_row(result):
+        """
+        :param result: a complete IngestResult
+        :return: a dict of ImageDatabase column values
+        """
+        return ImageDatabase.make_row(result.Uid, result.Header, result.Profile, raw_profile=result.Raw_Profile,
+                                      pixel_hash=result.Pixel_Hash, algorithm=result.Algorithm)
+
+
+class UploadIngest(DicomIngest):
+    """
+    Ingest the DICOM files of an upload, each one parsed from memory as it arrives and scored in the
+    calling thread, so only one file is in memory at a time and nothing is extracted to disk.
+    The uploaded files have no FileManifest rows.
+    """
+    def __init__(self, uploads, batch_size=None, keep_log=True):
+        """
+        :param uploads: an iterable of (name, bytes), e.g. iter_upload(), it is consumed lazily
+        :param batch_size: number of rows written in one transaction, default is INGEST_BATCH_SIZE
+        :param keep_log: add a line per file to Log_Record
+        """
+        self.Directory_Handler = None
+        self.Uploads = uploads
+        self.Log_Record = []
+        self.Received = 0
+        self.setup(None, 1, 1, batch_size, keep_log)
+
+    def progress(self):
+        # the size of an upload is not known before it is read
+        return None
+
+    def results(self, stop=None):
+        return self.Pipeline.run_contents(self.targets(stop))
+
+    def targets(self, stop=None):
+        """
+        :return: a generator of the uploaded (name, bytes) which are DICOM files of Band Assessment
+        """
+        for name, content in self.Uploads:
+            if stop is not None and stop():
+                return
+            self.Received += 1
+            if DirectoryHandler.is_target_file(name, io.BytesIO(content)):
+                yield name, content
+            elif self.Keep_Log:
+                self.Log_Record.append(name + '-->' + r"不是Band Assessment的DICOM文件，跳过")
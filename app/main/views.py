@@ -1,67 +1,199 @@
 from datetime import datetime
+import io
 import logging
-from flask import render_template, session, redirect, url_for, Response, request, send_file
+import pstats
+from flask import render_template, session, redirect, url_for, Response, request, send_file, jsonify, abort, \
+    current_app, stream_with_context
 
 from . import main
 from .forms import DirectoryInputForm, ShowSavedImage, LoginForm
-from .algorithm.DirectoryHandler import DirectoryHandler
-from .algorithm.DicomHanlder import DicomHandler
-from .algorithm.ImageHandler import ImageHandler
-from .. import db
+from .. import job_runner, render_service
+from ..export import Formats, export
 from ..models import ImageDatabase
+from ..query import filter_choices, list_images, parse_filters, algorithm_versions
+from ..storage import get_pixel_store
+from ..upload import iter_upload, UploadError
+from .algorithm.Metrics import metrics
 
 
 @main.route('/', methods=['GET', 'POST'])
 def index():
-    KV_Choices = [(1, '80'), (2, '110'), (3, '130')]
-    Current_Choices = [(1, '10'), (2, '130'), (3, '240')]
-    form = ShowSavedImage()
-    form.Select_Current.choices = KV_Choices
-    form.Select_KV.choices = Current_Choices
-    return render_template('index.html', form=form)
+    choices = filter_choices()
+    form = ShowSavedImage(request.args)
+    form.Select_KV.choices = [(0, r'全部')] + [(int(value), '%g' % value) for value, _ in choices['kv']]
+    form.Select_Current.choices = [(0, r'全部')] + [(value, str(value)) for value, _ in choices['current']]
+    filters = {}
+    if request.args.get('Select_KV', 0, type=int):
+        filters['kv'] = request.args.get('Select_KV', type=int)
+    if request.args.get('Select_Current', 0, type=int):
+        filters['current'] = request.args.get('Select_Current', type=int)
+    # the newest results, their previews and plots are served from the render cache
+    images, _ = list_images(limit=20, **filters)
+    return render_template('index.html', form=form, images=images)
+
+
+@main.route('/api/images')
+def api_images():
+    try:
+        filters = parse_filters(request.args)
+        images, cursor = list_images(limit=min(request.args.get('limit', 50, type=int), 1000),
+                                     after=request.args.get('after'), **filters)
+    except ValueError:
+        abort(400)
+    return jsonify(images=images, next=cursor)
+
+
+@main.route('/api/filters')
+def api_filters():
+    choices = filter_choices()
+    first, last = choices.pop('date_time')
+    result = {name: [dict(value=value, count=count) for value, count in values] for name, values in choices.items()}
+    result['date_time'] = dict(first=first, last=last)
+    return jsonify(result)
+
+
+@main.route('/api/algorithms')
+def api_algorithms():
+    return jsonify(algorithms=algorithm_versions())
+
+
+@main.route('/api/drift')
+def api_drift():
+    # numpy is imported by the first report, not by the app start
+    from ..drift import fleet_drift_report
+    try:
+        filters = parse_filters(request.args)
+    except ValueError:
+        abort(400)
+    return jsonify(fleet_drift_report(threshold=request.args.get('threshold', type=float), **filters))
+
+
+@main.route('/export.<format_>')
+def export_images(format_):
+    """
+    Stream the filtered results as CSV, an Arrow IPC stream or Parquet, a chunk of rows at a time,
+    the whole table is never loaded.
+    """
+    if format_ not in Formats:
+        abort(404)
+    try:
+        filters = parse_filters(request.args)
+    except ValueError:
+        abort(400)
+    try:
+        chunks = export(format_, current_app.config['EXPORT_CHUNK_SIZE'], **filters)
+    except ImportError as e:
+        return Response(str(e), status=501, mimetype='text/plain')
+    filename = 'results_%s.%s' % (datetime.now().strftime('%Y%m%d%H%M%S'), format_)
+    return Response(stream_with_context(chunks), mimetype=Formats[format_],
+                    headers={'Content-Disposition': 'attachment; filename=' + filename})
 
 
 @main.route('/DicomInput', methods=['GET', 'POST'])
 def dicom_input():
-    output_log = ''
-    progress = 0
-    current_count = 1
     form = DirectoryInputForm()
     if form.validate_on_submit():
-        directory_handler = DirectoryHandler(form.Input_Directory.data)
-        output_log = directory_handler.Log_Record.copy()
-        directory_handler.Log_Record.clear()
-
-        for x in directory_handler.Dicom_File_Path:
-            dicom = DicomHandler(x)
-            if dicom.isComplete:
-                image = ImageHandler(dicom)
-                if image.isImageComplete:
-                    int_result_string = ';'.join([str(x) for x in image.Image_Median_Filter_Result])
-                    dicom_model = ImageDatabase(Uid=dicom.Uid,
-                                                Serial_number=dicom.SerialNumber,
-                                                Modality = dicom.Modality,
-                                                Tube_voltage=dicom.KVP,
-                                                Tube_current=dicom.Current,
-                                                Kernel=dicom.Kernel,
-                                                Total_collimation=dicom.TotalCollimation,
-                                                Slice_Thickness=dicom.SliceThickness,
-                                                Instance=dicom.Instance,
-                                                Integration_result=int_result_string,
-                                                Date_Time=dicom.DateTime,
-                                                Dicom_Save=dicom)
-                    db.session.add(dicom_model)
-                    try:
-                        db.session.commit()
-                        output_log[current_count] += ('-->' + dicom.SerialNumber + ':' + dicom.ScanMode)
-                    except Exception as e:
-                        output_log[current_count] += ('-->' + dicom.SerialNumber + ':' +
-                                                      dicom.ScanMode+"已经存在于数据库！")
-                        db.session.rollback()
-                        logging.error(str(e))
-
-                    progress = current_count / directory_handler.Total_Dicom_Quantity * 100 + 1
-                    current_count += 1
-        directory_handler.Dicom_File_Path.clear()
-    return render_template('DicomInput.html', form=form, output_log=output_log, progress=str(progress))
+        # the ingest runs in the background, the page polls the job status
+        job = job_runner.submit(form.Input_Directory.data)
+        return redirect(url_for('.dicom_input', job=job.Id))
+    job = job_runner.get(request.args.get('job', ''))
+    return render_template('DicomInput.html', form=form, job=job)
+
+
+@main.route('/upload', methods=['POST'])
+def upload():
+    """
+    Ingest the DICOM files of a multipart/form-data body, a zip archive or a single file, while the
+    body arrives. Only request.stream is read: request.files would spool the whole body first.
+    """
+    # the scoring modules are imported by the first ingest, not by the app start
+    from .ingest import UploadIngest
+    uploads = iter_upload(request.stream, request.mimetype, request.mimetype_params,
+                          filename=request.args.get('filename', 'upload'),
+                          max_size=current_app.config['UPLOAD_MAX_FILE_SIZE'])
+    ingest = UploadIngest(uploads)
+    error = None
+    try:
+        with metrics.timer('upload'):
+            for _ in ingest.run():
+                pass
+    except UploadError as e:
+        # the files before the error are kept
+        error = str(e)
+        ingest.Log_Record.append(r"上传的文件无法解析：" + error)
+    result = dict(received=ingest.Received, processed=ingest.Processed, inserted=ingest.Inserted,
+                  duplicated=ingest.Duplicated, failed=ingest.Failed, drifted=ingest.Drifted, error=error,
+                  log=ingest.Log_Record)
+    return jsonify(result), 400 if error else 200
+
+
+@main.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = job_runner.get(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job.to_dict(since=request.args.get('since', 0, type=int)))
+
+
+@main.route('/jobs/<job_id>/profile')
+def job_profile(job_id):
+    job = job_runner.get(job_id)
+    if job is None or job.Profile is None:
+        abort(404)
+    output = io.StringIO()
+    pstats.Stats(job.Profile, stream=output).sort_stats('cumulative').print_stats(40)
+    return Response(output.getvalue(), mimetype='text/plain')
+
+
+@main.route('/metrics')
+def prometheus_metrics():
+    lines = ['# HELP webbat_jobs Number of ingest jobs kept by the job runner.',
+             '# TYPE webbat_jobs gauge']
+    lines += ['webbat_jobs{status="%s"} %d' % item for item in sorted(job_runner.status_counts().items())]
+    return Response(metrics.prometheus() + '\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+
+@main.route('/jobs/<job_id>/cancel', methods=['POST'])
+def job_cancel(job_id):
+    job = job_runner.cancel(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job.to_dict(since=request.args.get('since', 0, type=int)))
+
+
+def png_response(key, data, mtime):
+    """
+    :return: a PNG response, 304 if the browser has the same one
+    """
+    response = Response(data, mimetype='image/png')
+    response.set_etag(key)
+    response.last_modified = datetime.utcfromtimestamp(mtime)
+    response.cache_control.public = True
+    response.cache_control.max_age = 3600
+    return response.make_conditional(request)
+
+
+def render_size():
+    size = request.args.get('size')
+    if size is not None and size not in render_service.Sizes:
+        abort(400)
+    return size
+
+
+@main.route('/images/<uid>/preview.png')
+def image_preview(uid):
+    image = ImageDatabase.query.get_or_404(uid)
+    if image.Pixel_hash is None:
+        abort(404)
+    size = render_size()
+    window = None
+    if 'ww' in request.args or 'wl' in request.args:
+        window = (request.args.get('ww', image.Window_width, type=float),
+                  request.args.get('wl', image.Window_center, type=float))
+    return png_response(*render_service.preview(image, get_pixel_store(), window, size))
+
 
+@main.route('/images/<uid>/plot.png')
+def image_plot(uid):
+    image = ImageDatabase.query.get_or_404(uid)
+    return png_response(*render_service.plot(image, render_size()))
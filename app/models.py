@@ -1,8 +1,28 @@
+import hashlib
+import json
+import time
+from datetime import datetime
+from sqlalchemy import select
+
 from . import db
 
 
 class ImageDatabase(db.Model):
+    """
+    One scored slice.
+    The profiles are float32 arrays stored as bytes, the raw pixel data is kept in the
+    PixelStore under Pixel_hash. Dicom_Save is only filled by the legacy storage, it is
+    deferred like Integration_raw, so list and trend queries never load them.
+    """
     __tablename__ = 'dicoms'
+    # the filters of the index page and /api/images, newest first within each one,
+    # Uid is the tie-breaker of the keyset pagination
+    __table_args__ = (
+        db.Index('ix_dicoms_date_time', 'Date_Time', 'Uid'),
+        db.Index('ix_dicoms_serial_date_time', 'Serial_number', 'Date_Time', 'Uid'),
+        db.Index('ix_dicoms_protocol_date_time', 'Tube_voltage', 'Tube_current', 'Date_Time', 'Uid'),
+        db.Index('ix_dicoms_kernel_date_time', 'Kernel', 'Date_Time', 'Uid'),
+    )
     Uid = db.Column(db.Text, primary_key=True, nullable=False)
     Serial_number = db.Column(db.Integer, nullable=False)
     Modality = db.Column(db.Text, nullable=False)
@@ -12,11 +32,423 @@ class ImageDatabase(db.Model):
     Total_collimation = db.Column(db.Float, nullable=False)
     Slice_Thickness = db.Column(db.Float, nullable=False)
     Instance = db.Column(db.Integer, nullable=False)
-    Integration_result = db.Column(db.Text, nullable=False)
+    Integration_result = db.Column(db.LargeBinary, nullable=False)
     Date_Time = db.Column(db.Text, nullable=False)
-    Dicom_Save = db.Column(db.PickleType, nullable=False)
+    Dicom_Save = db.deferred(db.Column(db.PickleType))
     Comment = db.Column(db.Text)
+    # image geometry and rescale, enough to rebuild Image_HU from the stored pixel data
+    Series = db.Column(db.Integer)
+    Rows = db.Column(db.Integer)
+    Cols = db.Column(db.Integer)
+    Pixel_spacing = db.Column(db.Float)
+    Rescale_slope = db.Column(db.Float)
+    Rescale_intercept = db.Column(db.Float)
+    Window_center = db.Column(db.Float)
+    Window_width = db.Column(db.Float)
+    Pixel_hash = db.Column(db.Text)
+    Integration_raw = db.deferred(db.Column(db.LargeBinary))
+    # the score of Integration_result against the Baseline when it was ingested, see DriftDetector
+    Drift_score = db.Column(db.Float)
+    # the scoring algorithm which made the profiles, see AlgorithmVersion, None for the rows made before
+    Algorithm_version = db.Column(db.Integer)
+    Parameter_hash = db.Column(db.Text)
+
+    @classmethod
+    def make_row(cls, uid, header, profile, raw_profile=None, pixel_hash=None, comment=None, algorithm=None):
+        """
+        :param uid: the Uid
+        :param header: the dict of DicomHandler.header()
+        :param profile: Image_Median_Filter_Result
+        :param raw_profile: Image_Integration_Result
+        :param pixel_hash: the PixelStore key of the raw pixel data
+        :param comment: the comment
+        :param algorithm: the dict of ImageHandler.algorithm_parameters() which made the profiles, None if unknown
+        :return: a dict of column values for a bulk insert
+        """
+        def first(value):
+            # multi-valued window center/width, pixel spacing
+            return value[0] if isinstance(value, (list, tuple)) else value
+
+        return dict(Uid=uid,
+                    Serial_number=header['SerialNumber'],
+                    Modality=header['Modality'],
+                    Tube_voltage=header['KVP'],
+                    Tube_current=header['Current'],
+                    Kernel=header['Kernel'],
+                    Total_collimation=header['TotalCollimation'],
+                    Slice_Thickness=header['SliceThickness'],
+                    Instance=header['Instance'],
+                    Integration_result=cls.pack_profile(profile),
+                    Date_Time=header['DateTime'],
+                    Dicom_Save=None,
+                    Comment=comment,
+                    Series=header['Series'],
+                    Rows=header['Rows'],
+                    Cols=header['Cols'],
+                    Pixel_spacing=first(header['PixSpace']),
+                    Rescale_slope=header['Slop'],
+                    Rescale_intercept=header['Intercept'],
+                    Window_center=first(header['WindowCenter']),
+                    Window_width=first(header['WindowWidth']),
+                    Pixel_hash=pixel_hash,
+                    Integration_raw=cls.pack_profile(raw_profile) if raw_profile is not None else None,
+                    Drift_score=None,
+                    Algorithm_version=algorithm['version'] if algorithm is not None else None,
+                    Parameter_hash=AlgorithmVersion.parameter_hash(algorithm) if algorithm is not None else None)
+
+    # numpy is imported on first use, so the web app starts without it
+    @staticmethod
+    def pack_profile(profile):
+        import numpy as np
+        return np.asarray(profile, dtype=np.float32).tobytes()
+
+    @staticmethod
+    def unpack_profile(value):
+        if value is None:
+            return None
+        import numpy as np
+        return np.frombuffer(value, dtype=np.float32)
+
+    @property
+    def profile(self):
+        """Image_Median_Filter_Result as float32 np array"""
+        return self.unpack_profile(self.Integration_result)
+
+    @property
+    def raw_profile(self):
+        """Image_Integration_Result as float32 np array"""
+        return self.unpack_profile(self.Integration_raw)
+
+    def pixel_data(self, store):
+        """
+        :param store: the PixelStore
+        :return: the raw pixel data as read only memory-mapped np array
+        """
+        return store.get(self.Pixel_hash)
+
+    def image_hu(self, store):
+        return self.pixel_data(store) * self.Rescale_slope + self.Rescale_intercept
 
     def __repr__(self):
         return '<ImageDatabase %r>' % (str(self.Serial_number)+self.Date_Time)
 
+
+class FilterChoice(db.Model):
+    """
+    The distinct values of the filter columns of ImageDatabase with their number of rows,
+    maintained by BatchWriter with every written batch, so the filter choices never scan dicoms.
+    The value is stored as text, value() converts it back to the type of the column.
+    """
+    __tablename__ = 'filter_choices'
+    Fields = ('Serial_number', 'Tube_voltage', 'Tube_current', 'Kernel')
+    Field = db.Column(db.Text, primary_key=True, nullable=False)
+    Value = db.Column(db.Text, primary_key=True, nullable=False)
+    Count = db.Column(db.Integer, nullable=False, default=0)
+
+    @property
+    def value(self):
+        try:
+            return ImageDatabase.__table__.c[self.Field].type.python_type(self.Value)
+        except ValueError:
+            # SQLite keeps a serial number with letters as text in the integer column
+            return self.Value
+
+    @classmethod
+    def count_rows(cls, rows):
+        """
+        :param rows: dicts of ImageDatabase column values
+        :return: dict of {(field, value as text): number of rows}
+        """
+        counts = {}
+        for row in rows:
+            for field in cls.Fields:
+                key = (field, str(row[field]))
+                counts[key] = counts.get(key, 0) + 1
+        return counts
+
+    @classmethod
+    def increment(cls, counts):
+        """
+        Add the counts in the current transaction, the caller commits.
+        :param counts: dict of {(field, value as text): number of rows}, see count_rows()
+        """
+        table = cls.__table__
+        for (field, value), count in counts.items():
+            updated = db.session.execute(
+                table.update().where((table.c.Field == field) & (table.c.Value == value)).
+                values(Count=table.c.Count + count))
+            if updated.rowcount == 0:
+                db.session.execute(table.insert().values(Field=field, Value=value, Count=count))
+
+    @classmethod
+    def rebuild(cls):
+        """
+        Count all rows of ImageDatabase again, for a database written before the table existed.
+        :return: number of choices
+        """
+        table = cls.__table__
+        db.session.execute(table.delete())
+        rows = []
+        for field in cls.Fields:
+            column = ImageDatabase.__table__.c[field]
+            for value, count in db.session.query(column, db.func.count()).group_by(column):
+                rows.append(dict(Field=field, Value=str(value), Count=count))
+        if rows:
+            db.session.execute(table.insert(), rows)
+        db.session.commit()
+        return len(rows)
+
+    @classmethod
+    def choices(cls):
+        """
+        :return: dict of {field: list of (value, count) sorted by value}
+        """
+        result = {field: [] for field in cls.Fields}
+        for choice in cls.query.filter(cls.Count > 0):
+            result[choice.Field].append((choice.value, choice.Count))
+        for values in result.values():
+            values.sort()
+        return result
+
+    def __repr__(self):
+        return '<FilterChoice %r=%r>' % (self.Field, self.Value)
+
+
+class Baseline(db.Model):
+    """
+    The running mean and variance per radius of the profiles of one scanner and scan mode,
+    the scan mode includes the slice, as DicomHandler.ScanMode does.
+    BatchWriter scores the new images against it and adds them in the same transaction,
+    so a baseline never reads the history again, see RunningProfile.
+    """
+    __tablename__ = 'baselines'
+    Serial_number = db.Column(db.Integer, primary_key=True, nullable=False)
+    Scan_mode = db.Column(db.Text, primary_key=True, nullable=False)
+    Count = db.Column(db.Integer, nullable=False, default=0)
+    # float64 arrays stored as bytes
+    Mean = db.Column(db.LargeBinary, nullable=False)
+    M2 = db.Column(db.LargeBinary, nullable=False)
+    # the newest Date_Time added
+    Updated = db.Column(db.Text)
+    # time.time() of the last write by update() or rebuild(), the BaselineCache reloads when it changes,
+    # Updated does not, a rebuild from rescored profiles keeps the same images
+    Written = db.Column(db.Float)
+
+    @staticmethod
+    def scan_mode(row):
+        """
+        :param row: a dict of ImageDatabase column values
+        """
+        return '{0:g}kV_{1}mA_{2}_{3:g}P{4:g}.{5}'.format(row['Tube_voltage'], row['Tube_current'], row['Kernel'],
+                                                          row['Total_collimation'], row['Slice_Thickness'],
+                                                          row['Instance'])
+
+    def running_profile(self):
+        from .main.algorithm.DriftDetector import RunningProfile
+        return RunningProfile.from_bytes(self.Count, self.Mean, self.M2)
+
+    def set_running_profile(self, running, updated):
+        self.Count = running.Count
+        self.Mean, self.M2 = running.to_bytes()
+        self.Updated = max(self.Updated or '', updated)
+        self.Written = time.time()
+
+    @classmethod
+    def group_rows(cls, rows):
+        """
+        :return: dict of {(serial number, scan mode): list of rows}
+        """
+        groups = {}
+        for row in rows:
+            groups.setdefault((cls.serial_number(row['Serial_number']), cls.scan_mode(row)), []).append(row)
+        return groups
+
+    @staticmethod
+    def serial_number(value):
+        """
+        :return: the serial number as the database returns it, the header has it as text
+        """
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return value
+
+    @staticmethod
+    def stack_profiles(rows, length=None):
+        """
+        :param rows: dicts of ImageDatabase column values
+        :param length: the profile length of the baseline, None for the length of the 1st row
+        :return: (the rows of that length, (rows, length) float32 np array of their Integration_result),
+        a profile of another length (another image size) can not be compared
+        """
+        import numpy as np
+        length = length or len(rows[0]['Integration_result']) // 4
+        rows = [row for row in rows if len(row['Integration_result']) == length * 4]
+        profiles = np.frombuffer(b''.join(row['Integration_result'] for row in rows), dtype=np.float32)
+        return rows, profiles.reshape(len(rows), length)
+
+    @classmethod
+    def update(cls, rows, detector):
+        """
+        Score the rows against their baselines and set their Drift_score, then add the rows which are
+        not flagged to the baselines, so an artifact never becomes the norm it is compared with.
+        The rows of one batch are all scored against the baseline before the batch.
+        Runs in the current transaction, the caller commits.
+        :param rows: dicts of ImageDatabase column values of new images
+        :param detector: the DriftDetector
+        :return: list of (Uid, score) of the rows scored over detector.Threshold
+        """
+        import numpy as np
+        from .main.algorithm.DriftDetector import RunningProfile
+        groups = cls.group_rows(rows)
+        serials = {serial for serial, _ in groups}
+        existing = {(cls.serial_number(b.Serial_number), b.Scan_mode): b
+                    for b in cls.query.filter(cls.Serial_number.in_(serials))}
+        flagged = []
+        for key, members in groups.items():
+            baseline = existing.get(key)
+            running = baseline.running_profile() if baseline is not None else RunningProfile()
+            members, profiles = cls.stack_profiles(members, running.length)
+            if not members:
+                continue
+            scores = detector.score(running, profiles)
+            normal = ~(scores > detector.Threshold)
+            for row, score in zip(members, scores):
+                if not np.isnan(score):
+                    row['Drift_score'] = float(score)
+                    if score > detector.Threshold:
+                        flagged.append((row['Uid'], float(score)))
+            if not normal.any():
+                continue
+            running.add(profiles[normal])
+            if baseline is None:
+                baseline = cls(Serial_number=key[0], Scan_mode=key[1])
+                db.session.add(baseline)
+            baseline.set_running_profile(running, max(row['Date_Time'] for row, ok in zip(members, normal) if ok))
+        return flagged
+
+    @classmethod
+    def rebuild(cls, threshold=None, chunk_size=2000):
+        """
+        Build all baselines again from the stored profiles, for a database written before the table
+        existed or after the profiles are rescored.
+        :param threshold: the rows with a higher Drift_score are left out as update() does, None for none
+        :param chunk_size: number of rows read at a time
+        :return: number of baselines
+        """
+        from .main.algorithm.DriftDetector import RunningProfile
+        table = ImageDatabase.__table__
+        columns = [table.c[name] for name in ('Uid', 'Serial_number', 'Tube_voltage', 'Tube_current', 'Kernel',
+                                              'Total_collimation', 'Slice_Thickness', 'Instance', 'Date_Time',
+                                              'Integration_result', 'Drift_score')]
+        running = {}
+        updated = {}
+        last_uid = None
+        while True:
+            query = select(columns)
+            if last_uid is not None:
+                query = query.where(table.c.Uid > last_uid)
+            rows = [dict(row) for row in db.session.execute(query.order_by(table.c.Uid).limit(chunk_size))]
+            if not rows:
+                break
+            last_uid = rows[-1]['Uid']
+            if threshold is not None:
+                rows = [row for row in rows if row['Drift_score'] is None or row['Drift_score'] <= threshold]
+            for key, members in cls.group_rows(rows).items():
+                profile = running.setdefault(key, RunningProfile())
+                members, profiles = cls.stack_profiles(members, profile.length)
+                if not members:
+                    continue
+                profile.add(profiles)
+                updated[key] = max([updated.get(key, '')] + [row['Date_Time'] for row in members])
+        rows = []
+        written = time.time()
+        for (serial, scan_mode), profile in running.items():
+            mean, m2 = profile.to_bytes()
+            rows.append(dict(Serial_number=serial, Scan_mode=scan_mode, Count=profile.Count, Mean=mean, M2=m2,
+                             Updated=updated[(serial, scan_mode)], Written=written))
+        db.session.execute(cls.__table__.delete())
+        if rows:
+            db.session.execute(cls.__table__.insert(), rows)
+        db.session.commit()
+        return len(rows)
+
+    def __repr__(self):
+        return '<Baseline %r %r>' % (self.Serial_number, self.Scan_mode)
+
+
+class AlgorithmVersion(db.Model):
+    """
+    The parameter sets of the scoring algorithm which made stored profiles, by the Parameter_hash of
+    ImageDatabase, so a row tells which algorithm version and parameters made it and a re-score knows
+    the parameters of a row. A row is added by BatchWriter with the first image of its parameters.
+    """
+    __tablename__ = 'algorithm_versions'
+    Parameter_hash = db.Column(db.Text, primary_key=True, nullable=False)
+    Version = db.Column(db.Integer, nullable=False)
+    # the JSON of ImageHandler.algorithm_parameters()
+    Parameters = db.Column(db.Text, nullable=False)
+    Created = db.Column(db.Text)
+
+    @staticmethod
+    def parameter_hash(parameters):
+        """
+        :param parameters: the dict of ImageHandler.algorithm_parameters()
+        :return: 16 hex digits of the sha1 of the parameters
+        """
+        return hashlib.sha1(json.dumps(parameters, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+    @property
+    def parameters(self):
+        return json.loads(self.Parameters)
+
+    @classmethod
+    def register(cls, parameter_sets, known=None):
+        """
+        Add the parameter sets which are not in the table yet, in the current transaction.
+        :param parameter_sets: dicts of ImageHandler.algorithm_parameters()
+        :param known: optional set of the hashes known to be in the table, it is updated
+        :return: list of the added hashes
+        """
+        known = set() if known is None else known
+        new = {}
+        for parameters in parameter_sets:
+            key = cls.parameter_hash(parameters)
+            if key not in known:
+                new[key] = parameters
+        if new:
+            known |= {key for key, in db.session.query(cls.Parameter_hash).filter(cls.Parameter_hash.in_(list(new)))}
+        added = [key for key in new if key not in known]
+        if added:
+            created = datetime.now().isoformat(timespec='seconds')
+            db.session.execute(cls.__table__.insert(), [
+                dict(Parameter_hash=key, Version=new[key]['version'], Parameters=json.dumps(new[key], sort_keys=True),
+                     Created=created) for key in added])
+            known.update(added)
+        return added
+
+    @classmethod
+    def lookup(cls):
+        """
+        :return: dict of {Parameter_hash: parameters dict}
+        """
+        return {row.Parameter_hash: row.parameters for row in cls.query}
+
+    def __repr__(self):
+        return '<AlgorithmVersion %r %r>' % (self.Version, self.Parameter_hash)
+
+
+class FileManifest(db.Model):
+    """
+    One row per file seen by the ingest, so unchanged files can be skipped before any decode.
+    Uid is None if the file is not a target file or can not be scored.
+    """
+    __tablename__ = 'manifest'
+    Path = db.Column(db.Text, primary_key=True, nullable=False)
+    Size = db.Column(db.Integer, nullable=False)
+    Mtime_ns = db.Column(db.Integer, nullable=False)
+    Content_hash = db.Column(db.Text)
+    Uid = db.Column(db.Text)
+
+    def __repr__(self):
+        return '<FileManifest %r>' % self.Path
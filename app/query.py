@@ -0,0 +1,164 @@
+from collections import OrderedDict
+from sqlalchemy import and_, or_, inspect
+
+from . import db
+from .models import ImageDatabase, FilterChoice, AlgorithmVersion, Baseline
+
+# the columns returned by the listings, no profile or pixel data
+Light_Columns = ('Uid', 'Serial_number', 'Modality', 'Tube_voltage', 'Tube_current', 'Kernel',
+                 'Total_collimation', 'Slice_Thickness', 'Series', 'Instance', 'Date_Time', 'Comment',
+                 'Pixel_hash', 'Algorithm_version', 'Parameter_hash')
+
+# query argument: (column, type), a serial number with letters stays text as SQLite keeps it
+Filters = OrderedDict([('serial', ('Serial_number', Baseline.serial_number)),
+                       ('kv', ('Tube_voltage', float)),
+                       ('current', ('Tube_current', int)),
+                       ('kernel', ('Kernel', str))])
+
+
+def parse_filters(args):
+    """
+    :param args: the request arguments, serial, kv, current, kernel, start and end (Date_Time prefixes),
+    version (Algorithm_version) and params (Parameter_hash)
+    :return: dict of the keyword arguments of filter_images()
+    :raise ValueError: a filter value does not match the column type
+    """
+    filters = {}
+    for name, (_, type_) in Filters.items():
+        value = args.get(name)
+        if value not in (None, ''):
+            filters[name] = type_(value)
+    for name in ('start', 'end', 'params'):
+        if args.get(name):
+            filters[name] = args.get(name)
+    if args.get('version') not in (None, ''):
+        filters['version'] = int(args.get('version'))
+    return filters
+
+
+def filter_images(query, serial=None, kv=None, current=None, kernel=None, start=None, end=None, version=None,
+                  params=None):
+    """
+    :param query: a query of ImageDatabase or of its columns
+    :param start: the first Date_Time, inclusive, a prefix like '2017' or '201706' works
+    :param end: the last Date_Time, a prefix includes everything starting with it
+    :param version: only the rows made by this Algorithm_version
+    :param params: only the rows made with this Parameter_hash
+    :return: the filtered query, each filter but version and params is served by the indexes of ImageDatabase
+    """
+    values = dict(serial=serial, kv=kv, current=current, kernel=kernel)
+    for name, (column, _) in Filters.items():
+        if values[name] is not None:
+            query = query.filter(getattr(ImageDatabase, column) == values[name])
+    if start is not None:
+        query = query.filter(ImageDatabase.Date_Time >= start)
+    if end is not None:
+        # \uffff sorts after every character of a Date_Time
+        query = query.filter(ImageDatabase.Date_Time <= end + '\uffff')
+    if version is not None:
+        query = query.filter(ImageDatabase.Algorithm_version == version)
+    if params is not None:
+        query = query.filter(ImageDatabase.Parameter_hash == params)
+    return query
+
+
+def encode_cursor(date_time, uid):
+    return date_time + ',' + uid
+
+
+def decode_cursor(cursor):
+    """
+    :raise ValueError: not a cursor of encode_cursor()
+    """
+    date_time, uid = cursor.split(',', 1)
+    return date_time, uid
+
+
+def list_images(limit=50, after=None, **filters):
+    """
+    Newest first, paginated by keyset: a page starts after the last row of the previous one,
+    so a deep page costs the same as the first one and no total count is made.
+    :param limit: number of rows of the page
+    :param after: the cursor of the previous page, None for the first page
+    :param filters: see filter_images()
+    :return: (list of dicts of Light_Columns, cursor of the next page or None)
+    """
+    columns = [getattr(ImageDatabase, name) for name in Light_Columns]
+    query = filter_images(db.session.query(*columns), **filters)
+    if after is not None:
+        date_time, uid = decode_cursor(after)
+        query = query.filter(or_(ImageDatabase.Date_Time < date_time,
+                                 and_(ImageDatabase.Date_Time == date_time, ImageDatabase.Uid < uid)))
+    rows = query.order_by(ImageDatabase.Date_Time.desc(), ImageDatabase.Uid.desc()).limit(limit + 1).all()
+    images = [OrderedDict(zip(Light_Columns, row)) for row in rows[:limit]]
+    cursor = None
+    if len(rows) > limit:
+        cursor = encode_cursor(images[-1]['Date_Time'], images[-1]['Uid'])
+    return images, cursor
+
+
+def filter_choices():
+    """
+    :return: dict of {query argument: list of (value, count)} and the Date_Time range
+    """
+    choices = FilterChoice.choices()
+    result = OrderedDict((name, choices[column]) for name, (column, _) in Filters.items())
+    first, last = db.session.query(db.func.min(ImageDatabase.Date_Time), db.func.max(ImageDatabase.Date_Time)).one()
+    result['date_time'] = (first, last)
+    return result
+
+
+def algorithm_versions():
+    """
+    :return: list of dicts of the parameter sets with their number of rows, the rows made before the
+    versioning are counted under a None hash
+    """
+    counts = dict(db.session.query(ImageDatabase.Parameter_hash, db.func.count()).group_by(
+        ImageDatabase.Parameter_hash))
+    result = [OrderedDict([('version', row.Version), ('params', row.Parameter_hash),
+                           ('rows', counts.pop(row.Parameter_hash, 0)), ('created', row.Created),
+                           ('parameters', row.parameters)])
+              for row in AlgorithmVersion.query.order_by(AlgorithmVersion.Version, AlgorithmVersion.Created)]
+    if counts.get(None):
+        result.append(OrderedDict([('version', None), ('params', None), ('rows', counts[None]), ('created', None),
+                                   ('parameters', None)]))
+    return result
+
+
+def add_missing_columns(table):
+    """
+    Add the nullable columns missing in a table made before they were declared.
+    :param table: the sqlalchemy Table
+    :return: list of the added column names
+    """
+    existing = {column['name'] for column in inspect(db.engine).get_columns(table.name)}
+    added = []
+    for column in table.columns:
+        if column.name not in existing and column.nullable:
+            db.session.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+                table.name, column.name, column.type.compile(dialect=db.engine.dialect)))
+            added.append(column.name)
+    db.session.commit()
+    return added
+
+
+def create_indexes():
+    """
+    Create the columns and the indexes of ImageDatabase and the tables missing in a database made before they
+    were declared, and count the filter choices again.
+    :return: list of the created index names
+    """
+    table = ImageDatabase.__table__
+    add_missing_columns(table)
+    existing = {index['name'] for index in inspect(db.engine).get_indexes(table.name)}
+    created = []
+    for index in sorted(table.indexes, key=lambda i: i.name):
+        if index.name not in existing:
+            index.create(db.engine)
+            created.append(index.name)
+    FilterChoice.__table__.create(db.engine, checkfirst=True)
+    AlgorithmVersion.__table__.create(db.engine, checkfirst=True)
+    Baseline.__table__.create(db.engine, checkfirst=True)
+    add_missing_columns(Baseline.__table__)
+    FilterChoice.rebuild()
+    return created
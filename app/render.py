@@ -0,0 +1,63 @@
+import hashlib
+
+
+class RenderService:
+    """
+    The app wide Renderer for stored images, created on first use so matplotlib is only imported
+    by processes which render. Previews are keyed by Uid, pixel data, window and size, plots by Uid,
+    profile and size.
+    """
+    def __init__(self, app=None):
+        self.Renderer = None
+        self.Cache_Dir = None
+        self.Memory_Items = 256
+        self.Sizes = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.Cache_Dir = app.config.get('RENDER_CACHE_DIR')
+        self.Memory_Items = app.config.get('RENDER_CACHE_ITEMS', 256)
+        self.Sizes = app.config.get('RENDER_THUMBNAIL_SIZES', {})
+        self.Renderer = None
+
+    def renderer(self):
+        if self.Renderer is None:
+            from .main.algorithm.Renderer import Renderer
+            self.Renderer = Renderer(self.Cache_Dir, self.Memory_Items)
+        return self.Renderer
+
+    def size(self, name):
+        """
+        :param name: a thumbnail size name of RENDER_THUMBNAIL_SIZES, None for the full size
+        :return: the size in pixel or None, KeyError for an unknown name
+        """
+        return None if name is None else self.Sizes[name]
+
+    def preview(self, image, store, window=None, size=None):
+        """
+        :param image: an ImageDatabase row with Pixel_hash
+        :param store: the PixelStore
+        :param window: (window width, window center), None for the window of the image
+        :param size: a thumbnail size name, None for the full size
+        :return: (cache key, PNG bytes, render time)
+        """
+        renderer = self.renderer()
+        window = window or (image.Window_width, image.Window_center)
+        key = renderer.key('preview', image.Uid, image.Pixel_hash, tuple(window), size)
+        data, mtime = renderer.get(key, lambda: renderer.render_preview(image.image_hu(store), window,
+                                                                        self.size(size)))
+        return key, data, mtime
+
+    def plot(self, image, size=None):
+        """
+        :param image: an ImageDatabase row
+        :param size: a thumbnail size name, None for the full size
+        :return: (cache key, PNG bytes, render time)
+        """
+        renderer = self.renderer()
+        # the profile changes when it is rescored
+        profile_hash = hashlib.sha1(image.Integration_result).hexdigest()
+        key = renderer.key('plot', image.Uid, profile_hash, size)
+        data, mtime = renderer.get(key, lambda: renderer.render_plot(image.profile, self.size(size)))
+        return key, data, mtime
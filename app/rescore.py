@@ -0,0 +1,57 @@
+import logging
+from collections import defaultdict
+import numpy as np
+from sqlalchemy import select, bindparam
+
+from . import db
+from .models import ImageDatabase, AlgorithmVersion
+from .main.algorithm.ImageHandler import ImageHandler
+
+
+def rescore_profiles(window=6, factor=3, chunk_size=2000):
+    """
+    Filter the stored Integration_raw again with new median settings and update Integration_result.
+    Each chunk of rows is grouped by profile length and every group is filtered in one
+    median_filter() call. Rows without Integration_raw (migrated from the legacy storage) are skipped.
+    A row keeps its algorithm version, its Parameter_hash is changed to the one of the new median settings,
+    a row made before the versioning stays without one. The drift scores of the updated rows are cleared,
+    rebuild the baselines after.
+    :param window: width of the median window
+    :param factor: edge correction factor
+    :param chunk_size: number of rows read and updated in one transaction
+    :return: number of updated rows
+    """
+    table = ImageDatabase.__table__
+    query = select([table.c.Uid, table.c.Integration_raw, table.c.Parameter_hash]).where(
+        table.c.Integration_raw.isnot(None))
+    update = table.update().where(table.c.Uid == bindparam('uid')).values(
+        Integration_result=bindparam('profile'), Parameter_hash=bindparam('params'), Drift_score=None)
+    # {old hash: new parameters}
+    parameters = {}
+    for key, old in AlgorithmVersion.lookup().items():
+        parameters[key] = dict(old, median_window=window, median_factor=factor)
+    updated = 0
+    last_uid = None
+    while True:
+        chunk = query if last_uid is None else query.where(table.c.Uid > last_uid)
+        rows = db.session.execute(chunk.order_by(table.c.Uid).limit(chunk_size)).fetchall()
+        if not rows:
+            break
+        last_uid = rows[-1][0]
+
+        groups = defaultdict(list)
+        for uid, raw, key in rows:
+            groups[len(raw)].append((uid, raw, key))
+        values = []
+        for group in groups.values():
+            raw_profiles = np.stack([ImageDatabase.unpack_profile(raw) for _, raw, _ in group])
+            profiles = ImageHandler.median_filter(raw_profiles, window, factor)
+            values.extend(dict(uid=uid, profile=ImageDatabase.pack_profile(profile),
+                               params=AlgorithmVersion.parameter_hash(parameters[key]) if key in parameters else None)
+                          for (uid, _, key), profile in zip(group, profiles))
+        AlgorithmVersion.register([parameters[key] for _, _, key in rows if key in parameters])
+        db.session.execute(update, values)
+        db.session.commit()
+        updated += len(values)
+        logging.info(r"Rescored rows: " + str(updated))
+    return updated
@@ -0,0 +1,91 @@
+import logging
+import pickle
+from flask import current_app
+from sqlalchemy import inspect, MetaData, Table, select
+
+from . import db
+from .models import ImageDatabase
+
+
+def get_pixel_store():
+    """
+    :return: the PixelStore of the current app
+    """
+    from .main.algorithm.PixelStore import PixelStore
+    return PixelStore(current_app.config['PIXEL_STORE_DIR'])
+
+
+def legacy_row(row, store):
+    """
+    Convert a row of the legacy dicoms table, whose Dicom_Save pickles the whole DicomHandler
+    (or {'Header':, 'RawData':}) and whose Integration_result is ';' joined text.
+    :param row: a row of the legacy table
+    :param store: the PixelStore to move the pixel data to
+    :return: a dict of ImageDatabase column values
+    """
+    saved = row['Dicom_Save']
+    if isinstance(saved, bytes):
+        saved = pickle.loads(saved)
+    if isinstance(saved, dict):
+        header = saved['Header']
+        raw_data = saved['RawData']
+    else:
+        header = saved.header()
+        raw_data = saved.RawData
+    profile = row['Integration_result']
+    if isinstance(profile, str):
+        import numpy as np
+        profile = np.array([float(x) for x in profile.split(';')])
+    else:
+        profile = ImageDatabase.unpack_profile(profile)
+    return ImageDatabase.make_row(row['Uid'], header, profile,
+                                  pixel_hash=store.put(raw_data), comment=row['Comment'])
+
+
+def migrate_storage(store, chunk_size=200, vacuum=True):
+    """
+    Migrate a legacy database to the compact storage.
+    The legacy table is renamed to dicoms_legacy and a new dicoms table is created.
+    Each chunk of rows is inserted into the new table and deleted from the legacy table in one
+    transaction, so an interrupted migration resumes where it stopped.
+    :param store: the PixelStore to move the pixel data to
+    :param chunk_size: number of rows converted in one transaction
+    :param vacuum: run VACUUM on SQLite to give the space back
+    :return: number of migrated rows
+    """
+    table = ImageDatabase.__table__
+    legacy_name = table.name + '_legacy'
+    inspector = inspect(db.engine)
+    table_names = inspector.get_table_names()
+    if legacy_name not in table_names:
+        if table.name not in table_names or \
+                'Pixel_hash' in [c['name'] for c in inspector.get_columns(table.name)]:
+            logging.info(r"Database is already in compact storage.")
+            return 0
+        # index names are global on SQLite, free them for the new table
+        for index in inspector.get_indexes(table.name):
+            db.session.execute('DROP INDEX ' + index['name'])
+        db.session.execute('ALTER TABLE %s RENAME TO %s' % (table.name, legacy_name))
+        db.session.commit()
+    db.create_all()
+
+    from .main.ingest import BatchWriter
+    legacy = Table(legacy_name, MetaData(), autoload=True, autoload_with=db.engine)
+    migrated = 0
+    while True:
+        rows = db.session.execute(select([legacy]).order_by(legacy.c.Uid).limit(chunk_size)).fetchall()
+        if not rows:
+            break
+        # a Uid ingested again since the rename is kept as it is
+        db.session.execute(BatchWriter.insert(table), [legacy_row(row, store) for row in rows])
+        db.session.execute(legacy.delete().where(legacy.c.Uid.in_([row['Uid'] for row in rows])))
+        db.session.commit()
+        migrated += len(rows)
+        logging.info(r"Migrated rows: " + str(migrated))
+
+    db.session.execute('DROP TABLE ' + legacy_name)
+    db.session.commit()
+    if vacuum and db.engine.dialect.name == 'sqlite':
+        db.session.remove()
+        db.engine.execute('VACUUM')
+    return migrated
@@ -0,0 +1,365 @@
+import logging
+import struct
+import zlib
+
+
+class UploadError(ValueError):
+    """The upload body can not be parsed."""
+
+
+class PushbackReader:
+    """
+    A read-only file object over a stream, where data read too far can be pushed back.
+    """
+    def __init__(self, stream, chunk_size=65536):
+        self.Stream = stream
+        self.Chunk_Size = chunk_size
+        self.Buffer = b''
+
+    def read(self, size=-1):
+        """
+        :param size: number of bytes, -1 for everything left
+        :return: up to size bytes, b'' at the end of the stream
+        """
+        if self.Buffer:
+            if size < 0 or size >= len(self.Buffer):
+                data = self.Buffer
+                self.Buffer = b''
+                if size < 0:
+                    return data + self.Stream.read()
+                return data
+            data = self.Buffer[:size]
+            self.Buffer = self.Buffer[size:]
+            return data
+        return self.Stream.read(size if size >= 0 else -1)
+
+    def read_upto(self, size):
+        """
+        :return: size bytes, fewer only at the end of the stream, a stream may return less on one read
+        """
+        parts = []
+        left = size
+        while left > 0:
+            data = self.read(min(left, self.Chunk_Size))
+            if not data:
+                break
+            parts.append(data)
+            left -= len(data)
+        return b''.join(parts)
+
+    def read_exact(self, size):
+        """
+        :raise UploadError: the stream ends before size bytes
+        """
+        parts = []
+        left = size
+        while left > 0:
+            data = self.read(min(left, self.Chunk_Size))
+            if not data:
+                raise UploadError(r"Unexpected end of the upload")
+            parts.append(data)
+            left -= len(data)
+        return b''.join(parts)
+
+    def skip(self, size):
+        while size > 0:
+            data = self.read(min(size, self.Chunk_Size))
+            if not data:
+                raise UploadError(r"Unexpected end of the upload")
+            size -= len(data)
+
+    def unread(self, data):
+        self.Buffer = data + self.Buffer
+
+
+class PartReader:
+    """
+    The body of one part of a multipart/form-data stream, ends before the next boundary.
+    """
+    def __init__(self, reader, delimiter):
+        """
+        :param reader: the PushbackReader positioned at the start of the body
+        :param delimiter: b'\\r\\n--' + boundary
+        """
+        self.Reader = reader
+        self.Delimiter = delimiter
+        self.Done = False
+
+    def read(self, size=-1):
+        if self.Done:
+            return b''
+        if size < 0:
+            return b''.join(iter(lambda: self.read(self.Reader.Chunk_Size), b''))
+        # enough data to tell a delimiter across the chunk end
+        data = self.Reader.read(size + len(self.Delimiter))
+        while len(data) < size + len(self.Delimiter):
+            more = self.Reader.read(size + len(self.Delimiter) - len(data))
+            if not more:
+                break
+            data += more
+        index = data.find(self.Delimiter)
+        if index >= 0:
+            self.Reader.unread(data[index + len(self.Delimiter):])
+            self.Done = True
+            return data[:index]
+        if len(data) <= size:
+            raise UploadError(r"Multipart body ends without the closing boundary")
+        self.Reader.unread(data[size:])
+        return data[:size]
+
+    def drain(self):
+        while self.read(self.Reader.Chunk_Size):
+            pass
+
+
+def content_disposition_filename(headers):
+    """
+    :param headers: dict of the lower case part header names and values
+    :return: the filename parameter of Content-Disposition, None if it is not a file
+    """
+    for item in headers.get('content-disposition', '').split(';')[1:]:
+        name, _, value = item.strip().partition('=')
+        if name.lower() == 'filename':
+            return value.strip().strip('"')
+    return None
+
+
+def iter_multipart(stream, boundary, max_header_size=16384):
+    """
+    Stream the file parts of a multipart/form-data body, nothing is spooled to disk.
+    Each part must be read (or is skipped) before the next one is yielded.
+    :param stream: the request body
+    :param boundary: the boundary parameter of the Content-Type
+    :param max_header_size: max size of the headers of one part
+    :return: a generator of (filename, PartReader)
+    """
+    reader = PushbackReader(stream)
+    delimiter = b'\r\n--' + boundary.encode('latin-1')
+    # the 1st boundary has no CRLF before it
+    reader.unread(b'\r\n')
+    PartReader(reader, delimiter).drain()
+    while True:
+        ending = reader.read_exact(2)
+        if ending == b'--':
+            return
+        if ending != b'\r\n':
+            raise UploadError(r"Malformed multipart boundary")
+        header_data = b''
+        while b'\r\n\r\n' not in header_data:
+            more = reader.read(1024)
+            if not more or len(header_data) > max_header_size:
+                raise UploadError(r"Malformed multipart headers")
+            header_data += more
+        header_data, _, rest = header_data.partition(b'\r\n\r\n')
+        reader.unread(rest)
+        headers = {}
+        for line in header_data.decode('utf-8', 'replace').split('\r\n'):
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        part = PartReader(reader, delimiter)
+        filename = content_disposition_filename(headers)
+        if filename:
+            yield filename, part
+        part.drain()
+
+
+Local_Header = struct.Struct('<IHHHHHIIIHH')
+Local_Signature = 0x04034b50
+Descriptor_Signature = 0x08074b50
+# central directory, zip64 end of central directory, end of central directory
+End_Signatures = (0x02014b50, 0x06064b50, 0x06054b50)
+
+
+def zip64_field(extra):
+    """
+    :return: the bytes of the zip64 extended information extra field, None if there is none
+    """
+    offset = 0
+    while offset + 4 <= len(extra):
+        header_id, length = struct.unpack_from('<HH', extra, offset)
+        if header_id == 0x0001:
+            return extra[offset + 4:offset + 4 + length]
+        offset += 4 + length
+    return None
+
+
+def iter_zip(stream, max_member_size=64 * 2 ** 20, chunk_size=65536):
+    """
+    Read the members of a zip archive in one pass over the stream, by the local file headers instead of
+    the central directory at the end, so nothing is written to disk and only one member is in memory.
+    Stored and deflated members are supported, deflated ones also with a data descriptor.
+    :param stream: a file object of the archive, it does not need to be seekable
+    :param max_member_size: a bigger member is skipped
+    :param chunk_size: bytes read from the stream at a time
+    :return: a generator of (member name, bytes)
+    :raise UploadError: the archive is corrupted or uses an unsupported feature
+    """
+    reader = PushbackReader(stream, chunk_size)
+    while True:
+        data = reader.read_upto(4)
+        if not data:
+            return
+        if len(data) < 4:
+            raise UploadError(r"Unexpected end of the upload")
+        signature, = struct.unpack('<I', data)
+        if signature in End_Signatures:
+            return
+        if signature != Local_Signature:
+            raise UploadError(r"Not a zip archive or a corrupted one")
+        fields = Local_Header.unpack(data + reader.read_exact(Local_Header.size - 4))
+        _, _, flags, method, _, _, crc, compressed_size, size, name_length, extra_length = fields
+        name = reader.read_exact(name_length).decode('utf-8' if flags & 0x800 else 'cp437')
+        zip64 = zip64_field(reader.read_exact(extra_length))
+        has_descriptor = bool(flags & 0x08)
+        if flags & 0x01:
+            raise UploadError(r"Encrypted zip member: " + name)
+        if method not in (0, 8) or (method == 0 and has_descriptor):
+            # a stored member of unknown size can not be told from the next one
+            raise UploadError(r"Unsupported compression of zip member: " + name)
+        if zip64 is not None and not has_descriptor:
+            values = list(struct.unpack('<%dQ' % (len(zip64) // 8), zip64[:len(zip64) // 8 * 8]))
+            if size == 0xffffffff and values:
+                size = values.pop(0)
+            if compressed_size == 0xffffffff and values:
+                compressed_size = values.pop(0)
+
+        content = read_member(reader, method, None if has_descriptor else compressed_size, max_member_size)
+        if has_descriptor:
+            crc, size = read_descriptor(reader, zip64 is not None)
+        if name.endswith('/'):
+            continue
+        if content is None:
+            logging.warning(name + r": the zip member is bigger than %d bytes, skipped" % max_member_size)
+            continue
+        if len(content) != size or zlib.crc32(content) & 0xffffffff != crc:
+            logging.error(name + r": the zip member is corrupted, skipped")
+            continue
+        yield name, content
+
+
+def read_member(reader, method, compressed_size, max_member_size):
+    """
+    :param reader: the PushbackReader at the start of the member data
+    :param method: 0 stored, 8 deflated
+    :param compressed_size: None if it is only known by the data descriptor, deflated members only
+    :param max_member_size: the data of a bigger member is dropped while it is read
+    :return: the uncompressed bytes, None if the member is bigger than max_member_size
+    """
+    decompressor = zlib.decompressobj(-15) if method == 8 else None
+    parts = []
+    total = 0
+    left = compressed_size
+    while left is None or left > 0:
+        data = reader.read(reader.Chunk_Size if left is None else min(left, reader.Chunk_Size))
+        if not data:
+            raise UploadError(r"Unexpected end of the zip archive")
+        if left is not None:
+            left -= len(data)
+        pieces = [data] if decompressor is None else inflate(decompressor, data, reader.Chunk_Size)
+        for piece in pieces:
+            total += len(piece)
+            if total > max_member_size:
+                # keep reading to find the next member, without keeping the data
+                parts = None
+            elif parts is not None:
+                parts.append(piece)
+        if decompressor is not None and decompressor.eof:
+            # the rest of the chunk is the next member or the data descriptor
+            reader.unread(decompressor.unused_data)
+            if left:
+                raise UploadError(r"Corrupted deflate data in the zip archive")
+            break
+    else:
+        if decompressor is not None and not decompressor.eof:
+            raise UploadError(r"Corrupted deflate data in the zip archive")
+    return b''.join(parts) if parts is not None else None
+
+
+def inflate(decompressor, data, max_length):
+    """
+    :return: a generator of the uncompressed pieces of data, each one at most max_length bytes,
+    so a highly compressed chunk never inflates in memory at once
+    """
+    while not decompressor.eof:
+        piece = decompressor.decompress(data, max_length)
+        yield piece
+        data = decompressor.unconsumed_tail
+        # a full piece may leave output in the decompressor after the input is consumed
+        if not data and len(piece) < max_length:
+            break
+
+
+def read_descriptor(reader, is_zip64):
+    """
+    :return: (crc, uncompressed size) of the data descriptor after a member
+    """
+    data = reader.read_exact(4)
+    if struct.unpack('<I', data)[0] != Descriptor_Signature:
+        # the signature of the data descriptor is optional
+        reader.unread(data)
+    if is_zip64:
+        crc, _, size = struct.unpack('<IQQ', reader.read_exact(20))
+    else:
+        crc, _, size = struct.unpack('<III', reader.read_exact(12))
+    return crc, size
+
+
+def read_file(stream, max_size, chunk_size=65536):
+    """
+    :return: the whole content of stream, None if it is bigger than max_size (it is read to the end anyway)
+    """
+    parts = []
+    total = 0
+    for data in iter(lambda: stream.read(chunk_size), b''):
+        total += len(data)
+        if total > max_size:
+            parts = None
+        elif parts is not None:
+            parts.append(data)
+    return b''.join(parts) if parts is not None else None
+
+
+Zip_Types = ('application/zip', 'application/x-zip-compressed')
+
+
+def iter_file(name, stream, max_size):
+    """
+    A zip archive (told by its magic number, not its name) or a single file.
+    :return: a generator of (name, bytes)
+    """
+    reader = PushbackReader(stream)
+    head = reader.read_upto(4)
+    reader.unread(head)
+    if head == struct.pack('<I', Local_Signature):
+        for member, content in iter_zip(reader, max_size):
+            yield name + '/' + member, content
+        return
+    content = read_file(reader, max_size)
+    if content is None:
+        logging.warning(name + r": the file is bigger than %d bytes, skipped" % max_size)
+        return
+    yield name, content
+
+
+def iter_upload(stream, mimetype, params, filename='upload', max_size=64 * 2 ** 20):
+    """
+    Stream the files of an upload request body, one at a time, without spooling it to disk.
+    :param stream: the request body, request.stream, request.files or request.form must not be used
+    :param mimetype: the Content-Type of the request without parameters
+    :param params: the Content-Type parameters, the boundary of multipart/form-data
+    :param filename: the name of a body which is a single file or a zip archive
+    :param max_size: max size of one file, or of one zip member, a bigger one is skipped
+    :return: a generator of (name, bytes): every file of a multipart/form-data body, every member of a
+    zip archive, or the single file of any other body
+    :raise UploadError: the body can not be parsed
+    """
+    if mimetype == 'multipart/form-data':
+        if not params.get('boundary'):
+            raise UploadError(r"No multipart boundary")
+        for name, part in iter_multipart(stream, params['boundary']):
+            yield from iter_file(name, part, max_size)
+    elif mimetype in Zip_Types:
+        for member, content in iter_zip(stream, max_size):
+            yield filename + '/' + member, content
+    else:
+        yield from iter_file(filename, stream, max_size)
@@ -0,0 +1,327 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import time
+
+from .main.ingest import DicomIngest
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+Event_Header = struct.Struct('iIII')
+
+
+class InotifyWatcher:
+    """
+    Report the files created, written or moved into the directory trees by inotify, so an idle tree costs
+    nothing and a new file is seen at once. A new sub directory is watched and listed as soon as it appears,
+    the files written into it before its watch is added are not missed.
+    The kernel calls are made by ctypes, there is no dependency.
+    """
+    Mask = IN_CLOSE_WRITE | IN_MODIFY | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+    def __init__(self, roots):
+        """
+        :param roots: the absolute directories to watch
+        :raise OSError: inotify is not available, or the watch limit is reached (fs.inotify.max_user_watches)
+        """
+        self.Libc = self.libc()
+        self.Fd = self.Libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.Fd < 0:
+            raise OSError(ctypes.get_errno(), r"inotify_init1 failed")
+        # {watch descriptor: directory}
+        self.Directories = {}
+        self.Pending = set()
+        try:
+            for root in roots:
+                self.add_tree(root, report=False)
+        except OSError:
+            self.close()
+            raise
+
+    @staticmethod
+    def libc():
+        name = ctypes.util.find_library('c')
+        libc = ctypes.CDLL(name or 'libc.so.6', use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, r"inotify is not available")
+        libc.inotify_add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        return libc
+
+    def add_tree(self, directory, report=True):
+        """
+        Watch the directory and all its sub directories.
+        :param report: report the files already in them as new
+        """
+        pending = [directory]
+        while pending:
+            current = pending.pop()
+            wd = self.Libc.inotify_add_watch(self.Fd, os.fsencode(current), self.Mask)
+            if wd < 0:
+                error = ctypes.get_errno()
+                if error in (errno.ENOENT, errno.ENOTDIR):
+                    # removed meanwhile
+                    continue
+                raise OSError(error, os.strerror(error), current)
+            self.Directories[wd] = current
+            try:
+                with os.scandir(current) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            pending.append(entry.path)
+                        elif report and entry.is_file():
+                            self.Pending.add(entry.path)
+            except OSError as e:
+                logging.error(str(e))
+
+    def changes(self, timeout):
+        """
+        :param timeout: seconds to wait for a change
+        :return: (set of the changed files, True if events are lost and the trees must be scanned again)
+        """
+        rescan = False
+        if not self.Pending and select.select([self.Fd], [], [], timeout)[0] == []:
+            return set(), False
+        while True:
+            try:
+                data = os.read(self.Fd, 65536)
+            except BlockingIOError:
+                break
+            rescan |= self.parse(data)
+        paths = self.Pending
+        self.Pending = set()
+        return paths, rescan
+
+    def parse(self, data):
+        """
+        :return: True if the event queue overflowed
+        """
+        overflow = False
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = Event_Header.unpack_from(data, offset)
+            name = data[offset + Event_Header.size:offset + Event_Header.size + length].rstrip(b'\0')
+            offset += Event_Header.size + length
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+                continue
+            directory = self.Directories.get(wd)
+            if directory is None:
+                continue
+            if mask & (IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF):
+                if mask & IN_IGNORED:
+                    del self.Directories[wd]
+                continue
+            path = os.path.join(directory, os.fsdecode(name))
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self.add_tree(path)
+            else:
+                self.Pending.add(path)
+        return overflow
+
+    def close(self):
+        if self.Fd >= 0:
+            os.close(self.Fd)
+            self.Fd = -1
+
+
+class PollingWatcher:
+    """
+    The fallback without inotify, e.g. on a network share: the directories are stat'ed every poll and
+    only a directory whose mtime changed is listed again, a new file changes the mtime of its directory.
+    The files themselves are not stat'ed, the debouncer does it for the new ones.
+    """
+    def __init__(self, roots, recent=2.0):
+        """
+        :param roots: the absolute directories to watch
+        :param recent: a directory changed less than that many seconds ago is listed on every poll,
+        a file system with a coarse mtime may not tell 2 changes in the same tick apart
+        """
+        self.Recent = recent
+        # {directory: (mtime_ns, set of file names)}
+        self.Directories = {}
+        for root in roots:
+            self.scan(root, report=False)
+
+    def scan(self, directory, report=True):
+        """
+        List the directory and its new sub directories.
+        :return: set of the new files
+        """
+        new = set()
+        pending = [directory]
+        while pending:
+            current = pending.pop()
+            try:
+                mtime_ns = os.stat(current).st_mtime_ns
+                with os.scandir(current) as it:
+                    entries = list(it)
+            except OSError:
+                self.Directories.pop(current, None)
+                continue
+            names = set()
+            known = self.Directories.get(current, (None, set()))[1]
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.path not in self.Directories:
+                            pending.append(entry.path)
+                    elif entry.is_file():
+                        names.add(entry.name)
+                        if report and entry.name not in known:
+                            new.add(entry.path)
+                except OSError as e:
+                    logging.error(str(e))
+            self.Directories[current] = (mtime_ns, names)
+        return new
+
+    def changes(self, timeout):
+        """
+        :param timeout: seconds to wait before the poll
+        :return: (set of the new files, False)
+        """
+        time.sleep(timeout)
+        now = time.time_ns() if hasattr(time, 'time_ns') else int(time.time() * 1e9)
+        new = set()
+        for directory, (mtime_ns, _) in list(self.Directories.items()):
+            try:
+                current = os.stat(directory).st_mtime_ns
+            except OSError:
+                del self.Directories[directory]
+                continue
+            if current != mtime_ns or now - current < self.Recent * 1e9:
+                new |= self.scan(directory)
+        return new, False
+
+    def close(self):
+        pass
+
+
+class Debouncer:
+    """
+    Hold the new files until they stop changing: a scanner or a copy writes a file in several steps,
+    a file is ready once its size and mtime are the same for settle seconds.
+    """
+    def __init__(self, settle=2.0):
+        self.Settle = settle
+        # {path: ((size, mtime_ns), time of the last change)}
+        self.Pending = {}
+
+    def touch(self, path, now=None):
+        self.Pending[path] = (None, time.monotonic() if now is None else now)
+
+    def ready(self, now=None):
+        """
+        :return: list of the files which did not change for settle seconds, sorted, they are not pending any more
+        """
+        now = time.monotonic() if now is None else now
+        ready = []
+        for path, (signature, since) in list(self.Pending.items()):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # removed or renamed, the new name has its own event
+                del self.Pending[path]
+                continue
+            current = (stat.st_size, stat.st_mtime_ns)
+            if current != signature:
+                self.Pending[path] = (current, now)
+            elif now - since >= self.Settle:
+                del self.Pending[path]
+                ready.append(path)
+        return sorted(ready)
+
+    def __len__(self):
+        return len(self.Pending)
+
+
+def make_watcher(roots, polling=False):
+    """
+    :param polling: do not try inotify
+    :return: an InotifyWatcher, or a PollingWatcher if inotify is not available
+    """
+    if not polling:
+        try:
+            return InotifyWatcher(roots)
+        except OSError as e:
+            logging.warning(r"inotify is not available, polling the directories: " + str(e))
+    return PollingWatcher(roots)
+
+
+def root_of(path, roots):
+    """
+    :return: the root the path is under, the longest one if they are nested
+    """
+    matches = [root for root in roots if path.startswith(os.path.join(root, ''))]
+    return max(matches, key=len) if matches else None
+
+
+def watch_folders(roots, settle=2.0, poll_interval=1.0, workers=None, batch_size=None, polling=False,
+                  catch_up=True, stop=None, report=None):
+    """
+    Ingest the new files of the directory trees as they arrive, until stop() returns True.
+    The files already there are ingested first (catch_up), unchanged ones are skipped by the FileManifest
+    without being opened. After that only the new files are ingested, as soon as they are complete.
+    :param roots: the directories to watch
+    :param settle: seconds a new file must not change before it is ingested
+    :param poll_interval: max seconds between 2 checks of the pending files, and between 2 polls
+    :param workers: number of worker processes of each ingest, default is INGEST_WORKERS
+    :param batch_size: number of rows written in one transaction, default is INGEST_BATCH_SIZE
+    :param polling: poll the directories instead of inotify
+    :param catch_up: ingest the files already in the directories first
+    :param stop: a callable, the daemon stops when it returns True
+    :param report: optional callable(DicomIngest), called after each ingest
+    :return: the totals as a dict of processed, inserted, duplicated, unchanged, failed, drifted and ingests
+    """
+    roots = [os.path.abspath(root) for root in roots]
+    stop = stop or (lambda: False)
+    totals = dict.fromkeys(('processed', 'inserted', 'duplicated', 'unchanged', 'failed', 'drifted', 'ingests'), 0)
+
+    def ingest(root, paths=None):
+        run = DicomIngest(root, workers=workers, batch_size=batch_size, keep_log=False, paths=paths)
+        for _ in run.run(stop=stop):
+            pass
+        for name in ('processed', 'inserted', 'duplicated', 'unchanged', 'failed', 'drifted'):
+            totals[name] += getattr(run, name.capitalize())
+        totals['ingests'] += 1
+        if report is not None:
+            report(run)
+
+    # watch first, so nothing written during the catch up is missed
+    watcher = make_watcher(roots, polling)
+    debouncer = Debouncer(settle)
+    try:
+        rescan = catch_up
+        while not stop():
+            if rescan:
+                for root in roots:
+                    ingest(root)
+            paths, rescan = watcher.changes(min(poll_interval, settle) if len(debouncer) else poll_interval)
+            for path in paths:
+                debouncer.touch(path)
+            by_root = {}
+            for path in debouncer.ready():
+                root = root_of(path, roots)
+                if root is not None:
+                    by_root.setdefault(root, []).append(path)
+            for root, files in by_root.items():
+                ingest(root, files)
+    finally:
+        watcher.close()
+    return totals
@@ -0,0 +1,77 @@
+"""
+Benchmark of the fleet-wide drift report over a synthetic fleet.
+
+The profiles are built in memory as the stored Integration_result bytes, so the time to build the
+ProfileMatrix (the part of the loading after the database) is reported apart from the report itself.
+
+    python benchmarks/bench_drift.py --profiles 100000 --output drift.json
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from app.drift import ProfileMatrix, drift_report
+from app.main.algorithm.DriftDetector import DriftDetector, RunningProfile
+
+
+def make_fleet(profiles, scanners, modes, length, seed=0):
+    """
+    :return: (ProfileMatrix, dict of baselines as BaselineCache.get() returns them)
+    """
+    random = np.random.RandomState(seed)
+    keys = [(serial, 'mode%d' % mode) for serial in range(scanners) for mode in range(modes)]
+    shapes = random.normal(0, 2, (len(keys), length))
+    key_index = random.randint(0, len(keys), profiles)
+    data = (shapes[key_index] + random.normal(0, 1, (profiles, length))).astype(np.float32)
+    # a few drifted profiles
+    data[random.randint(0, profiles, profiles // 1000), length // 2] += 20
+    baselines = {}
+    for i, key in enumerate(keys):
+        running = RunningProfile()
+        running.add(data[key_index == i])
+        baselines[key] = (running.Count, running.Mean.astype(np.float32), running.std.astype(np.float32))
+    started = time.perf_counter()
+    matrix = ProfileMatrix(['%08d' % i for i in range(profiles)], [keys[i] for i in key_index],
+                           ['20170601%06d' % (i % 240000) for i in range(profiles)], [row.tobytes() for row in data])
+    return matrix, baselines, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--profiles', type=int, default=100000, help='number of profiles')
+    parser.add_argument('--scanners', type=int, default=50, help='number of scanners')
+    parser.add_argument('--modes', type=int, default=40, help='number of scan modes of every scanner')
+    parser.add_argument('--length', type=int, default=250, help='profile length')
+    parser.add_argument('--repeat', type=int, default=5, help='runs of the report')
+    parser.add_argument('--output', default=None, help='JSON file to save the result')
+    args = parser.parse_args()
+
+    matrix, baselines, build = make_fleet(args.profiles, args.scanners, args.modes, args.length)
+    detector = DriftDetector()
+    times = []
+    for _ in range(args.repeat):
+        started = time.perf_counter()
+        report = drift_report(matrix, baselines, detector)
+        times.append(time.perf_counter() - started)
+    times.sort()
+    result = OrderedDict(created=time.strftime('%Y-%m-%dT%H:%M:%S'), python=platform.python_version(),
+                         numpy=np.__version__, platform=platform.platform(), profiles=args.profiles,
+                         scan_modes=len(matrix.Keys), length=args.length, matrix_seconds=round(build, 3),
+                         report_min_seconds=round(times[0], 3), report_median_seconds=round(times[len(times) // 2], 3),
+                         flagged=report['flagged'])
+    print('%d profiles, %d scan modes: matrix %.3fs, report min %.3fs median %.3fs, %d flagged' % (
+        args.profiles, len(matrix.Keys), build, times[0], times[len(times) // 2], report['flagged']))
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(result, fp, indent=2)
+
+
+if __name__ == '__main__':
+    main()
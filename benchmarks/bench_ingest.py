@@ -0,0 +1,198 @@
+"""
+Benchmark of the ingest stages on synthetic Band Assessment phantoms.
+
+Each scale is a directory of N files, hard links to a pool of distinct phantoms, and every stage
+is timed separately: discovery, parsing, scoring (a whole ImageHandler), center detection,
+ring integration, median filtering and the DB insert. The results are saved as JSON, a previous
+result can be compared against to catch regressions.
+
+    python benchmarks/bench_ingest.py --scales 1,10,100,1000 --output bench.json
+    python benchmarks/bench_ingest.py --scales 1,10,100,1000,10000 --compare bench.json
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from config import config, TestingConfig
+from app import create_app, db
+from app.models import ImageDatabase
+from app.main.ingest import BatchWriter
+from app.main.algorithm.DirectoryHandler import DirectoryHandler
+from app.main.algorithm.DicomHanlder import DicomHandler
+from app.main.algorithm.ImageHandler import ImageHandler
+from app.main.algorithm.RingIntegrator import RingIntegrator
+from app.main.algorithm.PhantomGenerator import PhantomGenerator
+
+Stages = ('discovery', 'parsing', 'scoring', 'center_detection', 'ring_integration', 'median_filter',
+          'db_insert')
+# ImageHandler.calc_radius() fixes the ring radius at 233 px (or 220 px) whatever the image size,
+# make_pool() moves the phantoms up to 2 px off the center, a smaller image fails every file
+Legacy_Radius = 233
+Max_Offset = 2
+Min_Size = 2 * (Legacy_Radius + Max_Offset)
+
+
+class Timer:
+    def __init__(self):
+        self.Total = OrderedDict((stage, 0.0) for stage in Stages)
+
+    def time(self, stage, function, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        self.Total[stage] += time.perf_counter() - start
+        return result
+
+
+def make_pool(directory, count, size):
+    """
+    Write the distinct phantoms once, with offsets, rings and noise varying between files.
+    """
+    pool = os.path.join(directory, 'pool')
+    if os.path.isdir(pool) and len(os.listdir(pool)) >= count:
+        return sorted(os.path.join(pool, f) for f in os.listdir(pool))[:count]
+    os.makedirs(pool, exist_ok=True)
+    files = []
+    for index in range(count):
+        generator = PhantomGenerator(size=size, offset=(index % 5 - Max_Offset, index % 3 - 1),
+                                     rings=[(40 + index % 150, 5.0, 1.5)], seed=index)
+        files.append(generator.write(os.path.join(pool, 'IM%05d.dcm' % index), instance=index + 1))
+    return files
+
+
+def make_scale(directory, pool, scale):
+    """
+    A directory of scale files, hard links (or copies) of the pool.
+    """
+    target = os.path.join(directory, 'scale%d' % scale)
+    if os.path.isdir(target) and len(os.listdir(target)) == scale:
+        return target
+    shutil.rmtree(target, ignore_errors=True)
+    os.makedirs(target)
+    for index in range(scale):
+        source = pool[index % len(pool)]
+        destination = os.path.join(target, 'IM%05d.dcm' % index)
+        try:
+            os.link(source, destination)
+        except OSError:
+            shutil.copyfile(source, destination)
+    return target
+
+
+def run_scale(directory, batch_size):
+    """
+    :return: (number of files, number of scored files, {stage: seconds})
+    """
+    timer = Timer()
+    handler = timer.time('discovery', DirectoryHandler, directory)
+    writer = BatchWriter(batch_size=batch_size)
+    scored = 0
+    for index, filename in enumerate(handler.Dicom_File_Path):
+        dcm = timer.time('parsing', DicomHandler, filename)
+        image = timer.time('scoring', ImageHandler, dcm)
+        if not image.isImageComplete:
+            continue
+        scored += 1
+        # the stages again on their own, on the scored image
+        timer.time('center_detection', image.calc_circle, image.Image_HU)
+        ring = RingIntegrator.get(dcm.Rows, dcm.Cols, tuple(image.Center), image.Radius[0])
+        timer.time('ring_integration', ring.integrate, image.Image_HU)
+        timer.time('median_filter', ImageHandler.median_filter, image.Image_Integration_Result)
+        # hard links share the Uid, keep every row
+        row = ImageDatabase.make_row(dcm.Uid + '-%d' % index, dcm.header(), image.Image_Median_Filter_Result,
+                                     raw_profile=image.Image_Integration_Result)
+        timer.time('db_insert', writer.add_image, row)
+    timer.time('db_insert', writer.flush)
+    return handler.Total_Dicom_Quantity, scored, timer.Total
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(result, previous, tolerance, min_delta_ms=0.1):
+    """
+    :param min_delta_ms: a smaller difference per file is noise
+    :return: list of (scale, stage, previous per file, current per file) slower than tolerance
+    """
+    old = {(r['scale'], stage): value['per_file_ms']
+           for r in previous['results'] for stage, value in r['stages'].items()}
+    slower = []
+    for r in result['results']:
+        for stage, value in r['stages'].items():
+            before = old.get((r['scale'], stage))
+            if before and value['per_file_ms'] > max(before * tolerance, before + min_delta_ms):
+                slower.append((r['scale'], stage, before, value['per_file_ms']))
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', default='1,10,100,1000', help='comma separated numbers of files')
+    parser.add_argument('--size', type=int, default=512, help='rows and cols of the phantoms')
+    parser.add_argument('--distinct', type=int, default=100, help='number of distinct phantom files')
+    parser.add_argument('--batch-size', type=int, default=500, help='rows per DB transaction')
+    parser.add_argument('--workdir', default=None, help='directory of the generated files, kept between runs')
+    parser.add_argument('--output', default=None, help='JSON file to save the result')
+    parser.add_argument('--compare', default=None, help='JSON file of a previous result')
+    parser.add_argument('--tolerance', type=float, default=1.2, help='slower than previous * tolerance fails')
+    args = parser.parse_args()
+    if args.size < Min_Size:
+        parser.error('--size must be at least %d, the ring radius is fixed at %d px' % (Min_Size, Legacy_Radius))
+    logging.disable(logging.WARNING)
+
+    scales = [int(s) for s in args.scales.split(',')]
+    workdir = args.workdir or os.path.join(tempfile.gettempdir(), 'flaskbat-bench-%d' % args.size)
+    pool = make_pool(workdir, min(args.distinct, max(scales)), args.size)
+
+    database = os.path.join(workdir, 'bench.sqlite')
+    config['benchmark'] = type('BenchmarkConfig', (TestingConfig,),
+                               {'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + database})
+    app = create_app('benchmark')
+    result = OrderedDict(created=time.strftime('%Y-%m-%dT%H:%M:%S'), commit=git_commit(),
+                         python=platform.python_version(), numpy=np.__version__, platform=platform.platform(),
+                         size=args.size, distinct=len(pool), results=[])
+    with app.app_context():
+        for scale in scales:
+            db.drop_all()
+            db.create_all()
+            files, scored, total = run_scale(make_scale(workdir, pool, scale), args.batch_size)
+            if scored < files:
+                sys.exit('%d of %d files were not scored, the timings would not be comparable'
+                         % (files - scored, files))
+            stages = OrderedDict((stage, OrderedDict(total_s=round(seconds, 6),
+                                                     per_file_ms=round(seconds * 1000 / max(scored, 1), 4)))
+                                 for stage, seconds in total.items())
+            result['results'].append(OrderedDict(scale=scale, files=files, scored=scored, stages=stages))
+            print('%6d files  ' % files + '  '.join('%s %.2fms' % (stage, value['per_file_ms'])
+                                                    for stage, value in stages.items()))
+        db.session.remove()
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(result, fp, indent=2)
+    if args.compare:
+        with open(args.compare) as fp:
+            slower = compare(result, json.load(fp), args.tolerance)
+        for scale, stage, before, after in slower:
+            print('SLOWER %6d files  %s %.2fms -> %.2fms' % (scale, stage, before, after))
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
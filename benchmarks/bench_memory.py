@@ -0,0 +1,84 @@
+"""
+Benchmark of the peak memory of scoring one slice, in the default and the lean mode.
+
+Each slice is scored as an ingest worker does (read, parse, score), with tracemalloc tracing
+the Python and NumPy allocations. The peak is reported in bytes and as a multiple of the raw
+pixel buffer (Rows * Cols * 2 bytes), along with what is still held by the DicomHandler and
+ImageHandler once they are done.
+
+    python benchmarks/bench_memory.py --sizes 512,1024 --output memory.json
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from app.main.algorithm.DicomHanlder import DicomHandler
+from app.main.algorithm.ImageHandler import ImageHandler
+from app.main.algorithm.PhantomGenerator import PhantomGenerator
+
+
+def score(filename, lean):
+    with open(filename, 'rb') as fp:
+        content = fp.read()
+    dicom = DicomHandler(filename, io.BytesIO(content), lean=lean)
+    del content
+    image = ImageHandler(dicom, lean=lean)
+    assert image.isImageComplete
+    return dicom, image
+
+
+def measure(filename, lean):
+    """
+    :return: (peak bytes while scoring, bytes still held by the handlers)
+    """
+    # warm up the caches (ring geometry, imports) so they are not counted
+    score(filename, lean)
+    tracemalloc.start()
+    try:
+        handlers = score(filename, lean)
+        held, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del handlers
+    return peak, held
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='512', help='comma separated rows and cols of the phantoms')
+    parser.add_argument('--output', default=None, help='JSON file to save the result')
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    result = OrderedDict(created=time.strftime('%Y-%m-%dT%H:%M:%S'), python=platform.python_version(),
+                         numpy=np.__version__, platform=platform.platform(), results=[])
+    with tempfile.TemporaryDirectory() as directory:
+        for size in [int(s) for s in args.sizes.split(',')]:
+            filename = PhantomGenerator(size=size).write(os.path.join(directory, 'phantom%d.dcm' % size))
+            raw = size * size * 2
+            for mode, lean in (('default', False), ('lean', True)):
+                peak, held = measure(filename, lean)
+                result['results'].append(OrderedDict(size=size, mode=mode, raw_bytes=raw, peak_bytes=peak,
+                                                     held_bytes=held, peak_ratio=round(peak / raw, 2),
+                                                     held_ratio=round(held / raw, 2)))
+                print('%5d  %-8s peak %8.1fMB (%5.2f x raw)  held %8.1fMB (%5.2f x raw)' % (
+                    size, mode, peak / 2 ** 20, peak / raw, held / 2 ** 20, held / raw))
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(result, fp, indent=2)
+
+
+if __name__ == '__main__':
+    main()
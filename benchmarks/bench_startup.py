@@ -0,0 +1,111 @@
+"""
+Benchmark of the cold start of the web app and of the manage.py commands.
+
+Every scenario runs in a new interpreter. The time from the first import to the app being ready
+(or the command being done) is measured inside the process, the wall time of the whole process
+includes the interpreter start. The heavy modules loaded by then are listed: none of them should
+be imported before an ingest or a render needs them.
+
+    python benchmarks/bench_startup.py --repeat 10 --output startup.json
+    python benchmarks/bench_startup.py --compare startup.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+
+Root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+Heavy_Modules = ('numpy', 'matplotlib', 'PIL.Image', 'dicom', 'alembic')
+
+Measure = """
+import json, sys, time
+start = time.perf_counter()
+%s
+print(json.dumps(dict(seconds=time.perf_counter() - start,
+                      modules=[m for m in %r if m in sys.modules])))
+"""
+
+Scenarios = OrderedDict([
+    # the interpreter alone, to tell it from the app
+    ('interpreter', "pass"),
+    # what a gunicorn worker does before its first request
+    ('web_import', "import wsgi"),
+    ('web_first_request', "import wsgi\nwsgi.app.test_client().get('/jobs/none')"),
+    ('cli_help', "import runpy\nsys.argv = ['manage.py', '--help']\n"
+                 "try:\n    runpy.run_path('manage.py', run_name='__main__')\nexcept SystemExit:\n    pass"),
+])
+
+
+def run_scenario(code):
+    """
+    :return: (seconds in the process, seconds of the whole process, list of the heavy modules loaded)
+    """
+    environment = dict(os.environ, FLASK_CONFIG='testing')
+    start = time.perf_counter()
+    output = subprocess.check_output([sys.executable, '-c', Measure % (code, Heavy_Modules)], cwd=Root,
+                                     env=environment, stderr=subprocess.DEVNULL)
+    wall = time.perf_counter() - start
+    result = json.loads(output.decode().strip().splitlines()[-1])
+    return result['seconds'], wall, result['modules']
+
+
+def compare(result, previous, tolerance, min_delta_ms=5):
+    """
+    :param min_delta_ms: a smaller difference is noise
+    :return: list of (scenario, previous median, current median) slower than tolerance
+    """
+    old = {name: value['median_ms'] for name, value in previous['scenarios'].items()}
+    slower = []
+    for name, value in result['scenarios'].items():
+        before = old.get(name)
+        if before and value['median_ms'] > max(before * tolerance, before + min_delta_ms):
+            slower.append((name, before, value['median_ms']))
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5, help='runs of each scenario')
+    parser.add_argument('--output', default=None, help='JSON file to save the result')
+    parser.add_argument('--compare', default=None, help='JSON file of a previous result')
+    parser.add_argument('--tolerance', type=float, default=1.2, help='slower than previous * tolerance fails')
+    args = parser.parse_args()
+
+    result = OrderedDict(created=time.strftime('%Y-%m-%dT%H:%M:%S'), python=platform.python_version(),
+                         platform=platform.platform(), repeat=args.repeat, scenarios=OrderedDict())
+    for name, code in Scenarios.items():
+        times = []
+        walls = []
+        modules = []
+        for _ in range(args.repeat):
+            seconds, wall, modules = run_scenario(code)
+            times.append(seconds * 1000)
+            walls.append(wall * 1000)
+        times.sort()
+        walls.sort()
+        result['scenarios'][name] = OrderedDict(min_ms=round(times[0], 2),
+                                                median_ms=round(times[len(times) // 2], 2),
+                                                process_median_ms=round(walls[len(walls) // 2], 2),
+                                                heavy_modules=modules)
+        print('%-18s min %7.1fms  median %7.1fms  process %7.1fms  %s' % (
+            name, times[0], times[len(times) // 2], walls[len(walls) // 2], ' '.join(modules) or '-'))
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(result, fp, indent=2)
+    if args.compare:
+        with open(args.compare) as fp:
+            slower = compare(result, json.load(fp), args.tolerance)
+        for name, before, after in slower:
+            print('SLOWER %s %.1fms -> %.1fms' % (name, before, after))
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
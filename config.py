@@ -7,6 +7,61 @@ class Config:
     # set below key to False means you have to run db.session.commit() by your own.
     SQLALCHEMY_COMMIT_ON_TEARDOWN = True
     SQLALCHEMY_TRACK_MODIFICATIONS = True
+    # number of worker processes to parse and score DICOM files, 1 runs in the request thread
+    INGEST_WORKERS = os.cpu_count() or 1
+    # number of files sent to a worker process at a time
+    INGEST_CHUNK_SIZE = 8
+    # number of rows written to the database in one transaction
+    INGEST_BATCH_SIZE = 500
+    # score the slices of a series together, up to INGEST_SERIES_SIZE files of a directory at a time,
+    # with INGEST_SERIES_REFINE the center is detected on every slice instead of once per series
+    INGEST_SERIES_MODE = False
+    INGEST_SERIES_SIZE = 32
+    INGEST_SERIES_REFINE = False
+    # low memory scoring: no pydicom Dataset kept, float32 HU, no display image,
+    # the profiles only differ by the float32 rounding of the HU values
+    INGEST_LEAN_MODE = False
+    # PRAGMA statements for bulk loading, applied to every SQLite connection
+    INGEST_SQLITE_PRAGMAS = ['journal_mode=WAL', 'synchronous=NORMAL']
+    # content-addressed .npy store of the raw pixel data
+    PIXEL_STORE_DIR = os.path.join(basedir, 'pixels')
+    # disk cache of rendered previews and plots, number of them also kept in memory,
+    # and the thumbnail sizes the preview and plot routes accept as ?size=
+    RENDER_CACHE_DIR = os.path.join(basedir, 'render-cache')
+    RENDER_CACHE_ITEMS = 256
+    RENDER_THUMBNAIL_SIZES = {'thumb': 128, 'small': 256, 'medium': 512}
+    # score every new profile against the baseline of its scanner and scan mode while it is ingested,
+    # a baseline scores once it has DRIFT_MIN_COUNT profiles, a score is the max over radius of
+    # |profile - mean| / max(std, DRIFT_STD_FLOOR HU), a profile over DRIFT_THRESHOLD is reported
+    DRIFT_DETECTION = True
+    DRIFT_MIN_COUNT = 10
+    DRIFT_STD_FLOOR = 0.5
+    DRIFT_THRESHOLD = 5.0
+    # max size of one uploaded file or zip member, a bigger one is skipped,
+    # the memory of an upload is bounded by it whatever the size of the whole body
+    UPLOAD_MAX_FILE_SIZE = 64 * 2 ** 20
+    # rows read and converted at a time by an export, the memory of an export is bounded by it,
+    # the Arrow and Parquet formats need pyarrow, which is optional
+    EXPORT_CHUNK_SIZE = 2000
+    # checkpoint files of manage.py ingest
+    INGEST_CHECKPOINT_DIR = os.path.join(basedir, 'checkpoints')
+    # directories ingested continuously by manage.py watch, a new file is ingested once it did not change
+    # for WATCH_SETTLE_SECONDS, WATCH_POLLING polls every WATCH_POLL_INTERVAL seconds instead of inotify
+    WATCH_ROOTS = []
+    WATCH_SETTLE_SECONDS = 2.0
+    WATCH_POLL_INTERVAL = 1.0
+    WATCH_POLLING = False
+    # the new files arrive a few at a time, a process pool would cost more than it saves
+    WATCH_WORKERS = 1
+    # record stage timers and counters of the ingest, exposed by /metrics
+    METRICS_ENABLED = False
+    # capture a cProfile of the main thread of each ingest job into PROFILE_DIR/<job id>.prof
+    INGEST_PROFILE = False
+    PROFILE_DIR = os.path.join(basedir, 'profiles')
+    # number of ingest jobs running at the same time in background threads
+    INGEST_JOB_THREADS = 1
+    # number of finished ingest jobs kept for the status page
+    INGEST_JOB_HISTORY = 100
 
     @staticmethod
     def init_app(app):
@@ -16,11 +71,16 @@ class Config:
 class DevelopmentConfig(Config):
     DEBUG = True
     SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(basedir, 'data-dev.sqlite')
+    PIXEL_STORE_DIR = os.path.join(basedir, 'pixels-dev')
+    RENDER_CACHE_DIR = os.path.join(basedir, 'render-cache-dev')
 
 
 class TestingConfig(Config):
     TESTING = True
+    INGEST_WORKERS = 1
     SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(basedir, 'data-testing.sqlite')
+    PIXEL_STORE_DIR = os.path.join(basedir, 'pixels-testing')
+    RENDER_CACHE_DIR = None
 
 
 class ProductionConfig(Config):
@@ -1,19 +1,242 @@
 import os
+import sys
 from app import create_app, db
-from app.models import ImageDatabase
+from app.models import ImageDatabase, FilterChoice
 from flask_script import Manager, Shell
-from flask_migrate import Migrate, MigrateCommand
 
 app = create_app('default')
 manager = Manager(app)
-migrate = Migrate(app, db)
 
 
 def make_shell_context():
-    return dict(app=app, db=db, ImageDatabase=ImageDatabase)
+    return dict(app=app, db=db, ImageDatabase=ImageDatabase, FilterChoice=FilterChoice)
 
 manager.add_command("shell", Shell(make_context=make_shell_context))
-manager.add_command('db', MigrateCommand)
+# Flask-Migrate imports alembic, it is only loaded for the db commands
+if sys.argv[1:2] == ['db']:
+    from flask_migrate import Migrate, MigrateCommand
+    migrate = Migrate(app, db)
+    manager.add_command('db', MigrateCommand)
+
+
+@manager.command
+def init_db():
+    """Create the missing tables and indexes, run it once before the first start and after an upgrade"""
+    from app.query import create_indexes
+    db.create_all()
+    for name in create_indexes():
+        print('Created index: ' + name)
+
+
+@manager.command
+def compact_storage():
+    """Migrate a legacy database: pixel data to the pixel store, profiles to float32"""
+    from app.storage import get_pixel_store, migrate_storage
+    from app.models import FilterChoice
+    print('Migrated rows: %d' % migrate_storage(get_pixel_store()))
+    print('Filter choices: %d' % FilterChoice.rebuild())
+
+
+@manager.command
+def create_indexes():
+    """Create the missing columns and indexes of an existing database and count the filter choices again"""
+    from app.query import create_indexes
+    for name in create_indexes():
+        print('Created index: ' + name)
+
+
+@manager.option('-w', '--window', dest='window', type=int, default=6, help='width of the median window')
+@manager.option('-f', '--factor', dest='factor', type=float, default=3, help='edge correction factor')
+def rescore(window, factor):
+    """Filter all stored integration results again with new median settings"""
+    from app.rescore import rescore_profiles
+    updated = rescore_profiles(window, factor)
+    print('Rescored rows: %d' % updated)
+    if updated:
+        print('The drift scores of the updated rows are cleared, run rebuild_baselines')
+
+
+@manager.option('-w', '--window', dest='window', type=int, default=6, help='width of the median window')
+@manager.option('-f', '--factor', dest='factor', type=float, default=3, help='edge correction factor')
+@manager.option('-j', '--workers', dest='workers', type=int, default=None, help='number of worker processes')
+def backfill(window, factor, workers):
+    """Score again from the stored pixel data the rows made by another algorithm version or parameters"""
+    import signal
+    import threading
+    from app.backfill import backfill
+    from app.query import algorithm_versions
+
+    stop = threading.Event()
+
+    def request_stop(signum, frame):
+        print('Stopping after the current batch, run the same command again to resume')
+        stop.set()
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    def report(state):
+        print('%d / %d rows  %.1f rows/s  %d updated  %d failed' % (
+            state['processed'], state['total'], state['rows_per_second'], state['updated'], state['failed']))
+
+    state = backfill(window, factor, workers=workers, stop=stop.is_set, report=report)
+    if state['missing']:
+        print('Rows without pixel data, not scored again: %d' % state['missing'])
+    for version in algorithm_versions():
+        print('Version %s  %s: %d rows' % (version['version'], version['params'], version['rows']))
+    if state['updated']:
+        print('The drift scores of the updated rows are cleared, run rebuild_baselines')
+
+
+@manager.command
+def rebuild_baselines():
+    """Build the drift baselines again from the stored profiles which are not flagged"""
+    from app.models import Baseline
+    print('Baselines: %d' % Baseline.rebuild(app.config['DRIFT_THRESHOLD']))
+
+
+@manager.option('-t', '--threshold', dest='threshold', type=float, default=None, help='score which flags a profile')
+@manager.option('-s', '--serial', dest='serial', default=None, help='only this scanner')
+@manager.option('-n', '--top', dest='top', type=int, default=20, help='number of scan modes listed')
+def drift_report(threshold, serial, top):
+    """Report the drift of all stored profiles against the baselines of their scanner and scan mode"""
+    import time
+    from app.drift import ProfileMatrix, baseline_cache, drift_report, make_detector
+    from app.query import parse_filters
+    started = time.perf_counter()
+    matrix = ProfileMatrix.load(**parse_filters(dict(serial=serial)))
+    baselines = baseline_cache.get()
+    loaded = time.perf_counter()
+    report = drift_report(matrix, baselines, make_detector(threshold))
+    print('Images: %d  scored: %d  flagged: %d  (threshold %g)' % (report['images'], report['scored'],
+                                                                   report['flagged'], report['threshold']))
+    print('Loaded in %.2fs, reported in %.3fs' % (loaded - started, time.perf_counter() - loaded))
+    for scanner in report['scanners']:
+        print('Scanner %s: %d images  %d flagged  max score %s' % (scanner['serial'], scanner['images'],
+                                                                  scanner['flagged'], scanner['max_score']))
+    for mode in report['scan_modes'][:top]:
+        print('%s %s: %d images  %d flagged  max %s  last %s (%s)' % (
+            mode['serial'], mode['scan_mode'], mode['images'], mode['flagged'], mode['max_score'],
+            mode['last_score'], mode['last_date_time']))
+
+
+@manager.option('output', help='the file to write')
+@manager.option('-f', '--format', dest='format_', choices=('csv', 'arrow', 'parquet'), default='csv',
+                help='csv, arrow (IPC stream) or parquet, the last 2 need pyarrow')
+@manager.option('-s', '--serial', dest='serial', default=None, help='only this scanner')
+@manager.option('--start', dest='start', default=None, help='the first Date_Time, a prefix like 201706 works')
+@manager.option('--end', dest='end', default=None, help='the last Date_Time, a prefix like 201706 works')
+@manager.option('--kv', dest='kv', default=None, help='only this tube voltage')
+@manager.option('--current', dest='current', default=None, help='only this tube current')
+@manager.option('--kernel', dest='kernel', default=None, help='only this kernel')
+@manager.option('--version', dest='version', default=None, help='only the profiles of this algorithm version')
+@manager.option('--params', dest='params', default=None, help='only the profiles of this parameter hash')
+def export(output, format_, serial, start, end, kv, current, kernel, version, params):
+    """Export the results with their profiles, a chunk of rows at a time"""
+    from app.export import export
+    from app.query import parse_filters
+
+    filters = parse_filters(dict(serial=serial, start=start, end=end, kv=kv, current=current, kernel=kernel,
+                                 version=version, params=params))
+    try:
+        chunks = export(format_, app.config['EXPORT_CHUNK_SIZE'], **filters)
+    except ImportError as e:
+        print(str(e))
+        return 1
+    size = 0
+    with open(output, 'wb') as fp:
+        for chunk in chunks:
+            fp.write(chunk)
+            size += len(chunk)
+    print('Exported %d bytes to %s' % (size, output))
+
+
+@manager.option('directory', help='the directory to ingest')
+@manager.option('-j', '--workers', dest='workers', type=int, default=None, help='number of worker processes')
+@manager.option('-b', '--batch-size', dest='batch_size', type=int, default=None, help='rows per DB transaction')
+@manager.option('-c', '--checkpoint', dest='checkpoint', default=None, help='the checkpoint JSON file')
+@manager.option('--restart', dest='restart', action='store_true', help='do not resume an unfinished run')
+def ingest(directory, workers, batch_size, checkpoint, restart):
+    """Ingest a directory tree without the web server, an interrupted run resumes where it stopped"""
+    import signal
+    import threading
+    from app.bulk import bulk_ingest
+
+    if not os.path.isdir(directory):
+        print('Not a directory: ' + directory)
+        return 1
+    stop = threading.Event()
+
+    def request_stop(signum, frame):
+        print('Stopping after the current batch, run the same command again to resume')
+        stop.set()
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    def report(state):
+        print('%d files  %.1f files/s  %d inserted  %d failed' % (
+            state['processed'], state['processed'] / max(state['elapsed'], 1e-9), state['inserted'],
+            state['failed']))
+
+    result = bulk_ingest(directory, workers=workers, batch_size=batch_size, checkpoint_path=checkpoint,
+                         restart=restart, stop=stop.is_set, report=report)
+    state = result.State
+    print('Runs: %d  elapsed: %.1fs  %.1f files/s' % (state['runs'], state['elapsed'],
+                                                      state['processed'] / max(state['elapsed'], 1e-9)))
+    print('Processed: %d  inserted: %d  duplicated: %d  unchanged: %d  skipped: %d  failed: %d' % (
+        state['processed'], state['inserted'], state['duplicated'], state['unchanged'], state['skipped'],
+        state['failed']))
+    for filename in state['failures'][:20]:
+        print('Failed: ' + filename)
+    if len(state['failures']) > 20:
+        print('%d more failed files in %s' % (len(state['failures']) - 20, result.Path))
+    print(('Finished' if state['finished'] else 'Interrupted, resume with the same command') +
+          ', checkpoint: ' + result.Path)
+    return 0 if state['finished'] else 1
+
+
+@manager.option('roots', nargs='*', help='the directories to watch, default is WATCH_ROOTS')
+@manager.option('--poll', dest='poll', action='store_true', help='poll the directories instead of inotify')
+@manager.option('--settle', dest='settle', type=float, default=None, help='seconds a new file must not change')
+@manager.option('--no-catch-up', dest='no_catch_up', action='store_true',
+                help='do not ingest the files already in the directories')
+def watch(roots, poll, settle, no_catch_up):
+    """Ingest the new files of the watched directories as they arrive, until Ctrl+C"""
+    import signal
+    import threading
+    from app.watch import watch_folders
+
+    config = app.config
+    roots = roots or config['WATCH_ROOTS']
+    missing = [root for root in roots if not os.path.isdir(root)]
+    if not roots or missing:
+        print('Not a directory: ' + ', '.join(missing) if missing else 'No directory to watch')
+        return 1
+    stop = threading.Event()
+
+    def request_stop(signum, frame):
+        print('Stopping after the current batch')
+        stop.set()
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    def report(ingest):
+        if ingest.Processed or ingest.Manifest.Skipped:
+            print('%s: %d files  %d inserted  %d duplicated  %d failed  %d drifted  %d skipped  %.1fs' % (
+                ingest.Directory_Handler.Input_Directory, ingest.Processed, ingest.Inserted, ingest.Duplicated,
+                ingest.Failed, ingest.Drifted, ingest.Manifest.Skipped, ingest.Timing['elapsed']))
+
+    print('Watching ' + ', '.join(roots))
+    totals = watch_folders(roots, settle=config['WATCH_SETTLE_SECONDS'] if settle is None else settle,
+                           poll_interval=config['WATCH_POLL_INTERVAL'], workers=config['WATCH_WORKERS'],
+                           polling=poll or config['WATCH_POLLING'], catch_up=not no_catch_up, stop=stop.is_set,
+                           report=report)
+    print('Processed: %d  inserted: %d  duplicated: %d  unchanged: %d  failed: %d  drifted: %d' % (
+        totals['processed'], totals['inserted'], totals['duplicated'], totals['unchanged'], totals['failed'],
+        totals['drifted']))
+    return 0
 
 
 @manager.command
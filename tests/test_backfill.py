@@ -0,0 +1,94 @@
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+from app import create_app, db
+from app.backfill import Backfill
+from app.models import ImageDatabase, AlgorithmVersion
+from app.query import algorithm_versions, list_images
+from app.rescore import rescore_profiles
+from app.main.ingest import BatchWriter
+from app.main.algorithm.ImageHandler import ImageHandler
+from app.main.algorithm.PixelStore import PixelStore
+from tests.test_batch_writer import HEADER
+from tests.test_ring_integration import make_dicom
+
+
+class BackfillTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.directory = tempfile.mkdtemp()
+        self.app.config['PIXEL_STORE_DIR'] = self.directory
+        store = PixelStore(self.directory)
+        self.dicoms = {}
+        writer = BatchWriter(batch_size=10)
+        for i in range(1, 7):
+            uid = str(i)
+            dcm = self.dicoms[uid] = make_dicom(offset=(i % 3, -(i % 2)), seed=i)
+            image = ImageHandler(dcm)
+            header = dict(HEADER, Instance=i)
+            if i <= 4:
+                algorithm = image.algorithm_parameters()
+                writer.add_image(ImageDatabase.make_row(uid, header, image.Image_Median_Filter_Result,
+                                                        image.Image_Integration_Result, store.put(dcm.RawData),
+                                                        algorithm=algorithm), algorithm)
+            else:
+                # made before the versioning, the last one without pixel data
+                writer.add_image(ImageDatabase.make_row(uid, header, np.zeros(10), np.zeros(10),
+                                                        store.put(dcm.RawData) if i == 5 else None))
+        writer.flush()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def check_profiles(self, uids, median_window):
+        for uid in uids:
+            row = ImageDatabase.query.get(uid)
+            expected = ImageHandler(self.dicoms[uid], median_window=median_window)
+            np.testing.assert_allclose(row.profile, expected.Image_Median_Filter_Result, rtol=1e-6, atol=1e-4)
+            np.testing.assert_allclose(row.raw_profile, expected.Image_Integration_Result, rtol=1e-6, atol=1e-4)
+
+    def test_stamps(self):
+        default = AlgorithmVersion.parameter_hash(ImageHandler.default_parameters())
+        self.assertEqual([(v['version'], v['params'], v['rows']) for v in algorithm_versions()],
+                         [(1, default, 4), (None, None, 2)])
+        self.assertEqual(AlgorithmVersion.query.get(default).parameters['median_window'], 6)
+
+        rescore_profiles(window=4)
+        params = AlgorithmVersion.parameter_hash(ImageHandler.default_parameters(median_window=4))
+        self.assertEqual({row.Parameter_hash for row in ImageDatabase.query}, {params, None})
+        self.check_profiles(['1', '2'], median_window=4)
+        self.assertEqual([image['Uid'] for image in list_images(params=params)[0]], ['4', '3', '2', '1'])
+
+    def test_backfill(self):
+        reports = []
+        state = Backfill(workers=1, batch_size=2).run(report=reports.append)
+        self.assertEqual((state['total'], state['missing'], state['updated'], state['failed']), (1, 1, 1, 0))
+        self.assertEqual(reports[-1], state)
+        self.check_profiles(['5'], median_window=6)
+        self.assertIsNone(ImageDatabase.query.get('6').Parameter_hash)
+
+        # new parameters, in a process pool
+        backfill = Backfill(median_window=4, workers=2, chunk_size=1, batch_size=2)
+        state = backfill.run(report=reports.append)
+        self.assertEqual((state['total'], state['processed'], state['updated']), (5, 5, 5))
+        self.check_profiles(['1', '2', '3', '4', '5'], median_window=4)
+        self.assertEqual(Backfill(median_window=4).run()['total'], 0)
+        # a row already at the parameters is not written again
+        backfill.write([dict(uid='1', profile=b'', raw_profile=b'', version=1, params=backfill.Parameter_Hash)])
+        self.assertEqual(backfill.Updated, 5)
+        self.assertNotEqual(ImageDatabase.query.get('1').Integration_result, b'')
+
+        # a new algorithm version
+        with mock.patch.object(ImageHandler, 'Algorithm_Version', 2):
+            self.assertEqual(Backfill(median_window=4, workers=1).run()['updated'], 5)
+        self.assertEqual(len(list_images(version=2)[0]), 5)
+        self.assertEqual(list_images(version=1)[0], [])
+        self.assertEqual([v['version'] for v in algorithm_versions()], [1, 1, 2, None])
@@ -0,0 +1,102 @@
+import unittest
+from unittest import mock
+from app import create_app, db
+from app.models import ImageDatabase, FileManifest
+from app.main.ingest import BatchWriter
+
+
+HEADER = {'SerialNumber': '12345', 'Modality': 'CT', 'Slop': 1.0, 'Intercept': -1024.0, 'Rows': 512,
+          'Cols': 512, 'PixSpace': [0.5, 0.5], 'Instance': 1, 'StudyDescription': 'Band Assessment',
+          'WindowCenter': 0.0, 'WindowWidth': 100.0, 'FOV': 250.0, 'KVP': 120.0, 'Current': 200,
+          'Kernel': 'B30f', 'Series': 1, 'TotalCollimation': 19.2, 'SliceThickness': 1.2,
+          'DateTime': '20170601120000.000000', 'ScanMode': '120kV_200mA_B30f_19.2P1.2.1'}
+
+
+def make_row(uid, header=None):
+    return ImageDatabase.make_row(uid, header or HEADER, [0.5, 1.5])
+
+
+class BatchWriterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_batches(self):
+        writer = BatchWriter(batch_size=4)
+        for i in range(10):
+            writer.add_image(make_row(str(i)))
+        self.assertEqual(writer.Flush_Count, 2)
+        writer.flush()
+        self.assertEqual(writer.Flush_Count, 3)
+        self.assertEqual(ImageDatabase.query.count(), 10)
+
+    def test_duplicates_are_ignored(self):
+        written = []
+        writer = BatchWriter(batch_size=100)
+        writer.on_written = lambda uid, is_duplicated: written.append((uid, is_duplicated))
+        writer.add_image(make_row('a'))
+        writer.flush()
+        writer.add_image(make_row('a'))
+        writer.add_image(make_row('b'))
+        writer.add_image(make_row('b'))
+        writer.flush()
+        self.assertEqual(ImageDatabase.query.count(), 2)
+        self.assertEqual(written, [('a', False), ('a', True), ('b', False), ('b', True)])
+
+    def test_failed_commit_is_not_reported(self):
+        written = []
+        writer = BatchWriter(batch_size=100)
+        writer.on_written = lambda uid, is_duplicated: written.append(uid)
+        writer.add_image(make_row('a'))
+        with mock.patch.object(db.session, 'commit', side_effect=RuntimeError('disk full')):
+            with self.assertRaises(RuntimeError):
+                writer.flush()
+        self.assertEqual(written, [])
+        self.assertEqual(ImageDatabase.query.count(), 0)
+        writer.add_image(make_row('b'))
+        writer.flush()
+        self.assertEqual(written, ['b'])
+
+    def test_profile_roundtrip(self):
+        writer = BatchWriter()
+        writer.add_image(make_row('a'))
+        writer.flush()
+        image = ImageDatabase.query.get('a')
+        self.assertEqual(list(image.profile), [0.5, 1.5])
+        self.assertIsNone(image.raw_profile)
+        self.assertEqual(image.Pixel_spacing, 0.5)
+
+    def test_manifest_upsert(self):
+        writer = BatchWriter()
+        writer.add_manifest(dict(Path='/a', Size=1, Mtime_ns=1, Content_hash=None, Uid=None))
+        writer.flush()
+        writer.add_manifest(dict(Path='/a', Size=2, Mtime_ns=2, Content_hash='x', Uid='u'))
+        writer.flush()
+        self.assertEqual(FileManifest.query.count(), 1)
+        self.assertEqual(FileManifest.query.get('/a').Uid, 'u')
+
+    def test_other_dialect(self):
+        written = []
+        writer = BatchWriter(batch_size=100)
+        writer.on_written = lambda uid, is_duplicated: written.append((uid, is_duplicated))
+        with mock.patch.object(db.engine.dialect, 'name', 'mysql'):
+            self.assertEqual(str(BatchWriter.insert(FileManifest.__table__, replace=True)),
+                             str(FileManifest.__table__.insert()))
+            writer.add_image(make_row('a'))
+            writer.add_manifest(dict(Path='/a', Size=1, Mtime_ns=1, Content_hash=None, Uid=None))
+            writer.flush()
+            writer.add_image(make_row('a'))
+            writer.add_image(make_row('b'))
+            writer.add_manifest(dict(Path='/a', Size=2, Mtime_ns=2, Content_hash='x', Uid='u'))
+            writer.add_manifest(dict(Path='/a', Size=3, Mtime_ns=3, Content_hash='y', Uid='u'))
+            writer.flush()
+        self.assertEqual(ImageDatabase.query.count(), 2)
+        self.assertEqual(written, [('a', False), ('a', True), ('b', False)])
+        self.assertEqual([(m.Path, m.Size) for m in FileManifest.query], [('/a', 3)])
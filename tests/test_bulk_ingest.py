@@ -0,0 +1,57 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from app import create_app, db
+from app.bulk import bulk_ingest
+from app.models import ImageDatabase, AlgorithmVersion
+from app.main.algorithm.PhantomGenerator import PhantomGenerator
+
+
+class BulkIngestTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.directory = tempfile.mkdtemp()
+        self.checkpoint = os.path.join(self.directory, 'checkpoint.json')
+        generator = PhantomGenerator()
+        generator.write_series(os.path.join(self.directory, 'series'), 3)
+        # the header is complete, the pixel data is too short for the rows
+        filename = os.path.join(self.directory, 'series', 'broken.dcm')
+        dataset = generator.dataset(filename, instance=9)
+        dataset.Rows = 1024
+        dataset.save_as(filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_resume(self):
+        processed = []
+        first = bulk_ingest(self.directory, batch_size=1, checkpoint_path=self.checkpoint,
+                            stop=lambda: len(processed) >= 2, report=processed.append, report_interval=0)
+        self.assertFalse(first.State['finished'])
+        self.assertEqual(first.State['processed'], 2)
+        with open(self.checkpoint) as fp:
+            self.assertEqual(json.load(fp)['inserted'], 2)
+
+        second = bulk_ingest(self.directory, batch_size=1, checkpoint_path=self.checkpoint)
+        state = second.State
+        self.assertTrue(state['finished'])
+        self.assertEqual(state['runs'], 2)
+        self.assertEqual(state['skipped'], 2)
+        self.assertEqual((state['processed'], state['inserted'], state['failed']), (4, 3, 1))
+        self.assertEqual(state['failures'], [os.path.join(self.directory, 'series', 'broken.dcm')])
+        self.assertEqual(ImageDatabase.query.count(), 3)
+        # the rows are stamped with the algorithm which made them
+        self.assertEqual({(row.Algorithm_version, row.Parameter_hash) for row in ImageDatabase.query},
+                         {(1, AlgorithmVersion.query.one().Parameter_hash)})
+
+        # a finished checkpoint starts new totals
+        third = bulk_ingest(self.directory, checkpoint_path=self.checkpoint)
+        self.assertEqual((third.State['runs'], third.State['processed'], third.State['skipped']), (1, 0, 4))
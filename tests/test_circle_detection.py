@@ -0,0 +1,34 @@
+import unittest
+import numpy as np
+from app.main.algorithm.ImageHandler import ImageHandler
+from tests.test_ring_integration import make_dicom
+
+
+class CircleDetectionTestCase(unittest.TestCase):
+    def test_numpy_matches_pil(self):
+        for seed, offset in enumerate([(0, 0), (7, -3), (-12, 15)]):
+            dcm = make_dicom(offset=offset, seed=seed)
+            vectorized = ImageHandler(dcm, circle='numpy')
+            legacy = ImageHandler(dcm, circle='pil')
+            self.assertEqual(vectorized.Center, legacy.Center)
+            self.assertEqual(vectorized.Radius, legacy.Radius)
+
+    def test_numpy_does_not_modify_image(self):
+        dcm = make_dicom()
+        image = ImageHandler(dcm)
+        raw_data = dcm.RawData * dcm.Slop + dcm.Intercept
+        before = raw_data.copy()
+        image.calc_circle(raw_data)
+        np.testing.assert_array_equal(raw_data, before)
+
+    def test_subpixel_center(self):
+        dcm = make_dicom(offset=(4, -7))
+        image = ImageHandler(dcm, subpixel=True)
+        self.assertTrue(image.isImageComplete)
+        self.assertAlmostEqual(image.Center_Subpixel[0], 260, delta=0.5)
+        self.assertAlmostEqual(image.Center_Subpixel[1], 249, delta=0.5)
+        self.assertAlmostEqual(image.Radius_Subpixel, 240, delta=1)
+
+    def test_subpixel_is_optional(self):
+        image = ImageHandler(make_dicom())
+        self.assertIsNone(image.Center_Subpixel)
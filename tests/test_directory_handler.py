@@ -0,0 +1,41 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from app.main.algorithm.DirectoryHandler import DirectoryHandler
+
+
+class DirectoryHandlerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        deep = os.path.join(self.directory, *['sub%d' % i for i in range(50)])
+        os.makedirs(deep)
+        with open(os.path.join(deep, 'text.dcm'), 'w') as f:
+            f.write('not a dicom file')
+        with open(os.path.join(self.directory, 'broken.dcm'), 'wb') as f:
+            f.write(b'\0' * 128 + b'DICM' + b'\xff' * 16)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_dicom_magic(self):
+        self.assertTrue(DirectoryHandler.has_dicom_magic(io.BytesIO(b'\0' * 128 + b'DICM')))
+        self.assertFalse(DirectoryHandler.has_dicom_magic(io.BytesIO(b'DICM')))
+
+    def test_rejects_non_dicom(self):
+        handler = DirectoryHandler(self.directory)
+        self.assertEqual(handler.Dicom_File_Path, [])
+        self.assertEqual(handler.Total_Dicom_Quantity, 0)
+
+    def test_no_state_between_instances(self):
+        first = DirectoryHandler(self.directory)
+        first.Dicom_File_Path.append('leak')
+        second = DirectoryHandler(self.directory)
+        self.assertEqual(second.Dicom_File_Path, [])
+        self.assertEqual(second.Log_Record, [r"输入参数为文件夹（正确）"])
+
+    def test_not_directory(self):
+        handler = DirectoryHandler(os.path.join(self.directory, 'missing'))
+        self.assertEqual(handler.Log_Record, [r"输入参数不是文件夹，请再次检查！"])
+        self.assertEqual(list(handler.iter_files()), [])
@@ -0,0 +1,118 @@
+import json
+import unittest
+import numpy as np
+from app import create_app, db
+from app.drift import ProfileMatrix, baseline_cache, drift_report
+from app.models import ImageDatabase, Baseline
+from app.main.ingest import BatchWriter
+from app.main.algorithm.DriftDetector import DriftDetector, RunningProfile
+from tests.test_batch_writer import HEADER
+
+
+def make_row(uid, profile, **header):
+    return ImageDatabase.make_row(uid, dict(HEADER, DateTime='20170601%06d' % int(uid), **header), profile)
+
+
+class DriftDetectorTestCase(unittest.TestCase):
+    def test_running_profile(self):
+        profiles = np.random.RandomState(0).normal(3, 2, (50, 20))
+        running = RunningProfile()
+        for batch in (profiles[:1], profiles[1:17], profiles[17:]):
+            running.add(batch)
+        self.assertEqual(running.Count, 50)
+        np.testing.assert_allclose(running.Mean, profiles.mean(axis=0))
+        np.testing.assert_allclose(running.std, profiles.std(axis=0, ddof=1))
+        mean, m2 = running.to_bytes()
+        np.testing.assert_array_equal(RunningProfile.from_bytes(50, mean, m2).M2, running.M2)
+
+    def test_score_matrix(self):
+        detector = DriftDetector(min_count=5, std_floor=0.5, threshold=5, margin=1)
+        means = np.array([np.zeros(6), np.ones(6)])
+        stds = np.array([np.full(6, 2.0), np.full(6, 0.1)])
+        profiles = np.array([[0, 0, 4, 0, 0, 0], [1, 1, 1, 1, 2, 1], [9, 0, 0, 0, 0, 9], [0] * 6], dtype=float)
+        group = np.array([0, 1, 0, 1])
+        scores = detector.score_matrix(profiles, group, means, stds, np.array([5, 5]), chunk_size=3)
+        # the std floor of 0.5 applies to group 1, the ends are left out
+        np.testing.assert_allclose(scores, [2, 2, 0, 2])
+        scores = detector.score_matrix(profiles, group, means, stds, np.array([5, 4]))
+        self.assertTrue(np.isnan(scores[[1, 3]]).all())
+        summary = detector.summarize(np.array([2, np.nan, 7, 1]), np.array([0, 0, 1, 1]), 3)
+        self.assertEqual(list(summary['images']), [2, 2, 0])
+        self.assertEqual(list(summary['flagged']), [0, 1, 0])
+        np.testing.assert_allclose(summary['max_score'], [2, 7, np.nan])
+        np.testing.assert_allclose(summary['mean_score'], [2, 4, np.nan])
+
+
+class DriftTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.profiles = np.random.RandomState(1).normal(0, 1, (30, 40))
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def ingest(self, rows, batch_size=8):
+        drifted = []
+        writer = BatchWriter(batch_size=batch_size, drift_detector=DriftDetector(min_count=10, threshold=5))
+        writer.on_drifted = lambda uid, score: drifted.append(uid)
+        for row in rows:
+            writer.add_image(row)
+        writer.flush()
+        return drifted
+
+    def test_ingest(self):
+        drifted = self.ingest([make_row(str(i), profile) for i, profile in enumerate(self.profiles)])
+        self.assertEqual(drifted, [])
+        baseline = Baseline.query.one()
+        self.assertEqual((baseline.Serial_number, baseline.Scan_mode, baseline.Count),
+                         (12345, HEADER['ScanMode'], 30))
+        running = baseline.running_profile()
+        np.testing.assert_allclose(running.Mean, self.profiles.astype(np.float32).mean(axis=0), atol=1e-6)
+        # the 1st batches are scored once the baseline has 10 profiles
+        self.assertIsNone(ImageDatabase.query.get('0').Drift_score)
+        self.assertIsNotNone(ImageDatabase.query.get('29').Drift_score)
+
+        ring = np.zeros(40)
+        ring[20] = 30
+        drifted = self.ingest([make_row('30', ring), make_row('31', np.zeros(40), Instance=2)])
+        self.assertEqual(drifted, ['30'])
+        # the flagged profile is not added to its baseline
+        self.assertEqual(sorted(b.Count for b in Baseline.query), [1, 30])
+
+        expected = {(b.Serial_number, b.Scan_mode): (b.Count, b.Mean) for b in Baseline.query}
+        self.assertEqual(Baseline.rebuild(threshold=5, chunk_size=7), 2)
+        for b in Baseline.query:
+            self.assertEqual(b.Count, expected[(b.Serial_number, b.Scan_mode)][0])
+            np.testing.assert_allclose(np.frombuffer(b.Mean), np.frombuffer(expected[(b.Serial_number,
+                                                                                      b.Scan_mode)][1]))
+
+    def test_cache_after_rebuild(self):
+        self.ingest([make_row(str(i), profile) for i, profile in enumerate(self.profiles)], batch_size=100)
+        key = (12345, Baseline.query.one().Scan_mode)
+        np.testing.assert_allclose(baseline_cache.get()[key][1], self.profiles.mean(axis=0), rtol=1e-5)
+        # the profiles are rescored, same images, same count and Date_Time
+        table = ImageDatabase.__table__
+        db.session.execute(table.update().values(Integration_result=ImageDatabase.pack_profile(np.ones(40))))
+        db.session.commit()
+        Baseline.rebuild()
+        np.testing.assert_allclose(baseline_cache.get()[key][1], np.ones(40))
+
+    def test_report(self):
+        self.ingest([make_row(str(i), profile) for i, profile in enumerate(self.profiles)], batch_size=100)
+        self.ingest([make_row('30', np.full(40, 10.0)), make_row('31', np.zeros(40), SerialNumber='777')])
+
+        report = drift_report(ProfileMatrix.load(), baseline_cache.get(), DriftDetector(min_count=10, threshold=5))
+        self.assertEqual((report['images'], report['scored'], report['flagged']), (32, 31, 1))
+        self.assertEqual([scanner['serial'] for scanner in report['scanners']], [12345, 777])
+        mode = report['scan_modes'][0]
+        self.assertEqual((mode['images'], mode['flagged'], mode['last_uid']), (31, 1, '30'))
+        self.assertGreater(mode['last_score'], 5)
+
+        client = self.app.test_client()
+        report = json.loads(client.get('/api/drift?serial=777').data.decode())
+        self.assertEqual((report['images'], report['scored']), (1, 0))
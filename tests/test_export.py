@@ -0,0 +1,99 @@
+import csv
+import io
+import unittest
+from app import create_app, db
+from app.export import Export_Columns, export, iter_chunks
+from app.models import ImageDatabase, AlgorithmVersion
+from app.main.ingest import BatchWriter
+from app.main.algorithm.ImageHandler import ImageHandler
+from tests.test_batch_writer import HEADER
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+def make_row(i, profile, algorithm=None, **header):
+    return ImageDatabase.make_row('1.%02d' % i, dict(HEADER, DateTime='201706%02d120000' % (i + 1), **header),
+                                  profile, algorithm=algorithm)
+
+
+class ExportTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        writer = BatchWriter(batch_size=4)
+        # the first 3 rows are made before the versioning
+        self.algorithm = ImageHandler.default_parameters()
+        self.params = AlgorithmVersion.parameter_hash(self.algorithm)
+        for i in range(9):
+            algorithm = self.algorithm if i >= 3 else None
+            writer.add_image(make_row(i, [i, 0.5, 1.25], algorithm, KVP=80.0 if i % 2 else 120.0), algorithm)
+        # a shorter profile is padded
+        writer.add_image(make_row(9, [7.0], SerialNumber='54321'))
+        # a serial number with letters is kept as text by SQLite
+        writer.add_image(make_row(10, [1.0, 2.0], SerialNumber='CT12A'))
+        writer.flush()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def read_csv(self, data):
+        return list(csv.DictReader(io.StringIO(data.decode('utf-8'))))
+
+    def test_chunks(self):
+        chunks = list(iter_chunks(chunk_size=4, serial=12345))
+        self.assertEqual([len(rows) for rows in chunks], [4, 4, 1])
+        self.assertEqual([row[0] for rows in chunks for row in rows], ['1.%02d' % i for i in range(9)])
+
+    def test_csv(self):
+        rows = self.read_csv(b''.join(export('csv', chunk_size=3)))
+        self.assertEqual(list(rows[0])[:len(Export_Columns)], list(Export_Columns))
+        self.assertEqual([row['Uid'] for row in rows], ['1.%02d' % i for i in range(11)])
+        self.assertEqual(rows[10]['Serial_number'], 'CT12A')
+        self.assertEqual([rows[2]['Profile_%d' % i] for i in range(3)], ['2', '0.5', '1.25'])
+        self.assertEqual([rows[9]['Profile_%d' % i] for i in range(3)], ['7', '', ''])
+        self.assertEqual([(row['Algorithm_version'], row['Parameter_hash']) for row in rows[2:4]],
+                         [('', ''), (str(self.algorithm['version']), self.params)])
+
+        rows = self.read_csv(b''.join(export('csv', version=self.algorithm['version'], params=self.params)))
+        self.assertEqual([row['Uid'] for row in rows], ['1.%02d' % i for i in range(3, 9)])
+
+        rows = self.read_csv(b''.join(export('csv', kv=80.0, start='20170603', end='20170606')))
+        self.assertEqual([row['Uid'] for row in rows], ['1.03', '1.05'])
+
+        client = self.app.test_client()
+        response = client.get('/export.csv?serial=54321')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('attachment', response.headers['Content-Disposition'])
+        rows = self.read_csv(response.data)
+        self.assertEqual([(row['Uid'], row['Profile_0']) for row in rows], [('1.09', '7')])
+        self.assertEqual(client.get('/export.xls').status_code, 404)
+        self.assertEqual(client.get('/export.csv?kv=high').status_code, 400)
+
+    def test_arrow(self):
+        client = self.app.test_client()
+        response = client.get('/export.arrow?serial=12345')
+        if pyarrow is None:
+            self.assertEqual(response.status_code, 501)
+            self.skipTest('pyarrow is not installed')
+        table = pyarrow.ipc.open_stream(response.data).read_all()
+        self.assertEqual(table.num_rows, 9)
+        self.assertEqual(table.schema.field('Profile').type, pyarrow.list_(pyarrow.float32(), 3))
+        self.assertEqual(table.column('Profile').to_pylist()[2], [2, 0.5, 1.25])
+        self.assertEqual(table.column('Serial_number').to_pylist()[0], '12345')
+        self.assertEqual(table.column('Algorithm_version').to_pylist()[2:4], [None, self.algorithm['version']])
+        self.assertEqual(table.column('Parameter_hash').to_pylist()[2:4], [None, self.params])
+
+        import pyarrow.parquet as pq
+        table = pq.read_table(io.BytesIO(b''.join(export('parquet', chunk_size=4))))
+        self.assertEqual(table.num_rows, 11)
+        self.assertEqual(table.column('Uid').to_pylist()[9], '1.09')
+        self.assertEqual(table.column('Serial_number').to_pylist()[9:], ['54321', 'CT12A'])
+        table = pyarrow.ipc.open_stream(b''.join(export('arrow', chunk_size=4))).read_all()
+        self.assertEqual(table.column('Serial_number').to_pylist()[10], 'CT12A')
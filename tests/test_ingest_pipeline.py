@@ -0,0 +1,41 @@
+import os
+import shutil
+import tempfile
+import unittest
+from app.main.algorithm.IngestPipeline import IngestPipeline
+
+
+class IngestPipelineTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.files = []
+        for i in range(7):
+            filename = os.path.join(self.directory, 'file%d.dcm' % i)
+            with open(filename, 'w') as f:
+                f.write('not a dicom file')
+            self.files.append(filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_results_in_input_order(self):
+        pipeline = IngestPipeline(workers=2, chunk_size=2)
+        results = list(pipeline.run(iter(self.files)))
+        self.assertEqual([r.FileName for r in results], self.files)
+        self.assertFalse(any(r.isComplete for r in results))
+        # the parse error logged in the worker is sent back with the result
+        self.assertTrue(all(r.Log for r in results))
+
+    def test_in_process(self):
+        pipeline = IngestPipeline(workers=1)
+        results = list(pipeline.run(self.files))
+        self.assertEqual([r.FileName for r in results], self.files)
+        self.assertFalse(any(r.Log for r in results))
+
+    def test_series_mode(self):
+        pipeline = IngestPipeline(workers=2, series=True, series_size=3)
+        results = list(pipeline.run(iter(self.files)))
+        self.assertEqual([r.FileName for r in results], self.files)
+        self.assertFalse(any(r.isComplete for r in results))
+        chunks = list(pipeline.series_chunks([(f, None) for f in self.files + ['/other/file.dcm']]))
+        self.assertEqual([len(chunk) for chunk in chunks], [3, 3, 1, 1])
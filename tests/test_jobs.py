@@ -0,0 +1,72 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from app import create_app, db, job_runner
+from app.jobs import IngestJob
+from app.main.ingest import DicomIngest
+from app.main.algorithm.PhantomGenerator import PhantomGenerator
+
+
+class JobTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+        self.directory = tempfile.mkdtemp()
+        with open(self.directory + '/text.dcm', 'w') as f:
+            f.write('not a dicom file')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_submit_and_poll(self):
+        response = self.client.post('/DicomInput', data={'Input_Directory': self.directory})
+        self.assertEqual(response.status_code, 302)
+        job_id = response.headers['Location'].split('job=')[-1]
+        job_runner.get(job_id).Future.result(timeout=60)
+
+        response = self.client.get('/jobs/' + job_id)
+        self.assertEqual(response.status_code, 200)
+        status = json.loads(response.data.decode())
+        self.assertEqual(status['status'], 'done')
+        self.assertEqual(status['progress'], 100)
+        self.assertEqual(status['log_offset'], len(status['log']))
+        self.assertIn(job_id, self.client.get('/DicomInput?job=' + job_id).data.decode())
+
+    def test_progress(self):
+        PhantomGenerator().write_series(os.path.join(self.directory, 'series'), 3)
+        job = IngestJob(self.directory)
+        job.Status = 'running'
+        job.Ingest = DicomIngest(self.directory, workers=1)
+        self.assertIsNone(job.to_dict()['progress'])
+        statuses = [job.to_dict() for _ in job.Ingest.run()]
+        # the walk is lazy, the total is not known before the last file is found
+        self.assertEqual([(status['progress'], status['processed']) for status in statuses],
+                         [(None, 1), (None, 2), (None, 3)])
+        self.assertEqual([status['found'] for status in statuses], [1, 2, 3])
+        self.assertEqual(job.to_dict()['progress'], 100)
+
+        job = IngestJob(self.directory)
+        job.Ingest = DicomIngest(self.directory, workers=1)
+        files = job.Ingest.Directory_Handler.iter_files()
+        self.assertEqual(len(list(files)), 3)
+        job.Ingest.Processed = 1
+        self.assertAlmostEqual(job.to_dict()['progress'], 100 / 3)
+
+    def test_unknown_job(self):
+        self.assertEqual(self.client.get('/jobs/nothing').status_code, 404)
+        self.assertEqual(self.client.post('/jobs/nothing/cancel').status_code, 404)
+
+    def test_stop(self):
+        ingest = DicomIngest(self.directory)
+        self.assertEqual(list(ingest.run(stop=lambda: True)), [])
+        self.assertEqual(ingest.Processed, 0)
+        self.assertEqual(ingest.Log_Record[-1], r"导入已取消")
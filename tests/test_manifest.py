@@ -0,0 +1,48 @@
+import os
+import shutil
+import tempfile
+import unittest
+from app import create_app, db
+from app.models import FileManifest
+from app.main.ingest import DicomIngest
+
+
+class ManifestTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'text.dcm')
+        with open(self.filename, 'w') as f:
+            f.write('not a dicom file')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def ingest(self):
+        ingest = DicomIngest(self.directory)
+        results = list(ingest.run())
+        return ingest, results
+
+    def test_unchanged_file_is_skipped(self):
+        ingest, _ = self.ingest()
+        self.assertEqual(ingest.Manifest.Skipped, 0)
+        row = FileManifest.query.get(self.filename)
+        self.assertIsNotNone(row)
+        self.assertIsNone(row.Uid)
+
+        ingest, _ = self.ingest()
+        self.assertEqual(ingest.Manifest.Skipped, 1)
+
+    def test_modified_file_is_checked_again(self):
+        self.ingest()
+        with open(self.filename, 'a') as f:
+            f.write('changed')
+        ingest, _ = self.ingest()
+        self.assertEqual(ingest.Manifest.Skipped, 0)
+        self.assertEqual(FileManifest.query.get(self.filename).Size, os.path.getsize(self.filename))
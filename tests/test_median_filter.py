@@ -0,0 +1,83 @@
+import unittest
+import numpy as np
+from app import create_app, db
+from app.models import ImageDatabase
+from app.main.algorithm.ImageHandler import ImageHandler
+from app.rescore import rescore_profiles
+from tests.test_batch_writer import HEADER
+
+
+def legacy_median_filter(profile, factor=3):
+    result = np.zeros(len(profile))
+    result[0] = np.median(profile[:3]) * factor - np.median(profile[:5])
+    result[1] = np.median(profile[:3]) * factor - np.median(profile[:5])
+    result[-1] = np.median(profile[-3:]) * factor - np.median(profile[-5:])
+    result[-2] = np.median(profile[-3:]) * factor - np.median(profile[-5:])
+    for index in range(3, len(profile) - 2):
+        result[index] = np.median(profile[index - 3:index + 3])
+    return result
+
+
+class MedianFilterTestCase(unittest.TestCase):
+    def test_same_as_legacy(self):
+        random = np.random.RandomState(0)
+        for length in (2, 5, 6, 7, 50, 240):
+            profile = random.randn(length)
+            np.testing.assert_array_equal(ImageHandler.median_filter(profile), legacy_median_filter(profile))
+
+    def test_batch(self):
+        profiles = np.random.RandomState(1).randn(20, 60)
+        result = ImageHandler.median_filter(profiles, window=5, factor=2)
+        self.assertEqual(result.shape, profiles.shape)
+        for profile, filtered in zip(profiles, result):
+            np.testing.assert_array_equal(ImageHandler.median_filter(profile, window=5, factor=2), filtered)
+        self.assertEqual(result[0, 2], np.median(profiles[0, :5]))
+
+    def test_small_windows(self):
+        profile = np.random.RandomState(3).randn(30)
+        edges = ImageHandler.median_filter(profile, window=6)[[0, 1, -2, -1]]
+        for window in (1, 2, 3):
+            result = ImageHandler.median_filter(profile, window=window)
+            self.assertFalse(np.isnan(result).any())
+            # the edge corrected data are not overwritten by the sliding median
+            np.testing.assert_array_equal(result[[0, 1, -2, -1]], edges)
+            half = window // 2
+            for index in range(2, 28 - (window - half - 1)):
+                self.assertEqual(result[index], np.median(profile[index - half:index - half + window]))
+        np.testing.assert_array_equal(ImageHandler.median_filter(profile, window=1)[2:-2], profile[2:-2])
+        with self.assertRaises(ValueError):
+            ImageHandler.median_filter(profile, window=0)
+        with self.assertRaises(ValueError):
+            ImageHandler.default_parameters(median_window=0)
+
+
+class RescoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_rescore(self):
+        random = np.random.RandomState(2)
+        raw_profiles = {str(i): random.randn(50 + i % 3).astype(np.float32) for i in range(7)}
+        rows = [ImageDatabase.make_row(uid, HEADER, [0.0], raw_profile=raw) for uid, raw in raw_profiles.items()]
+        rows.append(ImageDatabase.make_row('legacy', HEADER, [0.0]))
+        for row in rows:
+            row['Drift_score'] = 2.0
+        db.session.execute(ImageDatabase.__table__.insert(), rows)
+        db.session.commit()
+
+        self.assertEqual(rescore_profiles(window=4, factor=2, chunk_size=3), 7)
+        for uid, raw in raw_profiles.items():
+            expected = ImageHandler.median_filter(raw, window=4, factor=2).astype(np.float32)
+            np.testing.assert_array_equal(ImageDatabase.query.get(uid).profile, expected)
+            # scored against the baseline of the old profiles
+            self.assertIsNone(ImageDatabase.query.get(uid).Drift_score)
+        self.assertEqual(list(ImageDatabase.query.get('legacy').profile), [0.0])
+        self.assertEqual(ImageDatabase.query.get('legacy').Drift_score, 2.0)
@@ -0,0 +1,97 @@
+import shutil
+import tempfile
+import unittest
+from app import create_app, db
+from app.main.ingest import DicomIngest
+from app.main.algorithm.Metrics import Metrics, metrics
+
+
+class MetricsTestCase(unittest.TestCase):
+    def test_disabled(self):
+        recorder = Metrics()
+        with recorder.timer('stage'):
+            pass
+        recorder.count('files')
+        self.assertEqual(recorder.snapshot(), {'timers': {}, 'counters': {}})
+
+    def test_timer_and_count(self):
+        recorder = Metrics(enabled=True)
+        with recorder.timer('stage'):
+            pass
+        recorder.timed('stage')(lambda: None)()
+        recorder.count('files', 3)
+        snapshot = recorder.snapshot()
+        self.assertEqual(snapshot['timers']['stage'][0], 2)
+        self.assertGreaterEqual(snapshot['timers']['stage'][1], 0)
+        self.assertEqual(snapshot['counters'], {'files': 3})
+
+    def test_pop_merge_difference(self):
+        worker = Metrics(enabled=True)
+        worker.add_time('stage', 1.5)
+        worker.count('files')
+        recorder = Metrics(enabled=True)
+        recorder.add_time('stage', 0.5)
+        before = recorder.snapshot()
+        recorder.merge(worker.pop())
+        self.assertEqual(worker.snapshot(), {'timers': {}, 'counters': {}})
+        self.assertEqual(recorder.snapshot()['timers']['stage'], [2, 2.0])
+        self.assertEqual(Metrics.difference(recorder.snapshot(), before),
+                         {'timers': {'stage': [1, 1.5]}, 'counters': {'files': 1}})
+
+    def test_prometheus(self):
+        recorder = Metrics(enabled=True)
+        recorder.add_time('dicom_read', 0.25, calls=2)
+        recorder.count('bytes_read', 1024)
+        text = recorder.prometheus()
+        self.assertIn('webbat_stage_seconds_total{stage="dicom_read"} 0.25\n', text)
+        self.assertIn('webbat_stage_calls_total{stage="dicom_read"} 2\n', text)
+        self.assertIn('webbat_bytes_read_total 1024\n', text)
+
+
+class MetricsEndpointTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+        self.directory = tempfile.mkdtemp()
+        with open(self.directory + '/text.dcm', 'w') as f:
+            f.write('not a dicom file')
+        metrics.Enabled = True
+
+    def tearDown(self):
+        metrics.Enabled = False
+        shutil.rmtree(self.directory)
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_ingest_timing(self):
+        ingest = DicomIngest(self.directory)
+        for _ in ingest.run():
+            pass
+        self.assertEqual(ingest.Timing['files'], 0)
+        self.assertIn('is_target', ingest.Timing['stages'])
+        self.assertIn(r"耗时：", ingest.Log_Record[-1])
+
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.mimetype.startswith('text/plain'))
+        text = response.data.decode()
+        self.assertIn('webbat_stage_seconds_total{stage="ingest"}', text)
+        self.assertIn('webbat_jobs{status="done"}', text)
+
+    def test_job_profile(self):
+        from app import job_runner
+        profile_dir = tempfile.mkdtemp()
+        self.app.config.update(INGEST_PROFILE=True, PROFILE_DIR=profile_dir)
+        try:
+            job = job_runner.submit(self.directory)
+            job.Future.result(timeout=60)
+            self.assertTrue(job.Profile.startswith(profile_dir))
+            response = self.client.get('/jobs/%s/profile' % job.Id)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('function calls', response.data.decode())
+        finally:
+            shutil.rmtree(profile_dir)
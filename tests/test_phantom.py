@@ -0,0 +1,52 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from app.main.algorithm.DicomHanlder import DicomHandler
+from app.main.algorithm.DirectoryHandler import DirectoryHandler
+from app.main.algorithm.ImageHandler import ImageHandler
+from app.main.algorithm.PhantomGenerator import PhantomGenerator
+
+
+class PhantomGeneratorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_series_is_scored(self):
+        generator = PhantomGenerator(offset=(3, -5), noise=2.0, rings=[(100, 8.0, 1.5)])
+        files = generator.write_series(os.path.join(self.directory, 'series'), 3, series=2)
+        handler = DirectoryHandler(self.directory)
+        self.assertEqual(handler.Dicom_File_Path, files)
+
+        dcm = DicomHandler(files[1])
+        self.assertTrue(dcm.isComplete)
+        self.assertEqual((dcm.Instance, dcm.Series, dcm.Rows), (2, 2, 512))
+        np.testing.assert_array_equal(dcm.RawData, generator.pixel_data(2))
+        image = ImageHandler(dcm)
+        self.assertTrue(image.isImageComplete)
+        self.assertEqual(image.Center, (259, 251))
+        # the ring artifact stands out of the flat water profile
+        profile = image.Image_Median_Filter_Result
+        self.assertGreater(profile[97:104].max(), 4)
+        self.assertLess(abs(profile[60:80].mean()), 1)
+
+    def test_lean_dicom(self):
+        generator = PhantomGenerator(rings=[(100, 8.0, 1.5)])
+        filename = generator.write(os.path.join(self.directory, 'phantom.dcm'))
+        dcm = DicomHandler(filename, lean=True)
+        self.assertTrue(dcm.isComplete)
+        self.assertIsNone(dcm.Data)
+        self.assertFalse(dcm.RawData.flags.writeable)
+        np.testing.assert_array_equal(dcm.RawData, DicomHandler(filename).RawData)
+        self.assertEqual(dcm.header(), DicomHandler(filename).header())
+
+    def test_not_band_assessment(self):
+        filename = os.path.join(self.directory, 'other.dcm')
+        dataset = PhantomGenerator(size=64).dataset(filename)
+        dataset.StudyDescription = 'Head'
+        dataset.save_as(filename)
+        self.assertEqual(DirectoryHandler(self.directory).Dicom_File_Path, [])
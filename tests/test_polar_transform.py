@@ -0,0 +1,69 @@
+import unittest
+import numpy as np
+from app.main.algorithm.ImageHandler import ImageHandler
+from app.main.algorithm.PolarTransform import PolarTransform
+from app.main.algorithm.SeriesHandler import SeriesHandler
+from tests.test_ring_integration import make_dicom
+
+
+class PolarTransformTestCase(unittest.TestCase):
+    def test_linear_image_is_exact(self):
+        rows, cols = np.mgrid[:128, :128]
+        image = 3.0 * rows - 2.0 * cols
+        center = (63.5, 60.25)
+        transform = PolarTransform(128, 128, center, 50, angles=72)
+        polar = transform.remap(image)
+        self.assertEqual(polar.shape, (50, 72))
+        radii = np.arange(50)[:, np.newaxis]
+        theta = np.arange(72) * 2 * np.pi / 72
+        expected = 3.0 * (center[0] - radii * np.sin(theta)) - 2.0 * (center[1] + radii * np.cos(theta))
+        np.testing.assert_allclose(polar, expected, atol=1e-9)
+        # the mean of a linear image over a full ring is its value at the center
+        np.testing.assert_allclose(transform.ring_profiles(polar), 3.0 * center[0] - 2.0 * center[1], atol=1e-9)
+
+    def test_band_artifact_in_sector(self):
+        image = np.zeros((256, 256))
+        rows, cols = np.mgrid[:256, :256]
+        distance = np.hypot(rows - 128, cols - 128)
+        angle = np.degrees(np.arctan2(128 - rows, cols - 128)) % 360
+        # a band over 30 degrees at radius 80 ~ 84
+        image[(distance >= 79) & (distance <= 85) & (angle >= 90) & (angle < 120)] = 60
+        rings, sectors = PolarTransform.get(256, 256, (128, 128), 120).profiles(image, sectors=12)
+        self.assertEqual(sectors.shape, (12, 120))
+        self.assertAlmostEqual(sectors[3, 82], 60)
+        # the neighbour sectors only get the interpolation at the band ends
+        self.assertLess(sectors[[2, 4], 82].max(), 0.1)
+        self.assertEqual(sectors[[0, 1, 5, 6, 7, 8, 9, 10, 11], 82].max(), 0)
+        # diluted 12 times in the full ring
+        self.assertAlmostEqual(rings[82], 5, delta=0.1)
+        self.assertEqual(rings[40], 0)
+
+    def test_batch_matches_slices(self):
+        volume = np.random.RandomState(0).normal(0, 10, (3, 96, 96))
+        transform = PolarTransform.get(96, 96, (48, 47), 40, 90)
+        self.assertIs(transform, PolarTransform.get(96, 96, (48, 47), 40, 90))
+        polar = transform.remap_batch(volume)
+        for image, expected in zip(volume, polar):
+            np.testing.assert_allclose(transform.remap(image), expected)
+        rings, sectors = transform.profiles(volume, sectors=9)
+        self.assertEqual((rings.shape, sectors.shape), ((3, 40), (3, 9, 40)))
+        np.testing.assert_allclose(sectors.mean(axis=1), rings)
+
+    def test_errors(self):
+        with self.assertRaises(IndexError):
+            PolarTransform(64, 64, (60, 32), 20)
+        with self.assertRaises(ValueError):
+            PolarTransform.sector_profiles(np.zeros((10, 360)), 7)
+
+    def test_handlers(self):
+        dicoms = [make_dicom(offset=(i % 3, -(i % 2)), seed=i) for i in range(3)]
+        series = SeriesHandler(dicoms, refine=True)
+        rings, sectors = series.polar_profiles(angles=180, sectors=6)
+        for dcm, ring, sector in zip(dicoms, rings, sectors):
+            image = ImageHandler(dcm)
+            expected_ring, expected_sector = image.polar_profiles(angles=180, sectors=6)
+            self.assertEqual(expected_sector.shape, (6, image.Radius[0]))
+            np.testing.assert_allclose(ring, expected_ring, atol=1e-9)
+            np.testing.assert_allclose(sector, expected_sector, atol=1e-9)
+            # the interpolated rings follow the bresenham rings
+            np.testing.assert_allclose(ring[5:-5], image.Image_Integration_Result[5:-5], atol=5)
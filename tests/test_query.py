@@ -0,0 +1,89 @@
+import json
+import unittest
+from app import create_app, db
+from app.models import FilterChoice
+from app.main.ingest import BatchWriter
+from app.query import list_images, filter_choices, parse_filters, create_indexes
+from tests.test_batch_writer import HEADER, make_row
+
+
+def header(**values):
+    result = dict(HEADER)
+    result.update(values)
+    return result
+
+
+class QueryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+        writer = BatchWriter(batch_size=4)
+        for i in range(10):
+            writer.add_image(make_row('1.%02d' % i, header(KVP=80.0 if i % 2 else 120.0,
+                                                           DateTime='201706%02d120000' % (i + 1))))
+        writer.add_image(make_row('2.0', header(SerialNumber='54321', Current=300)))
+        # a duplicate is not counted again
+        writer.add_image(make_row('1.00'))
+        writer.flush()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_filter_choices(self):
+        choices = filter_choices()
+        self.assertEqual(choices['kv'], [(80.0, 5), (120.0, 6)])
+        self.assertEqual(choices['current'], [(200, 10), (300, 1)])
+        self.assertEqual(choices['serial'], [(12345, 10), (54321, 1)])
+        self.assertEqual(choices['date_time'], ('20170601120000', '20170610120000'))
+        self.assertEqual(FilterChoice.rebuild(), 7)
+        self.assertEqual(filter_choices(), choices)
+
+    def test_keyset_pages(self):
+        uids = []
+        cursor = None
+        while True:
+            images, cursor = list_images(limit=3, after=cursor, serial=12345)
+            uids += [image['Uid'] for image in images]
+            self.assertNotIn('Integration_result', images[0])
+            if cursor is None:
+                break
+        self.assertEqual(uids, ['1.%02d' % i for i in reversed(range(10))])
+
+    def test_filters(self):
+        images, _ = list_images(**parse_filters({'kv': '80', 'start': '20170603', 'end': '20170608'}))
+        self.assertEqual([image['Uid'] for image in images], ['1.07', '1.05', '1.03'])
+        with self.assertRaises(ValueError):
+            parse_filters({'current': 'high'})
+        # a serial number with letters is kept as text, as FilterChoice offers it
+        writer = BatchWriter()
+        writer.add_image(make_row('3.0', header(SerialNumber='CT12A')))
+        writer.flush()
+        self.assertEqual(parse_filters({'serial': '12345'}), {'serial': 12345})
+        data = json.loads(self.client.get('/api/images?serial=CT12A').data.decode())
+        self.assertEqual([image['Uid'] for image in data['images']], ['3.0'])
+
+    def test_api(self):
+        response = self.client.get('/api/images?current=300')
+        data = json.loads(response.data.decode())
+        self.assertEqual([image['Uid'] for image in data['images']], ['2.0'])
+        self.assertIsNone(data['next'])
+        self.assertEqual(self.client.get('/api/images?kv=high').status_code, 400)
+
+        data = json.loads(self.client.get('/api/filters').data.decode())
+        self.assertEqual(data['kv'], [{'value': 80.0, 'count': 5}, {'value': 120.0, 'count': 6}])
+        self.assertEqual(data['date_time']['last'], '20170610120000')
+
+        page = self.client.get('/?Select_KV=80').data.decode()
+        self.assertIn('<option selected value="80">80</option>', page)
+        self.assertEqual(page.count('<td>12345</td>'), 5)
+
+    def test_create_indexes(self):
+        db.session.execute('DROP INDEX ix_dicoms_protocol_date_time')
+        db.session.commit()
+        self.assertEqual(create_indexes(), ['ix_dicoms_protocol_date_time'])
+        self.assertEqual(create_indexes(), [])
@@ -0,0 +1,90 @@
+import shutil
+import tempfile
+import threading
+import unittest
+import numpy as np
+from app import create_app, db
+from app.models import ImageDatabase
+from app.main.algorithm.PixelStore import PixelStore
+from app.main.algorithm.Renderer import Renderer
+from tests.test_batch_writer import HEADER
+
+
+class RendererTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_cache(self):
+        calls = []
+        renderer = Renderer(self.directory, memory_items=1)
+        render = lambda: calls.append(1) or b'png'
+        key = renderer.key('plot', 'a', 'small')
+        self.assertEqual(renderer.get(key, render)[0], b'png')
+        self.assertEqual(renderer.get(key, render)[0], b'png')
+        renderer.get(renderer.key('plot', 'b', 'small'), render)
+        # evicted from memory, still on disk
+        self.assertEqual(renderer.get(key, render)[0], b'png')
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(len(Renderer(self.directory).Memory), 0)
+        self.assertEqual(Renderer(self.directory).get(key, render)[0], b'png')
+        self.assertEqual(len(calls), 2)
+
+    def test_render_in_threads(self):
+        results = []
+        profile = np.sin(np.arange(233) / 10)
+        threads = [threading.Thread(target=lambda: results.append(Renderer.render_plot(profile, 256)))
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 4)
+        self.assertTrue(all(result.startswith(b'\x89PNG') for result in results))
+
+    def test_preview_size(self):
+        image = np.tile(np.linspace(-100, 100, 64), (64, 1))
+        self.assertTrue(Renderer.render_preview(image, (100, 0), 32).startswith(b'\x89PNG'))
+        window = Renderer.window_image(image, (100, 0))
+        self.assertEqual((window.min(), window.max()), (0, 255))
+
+
+class RenderRouteTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.directory = tempfile.mkdtemp()
+        self.app.config['PIXEL_STORE_DIR'] = self.directory
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        pixel_hash = PixelStore(self.directory).put(np.zeros((16, 16), dtype=np.int16))
+        db.session.execute(ImageDatabase.__table__.insert(),
+                           [ImageDatabase.make_row('a', HEADER, [0.5, 1.5], pixel_hash=pixel_hash)])
+        db.session.commit()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_preview(self):
+        response = self.client.get('/images/a/preview.png?size=thumb')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'image/png')
+        etag = response.headers['ETag']
+        response = self.client.get('/images/a/preview.png?size=thumb', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get('/images/a/preview.png?size=thumb&ww=400&wl=40')
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertEqual(self.client.get('/images/a/preview.png?size=huge').status_code, 400)
+        self.assertEqual(self.client.get('/images/b/preview.png').status_code, 404)
+
+    def test_plot(self):
+        response = self.client.get('/images/a/plot.png')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.data.startswith(b'\x89PNG'))
+        self.assertIn('/images/a/plot.png', self.client.get('/').data.decode())
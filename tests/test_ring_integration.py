@@ -0,0 +1,57 @@
+import unittest
+from types import SimpleNamespace
+import numpy as np
+from app.main.algorithm.ImageHandler import ImageHandler
+from app.main.algorithm.RingIntegrator import RingIntegrator
+
+
+def make_dicom(size=512, radius=240, offset=(0, 0), seed=0):
+    rng = np.random.RandomState(seed)
+    rows, cols = np.ogrid[:size, :size]
+    inside = (rows - size // 2 - offset[0]) ** 2 + (cols - size // 2 - offset[1]) ** 2 < radius ** 2
+    raw = np.where(inside, 1024, 24) + rng.randint(-10, 10, (size, size))
+    return SimpleNamespace(RawData=raw.astype(np.int16), Slop=1.0, Intercept=-1024.0,
+                           Rows=size, Cols=size, PixSpace=[0.5, 0.5],
+                           WindowWidth=100, WindowCenter=0)
+
+
+class RingIntegrationTestCase(unittest.TestCase):
+    def test_ring_matches_bresenham(self):
+        dcm = make_dicom(offset=(3, -5))
+        ring = ImageHandler(dcm, integration='ring')
+        legacy = ImageHandler(dcm, integration='bresenham')
+        self.assertTrue(ring.isImageComplete)
+        self.assertTrue(legacy.isImageComplete)
+        np.testing.assert_allclose(ring.Image_Integration_Result, legacy.Image_Integration_Result,
+                                   rtol=0, atol=1e-9)
+        np.testing.assert_allclose(ring.Image_Median_Filter_Result, legacy.Image_Median_Filter_Result,
+                                   rtol=0, atol=1e-9)
+
+    def test_lean_matches_default(self):
+        dcm = make_dicom(offset=(3, -5))
+        default = ImageHandler(dcm)
+        lean = ImageHandler(dcm, lean=True)
+        self.assertTrue(lean.isImageComplete)
+        self.assertEqual(lean.Image_HU.dtype, np.float32)
+        self.assertIsNone(lean.Image)
+        self.assertEqual((lean.Center, lean.Radius), (default.Center, default.Radius))
+        # integer HU values are exact in float32, only the chunked summation order differs
+        np.testing.assert_allclose(lean.Image_Integration_Result, default.Image_Integration_Result,
+                                   rtol=0, atol=1e-9)
+        np.testing.assert_allclose(lean.Image_Median_Filter_Result, default.Image_Median_Filter_Result,
+                                   rtol=0, atol=1e-9)
+        # the display image is only made when it is asked for
+        np.testing.assert_array_equal(np.array(lean.show_image()), np.array(default.show_image()))
+
+    def test_geometry_is_cached(self):
+        a = RingIntegrator.get(512, 512, (256, 256), 233)
+        b = RingIntegrator.get(512, 512, (256, 256), 233)
+        self.assertIs(a, b)
+
+    def test_ring_out_of_border(self):
+        with self.assertRaises(IndexError):
+            RingIntegrator(64, 64, (60, 32), 20)
+
+    def test_unknown_integration(self):
+        with self.assertRaises(ValueError):
+            ImageHandler(make_dicom(size=64, radius=20), integration='unknown')
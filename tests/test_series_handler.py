@@ -0,0 +1,33 @@
+import unittest
+import numpy as np
+from app.main.algorithm.ImageHandler import ImageHandler
+from app.main.algorithm.SeriesHandler import SeriesHandler
+from tests.test_ring_integration import make_dicom
+
+
+class SeriesHandlerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dicoms = [make_dicom(offset=(i % 3, -(i % 2)), seed=i) for i in range(5)]
+        for i, dcm in enumerate(self.dicoms):
+            dcm.FileName = 'slice%d' % i
+
+    def test_refine_matches_slices(self):
+        series = SeriesHandler(self.dicoms, refine=True)
+        self.assertTrue(series.isImageComplete)
+        for dcm, center, profile, raw_profile in zip(self.dicoms, series.Centers, series.Image_Median_Filter_Results,
+                                                     series.Image_Integration_Results):
+            image = ImageHandler(dcm)
+            self.assertEqual(image.Center, center)
+            np.testing.assert_array_equal(image.Image_Median_Filter_Result, profile)
+            np.testing.assert_array_equal(image.Image_Integration_Result, raw_profile)
+
+    def test_center_of_middle_slice(self):
+        series = SeriesHandler(self.dicoms)
+        self.assertTrue(series.isImageComplete)
+        self.assertEqual(set(series.Centers), {ImageHandler(self.dicoms[2]).Center})
+        self.assertEqual(len(series.Image_Median_Filter_Results), 5)
+
+    def test_different_geometry(self):
+        self.dicoms.append(make_dicom(size=500))
+        self.dicoms[-1].FileName = 'other'
+        self.assertFalse(SeriesHandler(self.dicoms).isImageComplete)
@@ -0,0 +1,23 @@
+import os
+import subprocess
+import sys
+import unittest
+
+
+class StartupTestCase(unittest.TestCase):
+    def loaded_modules(self, code):
+        """
+        :return: the heavy modules loaded by code in a new interpreter
+        """
+        check = code + "\nimport sys\nprint(' '.join(m for m in ('numpy', 'matplotlib', 'PIL.Image', 'dicom', " \
+                       "'alembic') if m in sys.modules))"
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.check_output([sys.executable, '-c', check], cwd=root, stderr=subprocess.DEVNULL,
+                                         env=dict(os.environ, FLASK_CONFIG='testing'))
+        return output.decode().split()
+
+    def test_web_app_is_lean(self):
+        self.assertEqual(self.loaded_modules("import wsgi\nwsgi.app.test_client().get('/jobs/none')"), [])
+
+    def test_manage_is_lean(self):
+        self.assertEqual(self.loaded_modules("import manage"), [])
@@ -0,0 +1,72 @@
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from app import create_app, db
+from app.models import ImageDatabase
+from app.storage import migrate_storage
+from app.main.algorithm.PixelStore import PixelStore
+from tests.test_batch_writer import HEADER
+
+
+class PixelStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = PixelStore(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_put_get(self):
+        array = np.arange(12, dtype=np.int16).reshape(3, 4)
+        key = self.store.put(array)
+        self.assertEqual(key, self.store.put(array.copy()))
+        self.assertTrue(self.store.exists(key))
+        np.testing.assert_array_equal(self.store.get(key), array)
+        self.assertIsInstance(self.store.get(key), np.memmap)
+
+    def test_content_address(self):
+        array = np.arange(12, dtype=np.int16)
+        self.assertNotEqual(self.store.key(array), self.store.key(array.reshape(3, 4)))
+        self.assertNotEqual(self.store.key(array), self.store.key(array.astype(np.int32)))
+
+
+class MigrationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.drop_all()
+        # the legacy schema
+        db.session.execute('CREATE TABLE dicoms (Uid TEXT NOT NULL PRIMARY KEY, Serial_number INTEGER NOT NULL, '
+                           'Modality TEXT NOT NULL, Tube_voltage FLOAT NOT NULL, Tube_current INTEGER NOT NULL, '
+                           'Kernel TEXT NOT NULL, Total_collimation FLOAT NOT NULL, '
+                           'Slice_Thickness FLOAT NOT NULL, Instance INTEGER NOT NULL, '
+                           'Integration_result TEXT NOT NULL, Date_Time TEXT NOT NULL, '
+                           'Dicom_Save BLOB NOT NULL, Comment TEXT)')
+        self.raw_data = np.arange(16, dtype=np.int16).reshape(4, 4)
+        for uid in ('a', 'b', 'c'):
+            db.session.execute('INSERT INTO dicoms VALUES (:uid, 12345, "CT", 120, 200, "B30f", 19.2, 1.2, 1, '
+                               '"0.5;1.5;2.5", "20170601120000", :save, "note")',
+                               {'uid': uid, 'save': pickle.dumps({'Header': HEADER, 'RawData': self.raw_data})})
+        db.session.commit()
+        self.directory = tempfile.mkdtemp()
+        self.store = PixelStore(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_migrate(self):
+        self.assertEqual(migrate_storage(self.store, chunk_size=2), 3)
+        image = ImageDatabase.query.get('b')
+        np.testing.assert_array_equal(image.profile, np.array([0.5, 1.5, 2.5], dtype=np.float32))
+        np.testing.assert_array_equal(image.pixel_data(self.store), self.raw_data)
+        self.assertEqual(image.Comment, 'note')
+        self.assertIsNone(image.Dicom_Save)
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+        self.assertEqual(migrate_storage(self.store), 0)
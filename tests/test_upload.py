@@ -0,0 +1,143 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+from app import create_app, db
+from app.models import ImageDatabase, FileManifest
+from app.upload import iter_zip, iter_upload, UploadError
+from app.main.algorithm.PhantomGenerator import PhantomGenerator
+
+
+class SlowStream:
+    """
+    A request body which arrives a few bytes at a time.
+    """
+    def __init__(self, data, step=7):
+        self.Data = io.BytesIO(data)
+        self.Step = step
+
+    def read(self, size=-1):
+        return self.Data.read(self.Step if size < 0 else min(size, self.Step))
+
+
+class UnseekableWriter(io.RawIOBase):
+    """
+    zipfile writes data descriptors to an unseekable file.
+    """
+    def __init__(self):
+        self.Data = io.BytesIO()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self.Data.write(data)
+
+
+Members = [('a.dcm', b'DICM' * 1000), ('dir/b.dcm', os.urandom(3000)), ('empty.txt', b'')]
+
+
+def make_zip(compression, fp=None):
+    fp = fp or io.BytesIO()
+    with zipfile.ZipFile(fp, 'w', compression) as archive:
+        for name, content in Members:
+            archive.writestr(zipfile.ZipInfo(name), content, compress_type=compression)
+    return fp.getvalue() if isinstance(fp, io.BytesIO) else fp.Data.getvalue()
+
+
+def multipart(boundary, files):
+    body = b''
+    for name, content in files:
+        body += (b'--' + boundary + b'\r\nContent-Disposition: form-data; name="files"; filename="' +
+                 name.encode() + b'"\r\nContent-Type: application/octet-stream\r\n\r\n' + content + b'\r\n')
+    return body + b'--' + boundary + b'--\r\n'
+
+
+class ZipStreamTestCase(unittest.TestCase):
+    def test_stored(self):
+        self.assertEqual(list(iter_zip(SlowStream(make_zip(zipfile.ZIP_STORED)))), Members)
+
+    def test_deflated(self):
+        self.assertEqual(list(iter_zip(SlowStream(make_zip(zipfile.ZIP_DEFLATED)))), Members)
+
+    def test_data_descriptor(self):
+        data = make_zip(zipfile.ZIP_DEFLATED, UnseekableWriter())
+        self.assertTrue(zipfile.ZipFile(io.BytesIO(data)).infolist()[0].flag_bits & 0x08)
+        self.assertEqual(list(iter_zip(SlowStream(data, step=100), chunk_size=64)), Members)
+
+    def test_short_reads(self):
+        # a read of a signature may return less than 4 bytes before the end of the stream
+        data = make_zip(zipfile.ZIP_DEFLATED)
+        self.assertEqual(list(iter_zip(SlowStream(data, step=3), chunk_size=3)), Members)
+        self.assertEqual(list(iter_upload(SlowStream(data, step=3), 'application/octet-stream', {}, filename='a')),
+                         [('a/' + name, content) for name, content in Members])
+
+    def test_too_big(self):
+        self.assertEqual([name for name, _ in iter_zip(io.BytesIO(make_zip(zipfile.ZIP_DEFLATED)),
+                                                       max_member_size=3500)], ['dir/b.dcm', 'empty.txt'])
+
+    def test_corrupted(self):
+        with self.assertRaises(UploadError):
+            list(iter_zip(io.BytesIO(b'not a zip archive')))
+        data = make_zip(zipfile.ZIP_STORED)
+        with self.assertRaises(UploadError):
+            list(iter_zip(io.BytesIO(data[:100])))
+
+    def test_multipart(self):
+        boundary = b'----boundary123'
+        body = multipart(boundary, [('one.dcm', b'\r\n--' + boundary[:-1] + b'\r\n'),
+                                    ('archive.zip', make_zip(zipfile.ZIP_DEFLATED))])
+        uploads = list(iter_upload(SlowStream(body, step=5), 'multipart/form-data',
+                                   {'boundary': boundary.decode()}))
+        self.assertEqual(uploads, [('one.dcm', b'\r\n--' + boundary[:-1] + b'\r\n')] +
+                         [('archive.zip/' + name, content) for name, content in Members])
+
+    def test_single_file(self):
+        self.assertEqual(list(iter_upload(io.BytesIO(b'content'), 'application/dicom', {}, filename='a.dcm')),
+                         [('a.dcm', b'content')])
+        self.assertEqual(len(list(iter_upload(io.BytesIO(make_zip(zipfile.ZIP_STORED)), 'application/zip', {}))),
+                         len(Members))
+
+
+class UploadTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+        self.directory = tempfile.mkdtemp()
+        PhantomGenerator().write_series(self.directory, 3)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_upload(self):
+        names = sorted(os.listdir(self.directory))
+        contents = []
+        for name in names:
+            with open(os.path.join(self.directory, name), 'rb') as fp:
+                contents.append(fp.read())
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as fp:
+            fp.writestr(names[1], contents[1])
+            fp.writestr(names[2], contents[2])
+            fp.writestr('readme.txt', b'not a DICOM file')
+        body = multipart(b'xyz', [(names[0], contents[0]), ('series.zip', archive.getvalue()),
+                                  (names[0], contents[0])])
+        response = self.client.post('/upload', data=body, content_type='multipart/form-data; boundary=xyz')
+        self.assertEqual(response.status_code, 200)
+        result = json.loads(response.data.decode())
+        self.assertEqual((result['received'], result['processed'], result['inserted'], result['duplicated']),
+                         (5, 4, 3, 1))
+        self.assertEqual(ImageDatabase.query.count(), 3)
+        self.assertEqual(FileManifest.query.count(), 0)
+
+        response = self.client.post('/upload', data=b'PK\x03\x04broken', content_type='application/zip')
+        self.assertEqual(response.status_code, 400)
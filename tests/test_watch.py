@@ -0,0 +1,104 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from app import create_app, db
+from app.models import ImageDatabase, FileManifest
+from app.watch import Debouncer, InotifyWatcher, PollingWatcher, watch_folders
+from app.main.algorithm.PhantomGenerator import PhantomGenerator
+
+
+def write(path, data=b'data'):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'ab') as fp:
+        fp.write(data)
+
+
+class WatcherTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        write(os.path.join(self.directory, 'old', 'a.dcm'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def check_watcher(self, watcher):
+        try:
+            self.assertEqual(watcher.changes(0.01), (set(), False))
+            new = [os.path.join(self.directory, 'b.dcm'), os.path.join(self.directory, 'old', 'c.dcm'),
+                   os.path.join(self.directory, 'new', 'sub', 'd.dcm')]
+            for path in new:
+                write(path)
+            found = set()
+            deadline = time.time() + 5
+            while found != set(new) and time.time() < deadline:
+                paths, rescan = watcher.changes(0.05)
+                self.assertFalse(rescan)
+                found |= paths
+            self.assertEqual(found, set(new))
+        finally:
+            watcher.close()
+
+    def test_polling(self):
+        self.check_watcher(PollingWatcher([self.directory], recent=0))
+
+    def test_inotify(self):
+        try:
+            watcher = InotifyWatcher([self.directory])
+        except OSError as e:
+            self.skipTest(str(e))
+        self.check_watcher(watcher)
+
+    def test_debouncer(self):
+        path = os.path.join(self.directory, 'old', 'a.dcm')
+        debouncer = Debouncer(settle=2)
+        debouncer.touch(path, now=0)
+        self.assertEqual(debouncer.ready(now=0), [])
+        self.assertEqual(debouncer.ready(now=1), [])
+        # still written
+        write(path, b'more data')
+        os.utime(path, ns=(0, 123))
+        self.assertEqual(debouncer.ready(now=2.5), [])
+        self.assertEqual(debouncer.ready(now=4), [])
+        self.assertEqual(debouncer.ready(now=4.5), [path])
+        self.assertEqual(len(debouncer), 0)
+        debouncer.touch(os.path.join(self.directory, 'missing.dcm'))
+        self.assertEqual((debouncer.ready(), len(debouncer)), ([], 0))
+
+
+class WatchFoldersTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.directory = tempfile.mkdtemp()
+        self.generator = PhantomGenerator()
+        self.generator.write(os.path.join(self.directory, 'IM1'), instance=1)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_watch(self):
+        ingests = []
+        deadline = time.time() + 10
+
+        def stop():
+            if len(ingests) == 1 and not os.path.exists(os.path.join(self.directory, 'series')):
+                # a new series arrives after the catch up
+                self.generator.write_series(os.path.join(self.directory, 'series'), 2, series=2)
+            return time.time() > deadline or ImageDatabase.query.count() >= 3
+
+        totals = watch_folders([self.directory], settle=0.1, poll_interval=0.05, workers=1, stop=stop,
+                               report=lambda ingest: ingests.append(ingest))
+        self.assertEqual(ImageDatabase.query.count(), 3)
+        self.assertEqual(totals['inserted'], 3)
+        # the catch up walks the directory, then only the new files are ingested
+        self.assertIsNone(ingests[0].Paths)
+        self.assertEqual(sorted(os.path.basename(p) for ingest in ingests[1:] for p in ingest.Paths),
+                         ['IM00001.dcm', 'IM00002.dcm'])
+        self.assertEqual(FileManifest.query.count(), 3)
@@ -0,0 +1,5 @@
+import os
+from app import create_app
+
+# gunicorn wsgi:app, without the imports of the manage.py commands
+app = create_app(os.environ.get('FLASK_CONFIG') or 'default')